@@ -0,0 +1,136 @@
+"""Persistent caches that are shared between `otk` invocations. Entries are
+files in a directory below the users cache directory. Writes are atomic and
+every operation is best-effort so that concurrent processes (and a broken or
+read-only cache directory) never fail a compile."""
+
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Upper bound for the size of the cache of parsed omnifest fragments.
+PARSE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# Upper bound for the size of the cache of external results.
+EXTERNAL_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+def cache_home() -> pathlib.Path:
+    """Return the directory `otk` keeps its caches in, this follows the XDG
+    base directory specification."""
+    base = os.getenv("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return pathlib.Path(base) / "otk"
+
+
+class DiskCache:
+    """A directory of cache entries, each entry is a file named by its key.
+    The total size of the directory is capped, when it grows beyond the cap
+    the least recently used entries are evicted. Use is tracked through the
+    modification time of the entries.
+
+    The directory is only scanned for its size on the first write, after that
+    the size is estimated from what is written. Entries written by other
+    processes are counted once the estimate goes beyond the cap and the
+    directory is scanned again."""
+
+    path: pathlib.Path
+    max_size: int
+
+    def __init__(self, path: pathlib.Path, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        # caches are shared between threads
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self.path / key
+        try:
+            data = entry.read_bytes()
+            # mark as recently used
+            os.utime(entry)
+        except OSError:
+            return None
+        return data
+
+    def touch(self, key: str) -> bool:
+        """Mark the entry `key` as recently used, returns if it exists."""
+        try:
+            os.utime(self.path / key)
+        except OSError:
+            return False
+        return True
+
+    def put(self, key: str, data: bytes) -> int:
+        """Store `data` under `key`, returns the number of entries that were
+        evicted to make room for it."""
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as fp:
+                    fp.write(data)
+                # readers either see the old or the new complete entry
+                os.replace(tmp, self.path / key)
+            except BaseException:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        except OSError as exc:
+            log.debug("could not write cache entry %s: %s", key, exc)
+            return 0
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+                if self._size <= self.max_size:
+                    return 0
+        return self.evict()
+
+    def remove(self, key: str) -> None:
+        try:
+            os.unlink(self.path / key)
+        except OSError:
+            pass
+
+    def evict(self) -> int:
+        """Remove the least recently used entries until the cache fits into
+        its maximum size. Returns the number of evicted entries."""
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.path) as it:
+                for dent in it:
+                    try:
+                        st = dent.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, dent.path))
+                    total += st.st_size
+        except OSError:
+            return 0
+
+        evicted = 0
+        if total > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                log.debug("evicting cache entry %s", path)
+                try:
+                    os.unlink(path)
+                    evicted += 1
+                except OSError:
+                    # another process got there first
+                    pass
+                total -= size
+        with self._lock:
+            self._size = total
+        return evicted
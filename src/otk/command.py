@@ -1,11 +1,17 @@
 import argparse
+import contextlib
 import logging
+import os
 import pathlib
 import sys
-from typing import List
+from typing import Iterator, List, Optional
 
 from . import __version__
-from .document import Omnifest
+from .cache import EXTERNAL_CACHE_MAX_SIZE, PARSE_CACHE_MAX_SIZE, DiskCache, cache_home
+from .constant import ENV_NO_CACHE
+from .document import Omnifest, find_targets
+from .external import BUNDLED, ExternalCache, external_index, lookup, write_index
+from .transform import RESOLVERS, ParseCache
 
 log = logging.getLogger(__name__)
 
@@ -32,11 +38,41 @@ def run(argv: List[str]) -> int:
         return compile(arguments)
     if arguments.command == "validate":
         return validate(arguments)
+    if arguments.command == "externals":
+        return externals(arguments)
 
     parser.print_help()
     return 2
 
 
+@contextlib.contextmanager
+def _externals_no_cache(no_cache: bool) -> Iterator[None]:
+    """Tell the externals to not use their caches either. Externals are
+    started from or run in this process, so they are told through the
+    environment."""
+    if not no_cache:
+        yield
+        return
+    old = os.environ.get(ENV_NO_CACHE)
+    os.environ[ENV_NO_CACHE] = "1"
+    try:
+        yield
+    finally:
+        if old is None:
+            del os.environ[ENV_NO_CACHE]
+        else:
+            os.environ[ENV_NO_CACHE] = old
+
+
+def _single_target(targets: List[str]) -> Optional[str]:
+    """Return the only one of `targets`, or "" when there are none. Documents
+    with more than one target need "-t"."""
+    if len(targets) > 1:
+        log.fatal("INPUT contains multiple targets, `-t` is required")
+        return None
+    return next(iter(targets), "")
+
+
 def _process(arguments: argparse.Namespace, dry_run: bool) -> int:
     if not dry_run:
         # pylint: disable=R1732
@@ -49,36 +85,47 @@ def _process(arguments: argparse.Namespace, dry_run: bool) -> int:
     else:
         paths = extra + [pathlib.Path(arguments.input)]
 
-    # First pass of resolving the otk file is "shallow", it will not run
-    # externals and not resolve anything under otk.target.*
-    #
-    # It only exists as convenience for the user so that they do not need
-    # to use "-t"
-    doc = Omnifest(paths)
+    # Unless disabled parsed files are also kept on disk for later runs, the
+    # results of (cacheable) externals only when asked for.
+    external_cache = None
+    if getattr(arguments, "no_cache", False):
+        parse_cache = ParseCache()
+    else:
+        parse_cache = ParseCache(DiskCache(cache_home() / "parse", PARSE_CACHE_MAX_SIZE))
+        if getattr(arguments, "cache_externals", False):
+            external_cache = ExternalCache(DiskCache(cache_home() / "external", EXTERNAL_CACHE_MAX_SIZE))
+
+    # The omnifest is resolved once. Without "-t" a document has to have a
+    # single target, that is checked before resolving so no externals run
+    # for a document that fails. Targets in includes with variables in their
+    # path are only found by resolving, and then checked afterwards.
+    target_requested = arguments.target or _single_target(find_targets(paths, parse_cache))
+    if target_requested is None:
+        return 1
+    warn_duplicated_defs = any(arg in getattr(arguments, "warn", [])
+                               for arg in ["duplicate-definition", "all"])
+    with _externals_no_cache(getattr(arguments, "no_cache", False)):
+        doc = Omnifest(paths, target=target_requested, warn_duplicated_defs=warn_duplicated_defs,
+                       parse_cache=parse_cache, resolver=getattr(arguments, "resolver", "recursive"),
+                       jobs=getattr(arguments, "jobs", 1), external_cache=external_cache,
+                       inprocess_externals=not getattr(arguments, "no_inprocess_externals", False))
+    if external_cache is not None:
+        log.info("external cache: %d hits, %d misses, %d evictions",
+                 external_cache.hits, external_cache.misses, external_cache.evictions)
 
     target_available = doc.targets
-    target_requested = arguments.target
-    if not target_requested:
-        if len(target_available) > 1:
-            log.fatal("INPUT contains multiple targets, `-t` is required")
-            return 1
-        # set the requested target to the default case now that we know that
-        # there aren't multiple targets available and none are requested
-        target_requested = list(target_available.keys())[0]
+    target_requested = arguments.target or _single_target(list(target_available))
+    if target_requested is None:
+        return 1
 
     if target_requested not in target_available:
         log.fatal("requested target %r does not exist in INPUT", target_requested)
         return 1
 
-    # Now do the real resolve that takes the target into account. It needs
-    # a full run so that resolving includes works correctly.
-    warn_duplicated_defs = any(arg in getattr(arguments, "warn", [])
-                               for arg in ["duplicate-definition", "all"])
-    doc = Omnifest(paths, target=target_requested, warn_duplicated_defs=warn_duplicated_defs)
-
     # and then output by writing to the output
     if not dry_run:
-        dst.write(doc.as_target_string())
+        # written as it is serialized, the manifest can be large
+        doc.write_target(dst, pretty=not getattr(arguments, "compact", False))
         if arguments.output is not None:
             dst.close()
 
@@ -93,6 +140,31 @@ def validate(arguments: argparse.Namespace) -> int:
     return _process(arguments, dry_run=True)
 
 
+def externals(arguments: argparse.Namespace) -> int:
+    if arguments.write_index is not None:
+        directory = pathlib.Path(arguments.write_index)
+        try:
+            names = write_index(directory)
+        except OSError as exc:
+            log.fatal("cannot write index: %s", exc)
+            return 1
+        log.info("indexed %d externals in %s", len(names), directory)
+        return 0
+
+    inprocess = not getattr(arguments, "no_inprocess_externals", False)
+    for name in sorted(set(external_index().externals()) | set(BUNDLED)):
+        try:
+            exe, module = lookup(name, inprocess)
+        except RuntimeError:
+            # bundled but not run in-process and not in the search paths
+            continue
+        if module is not None:
+            print(f"{name}\tin-process ({module.__name__})")
+        elif exe is not None:
+            print(f"{name}\t{exe}")
+    return 0
+
+
 def parser_create() -> argparse.ArgumentParser:
     # set up the main parser arguments
     parser = argparse.ArgumentParser(
@@ -152,6 +224,39 @@ def parser_create() -> argparse.ArgumentParser:
         default=None,
         help="Target to output, required if more than one target exists in an omnifest.",
     )
+    parser_compile.add_argument(
+        "--compact",
+        action="store_true",
+        help="Output compact JSON instead of indented JSON.",
+    )
+    parser_compile.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of externals in otk.define blocks to run in parallel.",
+    )
+    parser_compile.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update any cache.",
+    )
+    parser_compile.add_argument(
+        "--cache-externals",
+        action="store_true",
+        help="Reuse the results of externals that declare themselves cacheable.",
+    )
+    parser_compile.add_argument(
+        "--no-inprocess-externals",
+        action="store_true",
+        help="Always run the bundled externals as separate programs instead of in-process.",
+    )
+    parser_compile.add_argument(
+        "--resolver",
+        choices=list(RESOLVERS),
+        default="recursive",
+        help="Resolver implementation to use, 'iterative' is not limited by the nesting depth of the omnifest.",
+    )
 
     parser_validate = subparsers.add_parser("validate", help="Validate an omnifest.")
     parser_validate.add_argument(
@@ -174,5 +279,46 @@ def parser_create() -> argparse.ArgumentParser:
         default=None,
         help="Target to validate, required if more than one target exists in an omnifest.",
     )
+    parser_validate.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of externals in otk.define blocks to run in parallel.",
+    )
+    parser_validate.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not use or update any cache.",
+    )
+    parser_validate.add_argument(
+        "--cache-externals",
+        action="store_true",
+        help="Reuse the results of externals that declare themselves cacheable.",
+    )
+    parser_validate.add_argument(
+        "--no-inprocess-externals",
+        action="store_true",
+        help="Always run the bundled externals as separate programs instead of in-process.",
+    )
+    parser_validate.add_argument(
+        "--resolver",
+        choices=list(RESOLVERS),
+        default="recursive",
+        help="Resolver implementation to use, 'iterative' is not limited by the nesting depth of the omnifest.",
+    )
+
+    parser_externals = subparsers.add_parser("externals", help="List the available externals.")
+    parser_externals.add_argument(
+        "--no-inprocess-externals",
+        action="store_true",
+        help="List the programs that are run when the bundled externals are not run in-process.",
+    )
+    parser_externals.add_argument(
+        "--write-index",
+        metavar="DIR",
+        default=None,
+        help="Write an index of the externals in DIR to it instead, for read-only or slow search paths.",
+    )
 
     return parser
@@ -8,7 +8,23 @@ PREFIX_DEFINE = f"{PREFIX}define"
 
 PREFIX_EXTERNAL = f"{PREFIX}external."
 
+# set in the environment of externals that are started as a worker
+ENV_EXTERNAL_WORKER = "OTK_EXTERNAL_WORKER"
+# set in the environment of externals that exchange requests and responses
+# through files
+ENV_EXTERNAL_INPUT = "OTK_EXTERNAL_INPUT"
+ENV_EXTERNAL_OUTPUT = "OTK_EXTERNAL_OUTPUT"
+# set in the environment of externals when `otk` was asked not to use or
+# update any cache, externals that keep caches of their own honour it
+ENV_NO_CACHE = "OTK_NO_CACHE"
+
+# precomputed list of the externals in a directory of the search path
+EXTERNAL_INDEX_FILE = ".otk-external-index.json"
+
 NAME_VERSION = f"{PREFIX}version"
 
+# large values in the requests to externals are replaced by a reference
+NAME_REFERENCE = f"{PREFIX}ref"
+
 # only allow "simple" variable names to avoid confusion
 VALID_VAR_NAME_RE = r"[a-zA-Z][a-zA-Z0-9_]*"
@@ -3,6 +3,7 @@
 # Enables postponed annotations on older snakes (PEP-563)
 from __future__ import annotations
 
+import functools
 import logging
 import re
 from abc import ABC, abstractmethod
@@ -13,13 +14,24 @@ from .error import (ParseError,
                     TransformVariableIndexRangeError,
                     TransformVariableIndexTypeError,
                     TransformVariableLookupError, TransformVariableTypeError)
+from .runtime import Runtime
 
 log = logging.getLogger(__name__)
 
 
+_VALID_VAR_NAME = re.compile(VALID_VAR_NAME_RE)
+
+# Value of a name that is reserved for a define that is still to come, see
+# `Context.reserve`.
+_RESERVED = object()
+
+
+# Valid names are remembered, the same names get validated over and over
+# again on every define and substitution.
+@functools.lru_cache(maxsize=65536)
 def validate_var_name(name):
     for part in name.split("."):
-        if not re.fullmatch(VALID_VAR_NAME_RE, part):
+        if not _VALID_VAR_NAME.fullmatch(part):
             raise ParseError(f"invalid variable part '{part}' in '{name}', allowed {VALID_VAR_NAME_RE}")
 
 
@@ -36,32 +48,50 @@ class Context(ABC):
     @abstractmethod
     def variable(self, name: str) -> Any: ...
 
+    @abstractmethod
+    def reserve(self, name: str) -> None: ...
+
     @property
     @abstractmethod
     def target_requested(self) -> str: ...
 
+    @property
+    @abstractmethod
+    def runtime(self) -> Runtime: ...
+
 
 class CommonContext(Context):
     warn_duplicated_defs: bool
     _target_requested: str
     _version: Optional[int]
     _variables: dict[str, Any]
+    # Flat index of looked up variables, by top-level name and then by their
+    # full dotted name. Defines drop the entries they (might) change.
+    _index: dict[str, dict[str, Any]]
+    _runtime: Runtime
 
     def __init__(
         self,
         *,
         target_requested: str = "",
         warn_duplicated_defs: bool = False,
+        runtime: Optional[Runtime] = None,
     ) -> None:
         self._version = None
         self._variables = {}
+        self._index = {}
         self._target_requested = target_requested
+        self._runtime = runtime if runtime is not None else Runtime()
         self.warn_duplicated_defs = warn_duplicated_defs
 
     @property
     def target_requested(self) -> str:
         return self._target_requested
 
+    @property
+    def runtime(self) -> Runtime:
+        return self._runtime
+
     def version(self, v: int) -> None:
         # Set the context version, duplicate definitions with different
         # versions are an error
@@ -76,14 +106,27 @@ class CommonContext(Context):
         if not self.warn_duplicated_defs:
             return
         key = parts[-1]
-        if cur_var_scope.get(key):
+        if cur_var_scope.get(key) and cur_var_scope[key] is not _RESERVED:
             log.warning("redefinition of %r, previous value was %r and new value is %r",
                         ".".join(parts), cur_var_scope[parts[-1]], value)
 
+    def _invalidate(self, name: str) -> None:
+        """Drop the index entries a define of `name` might change."""
+        top, _, rest = name.partition(".")
+        if rest and isinstance(self._variables.get(top), dict):
+            # the define changes a mapping in place, the same mapping can
+            # also be the value of (or in) other variables
+            self._index.clear()
+        else:
+            self._index.pop(top, None)
+
     def define(self, name: str, value: Any) -> None:
         log.debug("defining %r", name)
         validate_var_name(name)
+        if self._runtime.pending:
+            self._runtime.settle(name)
 
+        self._invalidate(name)
         cur_var_scope = self._variables
         parts = name.split(".")
         for i, part in enumerate(parts[:-1]):
@@ -94,12 +137,41 @@ class CommonContext(Context):
         self._maybe_log_var_override(cur_var_scope, parts, value)
         cur_var_scope[parts[-1]] = value
 
+    def reserve(self, name: str) -> None:
+        """Add `name` to the defines without a value (yet), so it keeps its
+        place when it is defined later on. Names that are already defined
+        are left alone, they keep their place anyway."""
+        if self._runtime.pending:
+            self._runtime.settle(name)
+
+        cur_var_scope = self._variables
+        parts = name.split(".")
+        for part in parts[:-1]:
+            if part not in cur_var_scope:
+                cur_var_scope[part] = {}
+            cur_var_scope = cur_var_scope[part]
+            if not isinstance(cur_var_scope, dict):
+                return
+        cur_var_scope.setdefault(parts[-1], _RESERVED)
+
     def variable(self, name: str) -> Any:
+        if self._runtime.pending:
+            self._runtime.settle(name)
+        top = name.partition(".")[0]
+        bucket = self._index.get(top)
+        if bucket is not None and name in bucket:
+            return bucket[name]
+
+        value = self._lookup(name)
+        self._index.setdefault(top, {})[name] = value
+        return value
+
+    def _lookup(self, name: str) -> Any:
         parts = name.split(".")
         value = self._variables
         for i, part in enumerate(parts):
             if isinstance(value, dict):
-                if part not in value:
+                if value.get(part, _RESERVED) is _RESERVED:
                     raise TransformVariableLookupError(f"could not resolve '{name}' as '{part}' is not defined")
 
                 # TODO how should we deal with integer keys, convert them
@@ -122,7 +194,11 @@ class CommonContext(Context):
         return value
 
     def merge_defines(self, name: str, defines: dict[str, Any]) -> None:
+        if self._runtime.pending:
+            self._runtime.settle(name)
         if name == "":
+            for key in defines:
+                self._invalidate(key)
             self._variables.update(defines)
         else:
             self.define(name, defines)
@@ -144,9 +220,16 @@ class OSBuildContext(Context):
     def variable(self, name: str) -> Any:
         return self._context.variable(name)
 
+    def reserve(self, name: str) -> None:
+        self._context.reserve(name)
+
     def merge_defines(self, name: str, defines: dict[str, Any]) -> None:
         self._context.merge_defines(name, defines)
 
     @property
     def target_requested(self) -> str:
         return self._context._target_requested
+
+    @property
+    def runtime(self) -> Runtime:
+        return self._context.runtime
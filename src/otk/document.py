@@ -1,12 +1,16 @@
 import logging
 import pathlib
-from copy import deepcopy
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Mapping, Optional, TextIO
 
+from . import transform
 from .constant import PREFIX, PREFIX_TARGET, NAME_VERSION
 from .context import CommonContext, OSBuildContext
+from .external import ExternalCache, FileTransport, References, WorkerPool
 from .error import NoTargetsError, ParseError, ParseVersionError, OTKError
-from .transform import process_include
+from .runtime import Runtime
+from .transform import RESOLVERS, ParseCache, process_include
 from .traversal import State
 from .target import OSBuildTarget
 
@@ -19,31 +23,71 @@ class Omnifest:
     _osbuild_ctx: OSBuildContext
     _target: str
 
-    def __init__(self, paths: list[pathlib.Path], target: str = "", *, warn_duplicated_defs: bool = False) -> None:
-        self._ctx = CommonContext(target_requested=target, warn_duplicated_defs=warn_duplicated_defs)
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        paths: list[pathlib.Path],
+        target: str = "",
+        *,
+        warn_duplicated_defs: bool = False,
+        parse_cache: Optional[ParseCache] = None,
+        external_cache: Optional[ExternalCache] = None,
+        resolver: str = "recursive",
+        jobs: int = 1,
+        inprocess_externals: bool = True,
+    ) -> None:
+        runtime = Runtime(
+            parse_cache=parse_cache if parse_cache is not None else ParseCache(),
+            external_cache=external_cache,
+            # externals that can are kept running for the whole resolve
+            workers=WorkerPool(),
+            references=References(),
+            files=FileTransport(),
+            # Externals in otk.define blocks run in the background when more
+            # than one job is allowed.
+            executor=ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None,
+            inprocess_externals=inprocess_externals,
+        )
+        self._ctx = CommonContext(
+            target_requested=target,
+            warn_duplicated_defs=warn_duplicated_defs,
+            runtime=runtime,
+        )
 
         # XXX: this can be removed once we find a way to deal with unset variables
         self._ctx.define("user.modifications", {})
-        self._target = target
         # XXX: redo using a type-safe target registry
-        if target:
-            if not target.startswith("osbuild"):
-                raise OTKError("only target osbuild supported right now")
-            self._osbuild_ctx = OSBuildContext(self._ctx)
+        if target and not target.startswith("osbuild"):
+            raise OTKError("only target osbuild supported right now")
+        if resolver not in RESOLVERS:
+            raise OTKError(f"unknown resolver {resolver!r}, expected one of {list(RESOLVERS)}")
         state = State()
 
-        for path in paths:
-            tree = process_include(self._ctx, state, path)
-
-        # XXX: review this code, the idea is to find top-level keys that
-        # have no targets but that of course only works if there are
-        # no targets in the resolving. this means we are currently forced
-        # to resolve without target first to get this kind of error checking
-        # :(
-        if self._target == "":
-            Omnifest.ensure(tree)
+        try:
+            for path in paths:
+                tree = process_include(self._ctx, state, path, RESOLVERS[resolver])
+            # a failing external is an error even when its result is not used
+            runtime.settle()
+        finally:
+            runtime.close()
+
+        # Only the requested target (or without a request: every target) is
+        # resolved, the top-level keys are the same either way.
+        Omnifest.ensure(tree)
         self._tree = tree
 
+        self._target = target
+        self._osbuild_ctx = OSBuildContext(self._ctx)
+        available = _targets(tree)
+        if not target and len(available) == 1:
+            # A document with a single target can be written without a
+            # request, `find_targets` finds it before resolving in most
+            # cases. Writing it needs a context that requests it, the one
+            # that resolved the document requested every target.
+            self._target = next(iter(available))
+            self._osbuild_ctx = OSBuildContext(CommonContext(target_requested=self._target, runtime=runtime))
+        if self._target and not self._target.startswith("osbuild"):
+            raise OTKError("only target osbuild supported right now")
+
     @classmethod
     def ensure(cls, deserialized_data: dict[str, Any]) -> None:
         """Take a dictionary and ensure that its keys and values would be
@@ -65,8 +109,10 @@ class Omnifest:
             raise NoTargetsError("input does not contain any targets")
 
     @property
-    def tree(self) -> dict[str, Any]:
-        return deepcopy(self._tree)
+    def tree(self) -> Mapping[str, Any]:
+        """The resolved tree. It shares unchanged subtrees with the parsed
+        omnifest files and must not be modified."""
+        return MappingProxyType(self._tree)
 
     @property
     def targets(self) -> dict[str, Any]:
@@ -74,12 +120,32 @@ class Omnifest:
         return _targets(self._tree)
 
     def as_target_string(self) -> str:
+        target = self._output_target()
+        return target.as_string(self._osbuild_ctx, self._tree)
+
+    def write_target(self, fp: TextIO, pretty: bool = True) -> None:
+        """Write the requested target to `fp` as it is serialized, the output
+        is the same as `as_target_string` (or compact without `pretty`)."""
+        target = self._output_target()
+        target.write(fp, self._osbuild_ctx, self._tree, pretty)
+
+    def _output_target(self) -> OSBuildTarget:
         # XXX: redo using type-safe target registry
         if not self._target.startswith("osbuild"):
             raise OTKError("only osbuild targets supported right now")
         target = OSBuildTarget()
-        target.ensure_valid(self._tree)
-        return target.as_string(self._osbuild_ctx, self._tree)
+        target.ensure_valid(self._tree[PREFIX_TARGET + self._target])
+        return target
+
+
+def find_targets(paths: list[pathlib.Path], parse_cache: Optional[ParseCache] = None) -> list[str]:
+    """Return the names of the targets of the omnifest made of `paths`
+    without resolving it, see `otk.transform.find_targets`."""
+    ctx = CommonContext(runtime=Runtime(parse_cache=parse_cache))
+    names = []
+    for path in paths:
+        names.extend(transform.find_targets(ctx, State(), path))
+    return list(dict.fromkeys(names))
 
 
 def _targets(tree: dict[str, Any]) -> dict[str, Any]:
@@ -2,37 +2,581 @@
 receive the subtree to operate on in JSON. They are expected to return a new
 subtree."""
 
+import functools
+import hashlib
+import importlib
 import json
 import logging
 import pathlib
+import re
+import shutil
 import subprocess
 import os
-from typing import Any
+import sysconfig
+import tempfile
+import threading
+from types import ModuleType
+from typing import Any, Iterator, Optional
 
-from .constant import PREFIX_EXTERNAL
+from . import __version__
+from .cache import DiskCache
+from .constant import (ENV_EXTERNAL_INPUT, ENV_EXTERNAL_OUTPUT, ENV_EXTERNAL_WORKER, EXTERNAL_INDEX_FILE,
+                       NAME_REFERENCE, PREFIX_EXTERNAL)
 from .error import ExternalFailedError
 from .traversal import State
+from .tree import copy_tree, iter_json, json_key, json_scalar
 
 log = logging.getLogger(__name__)
 
+# Lists and objects in requests from this size on are passed by reference,
+# see `References`.
+REFERENCE_MIN_SIZE = 64 * 1024
 
-def call(state: State, directive: str, tree: Any) -> Any:
-    exe = exe_from_directive(directive)
-    exe = path_for(exe)
+# How much of a program is read to recognize an installed entry point of a
+# bundled external, see `_is_bundled_program`.
+BUNDLED_HEAD_SIZE = 4096
 
-    data = json.dumps(
-        {
-            "tree": tree,
-        }
-    )
+# The externals that ship with otk and the modules implementing them. These
+# can be run in-process, see `call`.
+BUNDLED = {
+    "osbuild-gen-depsolve-dnf4": "otk_external_osbuild.command.gen_depsolve_dnf4",
+    "osbuild-make-depsolve-dnf4-rpm-stage": "otk_external_osbuild.command.make_depsolve_dnf4_rpm_stage",
+    "osbuild-make-depsolve-dnf4-curl-source": "otk_external_osbuild.command.make_depsolve_dnf4_curl_source",
+    "osbuild-get-dnf4-package-info": "otk_external_osbuild.command.get_dnf4_package_info",
+    "osbuild-gen-inline-files": "otk_external_osbuild.command.gen_inline_files",
+    "osbuild-make-inline-source": "otk_external_osbuild.command.make_inline_source",
+    "osbuild-make-generator-metadata": "otk_external_osbuild.command.make_generator_metadata",
+}
 
-    process = subprocess.run([exe], input=data, encoding="utf8", capture_output=True, check=False)
-    if process.returncode != 0:
-        msg = f"call {exe} {directive!r} failed: stdout={process.stdout!r}, stderr={process.stderr!r}"
+
+# Externals that look up several values in one call, with the key of a value
+# to look up and the key of a list or mapping of values to look up. The result
+# of the latter is a mapping by the values of the list or the keys of the
+# mapping. Lookups in otk.define blocks that differ only in what they look up
+# are sent in one request, see `otk.transform.defer_external`.
+BATCHED = {
+    "osbuild-get-dnf4-package-info": ("packagename", "packagenames"),
+}
+
+
+class ExternalCache:
+    """Results of externals that declared themselves cacheable, see
+    `call`. Entries are keyed by the content of the external executable and
+    the canonical JSON of the tree it was called with."""
+
+    store: DiskCache
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, store: DiskCache) -> None:
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # externals can be called from multiple threads
+        self._lock = threading.Lock()
+        self._digests: dict[tuple[str, int, int, int, int], str] = {}
+
+    def _exe_digest(self, exe: pathlib.Path) -> str:
+        path = os.path.realpath(exe)
+        st = os.stat(path)
+        key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            self._digests[key] = digest
+        return digest
+
+    def key(self, exe: pathlib.Path, tree: Any) -> str:
+        h = hashlib.sha256()
+        h.update(f"otk {__version__}\0".encode("utf8"))
+        h.update(self._exe_digest(exe).encode("ascii"))
+        h.update(b"\0")
+        h.update(json.dumps(tree, sort_keys=True, separators=(",", ":")).encode("utf8"))
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        """Return the cached output (`{"tree": ...}`) for `key`."""
+        data = self.store.get(key)
+        res = None
+        if data is not None:
+            try:
+                res = json.loads(data)
+            except ValueError:
+                self.store.remove(key)
+        with self._lock:
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return res
+
+    def put(self, key: str, tree: Any) -> None:
+        evicted = self.store.put(key, json.dumps({"tree": tree}).encode("utf8"))
+        with self._lock:
+            self.evictions += evicted
+
+
+class _Worker:
+    """A running external in worker mode. Requests and responses are single
+    lines of JSON on its stdin and stdout."""
+
+    def __init__(self, exe: pathlib.Path) -> None:
+        self.exe = exe
+        # stderr is only read when the worker fails, a file can't fill up
+        # and block the worker like a pipe would
+        self.stderr = tempfile.TemporaryFile()
+        env = dict(os.environ)
+        env[ENV_EXTERNAL_WORKER] = "1"
+        # pylint: disable=consider-using-with
+        self.process = subprocess.Popen(
+            [exe], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr,
+            env=env, encoding="utf8")
+
+    def request(self, data: str) -> Optional[str]:
+        """Send a request, returns `None` when the worker has exited."""
+        assert self.process.stdin is not None and self.process.stdout is not None
+        try:
+            self.process.stdin.write(data + "\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            return None
+        line = self.process.stdout.readline()
+        # a worker that exits while answering leaves an incomplete line
+        if not line.endswith("\n"):
+            return None
+        return line
+
+    def close(self) -> str:
+        """Stop the worker, returns what it wrote to stderr."""
+        assert self.process.stdin is not None
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.stderr.seek(0)
+        stderr = self.stderr.read().decode("utf8", errors="replace")
+        self.stderr.close()
+        return stderr
+
+
+class WorkerPool:
+    """Externals that support it are started once and then kept running as a
+    worker for all further calls. An external advertises support by adding
+    `"worker": true` to its output, from then on it is started with
+    `OTK_EXTERNAL_WORKER` set in its environment and has to answer every line
+    of JSON on its stdin with a line of JSON on its stdout."""
+
+    def __init__(self) -> None:
+        # workers can be used from multiple threads, each worker handles a
+        # single request at a time
+        self._lock = threading.Lock()
+        self._supported: set[pathlib.Path] = set()
+        self._idle: dict[pathlib.Path, list[_Worker]] = {}
+        self._workers: list[_Worker] = []
+
+    def advertise(self, exe: pathlib.Path) -> None:
+        with self._lock:
+            self._supported.add(exe)
+
+    def supported(self, exe: pathlib.Path) -> bool:
+        with self._lock:
+            return exe in self._supported
+
+    def request(self, state: State, directive: str, exe: pathlib.Path, data: str) -> Optional[str]:
+        """Send the request `data` to a worker for `exe`. Returns `None` when
+        `exe` does not support running as a worker."""
+        with self._lock:
+            if exe not in self._supported:
+                return None
+            idle = self._idle.setdefault(exe, [])
+            worker = idle.pop() if idle else None
+        if worker is None:
+            log.debug("starting worker for %s", exe)
+            worker = _Worker(exe)
+            with self._lock:
+                self._workers.append(worker)
+
+        out = worker.request(data)
+        if out is None:
+            with self._lock:
+                self._workers.remove(worker)
+            stderr = worker.close()
+            msg = f"call {exe} {directive!r} failed: worker exited, stderr={stderr!r}"
+            log.error(msg)
+            raise ExternalFailedError(msg, state)
+
+        with self._lock:
+            self._idle[exe].append(worker)
+        return out
+
+    def close(self) -> None:
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+            self._idle = {}
+        for worker in workers:
+            worker.close()
+
+
+def _children(value: Any) -> Iterator[Any]:
+    return iter(value.values()) if isinstance(value, dict) else iter(value)
+
+
+def _leaf(value: Any, done: dict[int, tuple[Any, str, int, int]]) -> tuple[Any, str, int, int]:
+    if isinstance(value, (dict, list)):
+        return done[id(value)]
+    token = json_scalar(value)
+    return value, token, len(token), len(token)
+
+
+def _join(value: Any, done: dict[int, tuple[Any, str, int, int]]) -> tuple[Any, str, int, int]:
+    """Join the children of `value`, that are done, see `References._leave`.
+    Returns `value` with its children replaced, its tokens, its size and the
+    size with its children replaced."""
+    items = []
+    new: Any
+    if isinstance(value, dict):
+        new = {}
+        for key, child in value.items():
+            new[key], token, size, new_size = _leaf(child, done)
+            key = json_key(key) + ": "
+            items.append((key + token, len(key) + size, len(key) + new_size))
+        changed = any(new[key] is not child for key, child in value.items())
+        tokens = "{" + ", ".join(item[0] for item in items) + "}"
+    else:
+        new = []
+        for child in value:
+            rep, token, size, new_size = _leaf(child, done)
+            new.append(rep)
+            items.append((token, size, new_size))
+        changed = any(rep is not child for rep, child in zip(new, value))
+        tokens = "[" + ", ".join(item[0] for item in items) + "]"
+    seps = 2 + 2 * max(len(items) - 1, 0)
+    size = seps + sum(item[1] for item in items)
+    new_size = seps + sum(item[2] for item in items)
+    return new if changed else value, tokens, size, new_size
+
+
+class References:
+    """Large values are passed to externals that support it by reference
+    instead of in their request. An external advertises support by adding
+    `"references": true` to its output. From then on every large list or
+    object in its requests is written once to a file named by the checksum of
+    its content and replaced by `{"otk.ref": {"path": ..., "sha256": ...}}`
+    in the request.
+
+    Values are remembered by the checksum of their content, a value that is
+    passed to many externals (e.g. a package set) is only written once. Values
+    can be changed in place by later defines, so their checksum is computed
+    again for every request, once for every value."""
+
+    min_size: int
+
+    def __init__(self, min_size: int = REFERENCE_MIN_SIZE) -> None:
+        self.min_size = min_size
+        # externals can be called from multiple threads
+        self._lock = threading.Lock()
+        self._supported: set[pathlib.Path] = set()
+        self._dir: Optional[str] = None
+        # replaced values and their size by the checksum of the value
+        self._seen: dict[str, tuple[Any, int]] = {}
+
+    def advertise(self, exe: pathlib.Path) -> None:
+        with self._lock:
+            self._supported.add(exe)
+
+    def supported(self, exe: pathlib.Path) -> bool:
+        with self._lock:
+            return exe in self._supported
+
+    def replace(self, tree: Any) -> Any:
+        """Return `tree` with its large values replaced by references. Values
+        are kept on a stack instead of being replaced recursively, trees can be
+        nested deeper than the recursion limit."""
+        if not isinstance(tree, (dict, list)):
+            return tree
+
+        # the values that are done by their id, see `_leave`
+        done: dict[int, tuple[Any, str, int, int]] = {}
+        stack: list[tuple[Any, Iterator[Any]]] = [(tree, _children(tree))]
+        entered = {id(tree)}
+        while stack:
+            value, children = stack[-1]
+            for child in children:
+                if not isinstance(child, (dict, list)) or id(child) in done:
+                    continue
+                if id(child) in entered:
+                    raise ValueError("Circular reference detected")
+                entered.add(id(child))
+                stack.append((child, _children(child)))
+                break
+            else:
+                stack.pop()
+                done[id(value)] = self._leave(value, done, root=not stack)
+        return done[id(tree)][0]
+
+    def _leave(self, value: Any, done: dict[int, tuple[Any, str, int, int]],
+               root: bool) -> tuple[Any, str, int, int]:
+        """Replace `value` (once all of its children are done) and return its
+        replacement, its token, its size and the size of its replacement.
+
+        Sizes are the length of the serialized value. Small values are not
+        replaced, their token is their serialization. Large values are
+        identified by the checksum of the tokens of their children instead of
+        serializing them at every level, that's their token."""
+        new, tokens, size, new_size = _join(value, done)
+        if size < self.min_size:
+            return value, tokens, size, size
+        if root:
+            return new, "", size, new_size
+
+        key = hashlib.sha256(tokens.encode("utf8")).hexdigest()
+        with self._lock:
+            seen = self._seen.get(key)
+        if seen is not None:
+            return seen[0], "#" + key, size, seen[1]
+
+        # large parts are passed by their own reference, they are often
+        # shared with other values
+        if new_size >= self.min_size:
+            ref = self._write(new)
+            if ref is not None:
+                new = ref
+                new_size = len(json.dumps(ref))
+        with self._lock:
+            self._seen[key] = (new, new_size)
+        return new, "#" + key, size, new_size
+
+    def _write(self, value: Any) -> Optional[dict[str, Any]]:
+        """Write `value` to the file for its reference, returns `None` when
+        that's not possible (e.g. the temporary directory is full) and the
+        value has to be passed inline."""
+        h = hashlib.sha256()
+        try:
+            with self._lock:
+                if self._dir is None:
+                    self._dir = tempfile.mkdtemp(prefix="otk-ref-")
+                directory = self._dir
+            # partially written files are removed with the directory
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            with os.fdopen(fd, "w", encoding="utf8") as fp:
+                for chunk in iter_json(value):
+                    h.update(chunk.encode("utf8"))
+                    fp.write(chunk)
+            path = os.path.join(directory, f"{h.hexdigest()}.json")
+            os.replace(tmp, path)
+        except OSError as exc:
+            log.warning("cannot pass value by reference, passing it inline: %s", exc)
+            return None
+        return {NAME_REFERENCE: {"path": path, "sha256": h.hexdigest()}}
+
+    def close(self) -> None:
+        with self._lock:
+            path = self._dir
+            self._dir = None
+            self._seen = {}
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class FileTransport:
+    """Externals that support it exchange requests and responses through
+    files instead of stdin and stdout. An external advertises support by
+    adding `"files": true` to its output. From then on it is started with
+    `OTK_EXTERNAL_INPUT` set to the path of a file containing the request,
+    and writes its response to the file at `OTK_EXTERNAL_OUTPUT`. Requests
+    are serialized straight into the file and externals can read them as
+    they like, e.g. memory mapped."""
+
+    def __init__(self) -> None:
+        # externals can be called from multiple threads
+        self._lock = threading.Lock()
+        self._supported: set[pathlib.Path] = set()
+
+    def advertise(self, exe: pathlib.Path) -> None:
+        with self._lock:
+            self._supported.add(exe)
+
+    def supported(self, exe: pathlib.Path) -> bool:
+        with self._lock:
+            return exe in self._supported
+
+    def call(self, state: State, directive: str, exe: pathlib.Path, request: Any) -> Optional[Any]:
+        """Call `exe` with `request`, returns `None` when the request can't be
+        written (e.g. the temporary directory is full) and has to be passed on
+        stdin."""
+        try:
+            tmp_dir = tempfile.TemporaryDirectory(prefix="otk-io-")  # pylint: disable=consider-using-with
+        except OSError as exc:
+            log.warning("cannot write request for %s, passing it on stdin: %s", exe, exc)
+            return None
+        with tmp_dir as tmp:
+            input_path = os.path.join(tmp, "input.json")
+            output_path = os.path.join(tmp, "output.json")
+            try:
+                with open(input_path, "w", encoding="utf8") as fp:
+                    json.dump(request, fp)
+            except OSError as exc:
+                log.warning("cannot write request for %s, passing it on stdin: %s", exe, exc)
+                return None
+            env = dict(os.environ)
+            env[ENV_EXTERNAL_INPUT] = input_path
+            env[ENV_EXTERNAL_OUTPUT] = output_path
+            process = subprocess.run([exe], stdin=subprocess.DEVNULL, encoding="utf8", capture_output=True,
+                                     env=env, check=False)
+            if process.returncode != 0:
+                msg = f"call {exe} {directive!r} failed: stdout={process.stdout!r}, stderr={process.stderr!r}"
+                log.error(msg)
+                raise ExternalFailedError(msg, state)
+            try:
+                with open(output_path, encoding="utf8") as fp:
+                    return json.load(fp)
+            except FileNotFoundError as exc:
+                msg = f"call {exe} {directive!r} failed: no output written, stdout={process.stdout!r}"
+                log.error(msg)
+                raise ExternalFailedError(msg, state) from exc
+
+
+def _bundled_module(name: str) -> Optional[ModuleType]:
+    module = BUNDLED.get(name)
+    if module is None:
+        return None
+    try:
+        return importlib.import_module(module)
+    except ImportError as exc:
+        log.debug("bundled external %s not available: %s", name, exc)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _is_bundled_program(name: str, path: pathlib.Path) -> bool:
+    """Is `path` the program installed together with otk for the bundled
+    external `name`? Search paths usually contain links to it, installations
+    also copy the installed entry point elsewhere (e.g. to
+    `/usr/libexec/otk/external`). Entry points are recognized by the module
+    they import their `main` from."""
+    program = pathlib.Path(sysconfig.get_path("scripts")) / name
+    if os.path.realpath(path) == os.path.realpath(program):
+        return True
+    try:
+        with open(path, "rb") as fp:
+            head = fp.read(BUNDLED_HEAD_SIZE)
+    except OSError:
+        return False
+    entry_point = re.compile(rb"^from " + re.escape(BUNDLED[name].encode()) + rb" import main$", re.MULTILINE)
+    return head.startswith(b"#!") and entry_point.search(head) is not None
+
+
+def lookup(name: str, inprocess: bool) -> tuple[Optional[pathlib.Path], Optional[ModuleType]]:
+    """Find the external `name`, returns the program to run or the module to
+    call in-process."""
+    module = _bundled_module(name) if inprocess else None
+    if module is None:
+        return path_for(name), None
+    try:
+        exe = path_for(name)
+    except RuntimeError:
+        return None, module
+    # anything else found in the search paths overrides the bundled external
+    if not _is_bundled_program(name, exe):
+        return exe, None
+    return None, module
+
+
+def _call_inprocess(state: State, directive: str, module: ModuleType, tree: Any) -> Any:
+    log.debug("calling %s in-process", directive)
+    try:
+        # like a program the external gets its own copy, the tree is shared
+        # with the rest of the resolve
+        return module.process(copy_tree(tree))
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        msg = f"call {exe_from_directive(directive)} {directive!r} failed: {exc!r}"
         log.error(msg)
-        raise ExternalFailedError(msg, state)
+        raise ExternalFailedError(msg, state) from exc
+
+
+def _call_program(state: State, directive: str, exe: pathlib.Path, tree: Any, *,  # pylint: disable=too-many-arguments
+                  workers: Optional[WorkerPool], references: Optional[References],
+                  files: Optional[FileTransport]) -> Any:
+    if references is not None and references.supported(exe):
+        tree = references.replace(tree)
+    request = {
+        "tree": tree,
+    }
+
+    out = res = None
+    if workers is not None and workers.supported(exe):
+        out = workers.request(state, directive, exe, json.dumps(request))
+    if out is not None:
+        res = json.loads(out)
+    elif files is not None and files.supported(exe):
+        res = files.call(state, directive, exe, request)
+    if res is None:
+        process = subprocess.run([exe], input=json.dumps(request), encoding="utf8", capture_output=True, check=False)
+        if process.returncode != 0:
+            msg = f"call {exe} {directive!r} failed: stdout={process.stdout!r}, stderr={process.stderr!r}"
+            log.error(msg)
+            raise ExternalFailedError(msg, state)
+        res = json.loads(process.stdout)
+
+    if workers is not None and res.get("worker") is True:
+        workers.advertise(exe)
+    if references is not None and res.get("references") is True:
+        references.advertise(exe)
+    if files is not None and res.get("files") is True:
+        files.advertise(exe)
+    return res
+
+
+def call(state: State, directive: str, tree: Any, cache: Optional[ExternalCache] = None,  # pylint: disable=too-many-arguments
+         workers: Optional[WorkerPool] = None, *, inprocess: bool = False,
+         references: Optional[References] = None, files: Optional[FileTransport] = None) -> Any:
+    """Call the external for `directive` with `tree`. Externals that are
+    pure functions of their input can declare so by adding `"cacheable": true`
+    to their output, their results are then reused from `cache`. Externals
+    that can run as a worker (see `WorkerPool`) are kept running in
+    `workers`. Externals that support it get large values passed by
+    reference through `references` and exchange requests and responses
+    through `files`.
+
+    With `inprocess` the externals bundled with otk (see `BUNDLED`) are
+    called directly with `tree`, without starting a program or converting
+    from and to JSON. Another program of the same name in the search paths,
+    e.g. in `OTK_EXTERNAL_PATH`, still takes precedence."""
+    exe, module = lookup(exe_from_directive(directive), inprocess)
+
+    key = None
+    if cache is not None:
+        if module is not None:
+            assert module.__file__ is not None
+            key = cache.key(pathlib.Path(module.__file__), tree)
+        else:
+            assert exe is not None
+            key = cache.key(exe, tree)
+        cached = cache.get(key)
+        if cached is not None:
+            log.debug("using cached result for %s", directive)
+            return cached["tree"]
+
+    if module is not None:
+        res = _call_inprocess(state, directive, module, tree)
+    else:
+        assert exe is not None
+        res = _call_program(state, directive, exe, tree, workers=workers, references=references, files=files)
 
-    res = json.loads(process.stdout)
+    if key is not None and cache is not None and res.get("cacheable") is True:
+        cache.put(key, res["tree"])
     return res["tree"]
 
 
@@ -40,23 +584,136 @@ def exe_from_directive(directive):
     return directive.removeprefix(PREFIX_EXTERNAL)
 
 
-def path_for(exe):
-    paths = [
-        "/usr/local/libexec/otk/external",
-        "/usr/libexec/otk/external",
-        "/usr/local/lib/otk/external",
-        "/usr/lib/otk/external",
-    ]
+# The directories searched for externals after the ones in OTK_EXTERNAL_PATH.
+SEARCH_PATHS = [
+    "/usr/local/libexec/otk/external",
+    "/usr/libexec/otk/external",
+    "/usr/local/lib/otk/external",
+    "/usr/lib/otk/external",
+]
+
+
+def search_paths() -> list[str]:
+    paths = list(SEARCH_PATHS)
 
     env = os.getenv("OTK_EXTERNAL_PATH", None)
 
     if env is not None:
         paths = env.split(":") + paths
 
-    for pathname in paths:
-        path = pathlib.Path(pathname) / exe
+    return paths
+
+
+def _read_directory(directory: pathlib.Path) -> dict[str, pathlib.Path]:
+    """Return the executables in `directory` by name. When the directory
+    contains an index file (see `write_index`) the names are taken from it
+    without looking at the directory any further."""
+    index_file = directory / EXTERNAL_INDEX_FILE
+    try:
+        with index_file.open(encoding="utf8") as fp:
+            names = json.load(fp)["externals"]
+        return {name: directory / name for name in names}
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        log.warning("ignoring broken external index %s: %s", index_file, exc)
+    return list_directory(directory)
+
+
+def list_directory(directory: pathlib.Path) -> dict[str, pathlib.Path]:
+    found = {}
+    try:
+        with os.scandir(directory) as it:
+            for dent in it:
+                if dent.is_file() and os.access(dent.path, os.X_OK):
+                    found[dent.name] = directory / dent.name
+    except OSError:
+        pass
+    return found
+
+
+def write_index(directory: pathlib.Path) -> list[str]:
+    """Write an index of the executables in `directory` to it. Lookups then
+    read the index instead of listing the directory, e.g. for read-only
+    installs or slow (network) file systems. The index has to be written
+    again when externals are added or removed. Returns the indexed names."""
+    names = sorted(list_directory(directory))
+    # replaced as a whole, running lookups notice the directory changed
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as fp:
+            json.dump({"externals": names}, fp, indent=2)
+            fp.write("\n")
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, directory / EXTERNAL_INDEX_FILE)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return names
+
+
+class ExternalIndex:
+    """The executables in a list of search paths by name, the first one of
+    a name found wins. The directories are read once. Found executables are
+    not checked again, when a name is not found the directories are read
+    again if they changed since."""
 
-        if path.exists() and os.access(path, os.X_OK):
-            return path
+    paths: list[str]
 
-    raise RuntimeError(f"could not find {exe!r} in any search path {paths!r}")
+    def __init__(self, paths: list[str]) -> None:
+        self.paths = paths
+        # lookups can come from multiple threads
+        self._lock = threading.Lock()
+        self._externals: dict[str, pathlib.Path] = {}
+        self._mtimes: list[Optional[int]] = []
+
+    def _dir_mtimes(self) -> list[Optional[int]]:
+        mtimes: list[Optional[int]] = []
+        for pathname in self.paths:
+            try:
+                mtimes.append(os.stat(pathname).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _refresh(self) -> None:
+        mtimes = self._dir_mtimes()
+        if mtimes == self._mtimes:
+            return
+        externals: dict[str, pathlib.Path] = {}
+        for pathname in self.paths:
+            for name, path in _read_directory(pathlib.Path(pathname)).items():
+                externals.setdefault(name, path)
+        self._externals = externals
+        self._mtimes = mtimes
+
+    def externals(self) -> dict[str, pathlib.Path]:
+        with self._lock:
+            if not self._mtimes:
+                self._refresh()
+            return dict(self._externals)
+
+    def lookup(self, exe: str) -> pathlib.Path:
+        with self._lock:
+            path = self._externals.get(exe)
+            if path is None:
+                self._refresh()
+                path = self._externals.get(exe)
+        if path is None:
+            raise RuntimeError(f"could not find {exe!r} in any search path {self.paths!r}")
+        return path
+
+
+@functools.lru_cache(maxsize=1)
+def _index_for(paths: tuple[str, ...]) -> ExternalIndex:
+    return ExternalIndex(list(paths))
+
+
+def external_index() -> ExternalIndex:
+    """Return the index for the current search paths, a new index is created
+    when they changed."""
+    return _index_for(tuple(search_paths()))
+
+
+def path_for(exe):
+    return external_index().lookup(exe)
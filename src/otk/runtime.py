@@ -0,0 +1,116 @@
+"""The services a resolve uses besides the defines themselves: the parse
+cache, how externals are called and the executor externals in `otk.define`
+blocks run on. A single `Runtime` is shared by all contexts of a resolve."""
+
+# Enables postponed annotations on older snakes (PEP-563)
+from __future__ import annotations
+
+import logging
+from concurrent.futures import Executor, Future
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+if TYPE_CHECKING:
+    # required to avoid circular import errors
+    from .external import ExternalCache, FileTransport, References, WorkerPool
+    from .transform import ParseCache
+
+log = logging.getLogger(__name__)
+
+
+def _overlaps(name: str, other: str) -> bool:
+    """Does defining one of the two (dotted) names affect the other?"""
+    if not name or not other or name == other:
+        return True
+    return name.startswith(other + ".") or other.startswith(name + ".")
+
+
+class Runtime:  # pylint: disable=too-many-instance-attributes
+    """Everything that is optional for a resolve, without any of it every
+    file is parsed when it is included and every external is started as a
+    program when it is used."""
+
+    parse_cache: Optional[ParseCache]
+    external_cache: Optional[ExternalCache]
+    workers: Optional[WorkerPool]
+    references: Optional[References]
+    files: Optional[FileTransport]
+    # Executor to run externals in the background on, `None` when externals
+    # are run one after another.
+    executor: Optional[Executor]
+    # Run the bundled externals in-process instead of as a program, see
+    # `otk.external.call`.
+    inprocess_externals: bool
+    # Defines waiting for an external, in the order they were deferred.
+    pending: list[tuple[str, Future, Callable[[Any], None]]]
+    # Lookups that are sent in one request once one of them is needed, by
+    # their directive, see `otk.transform.defer_external`.
+    batches: dict[str, list[Any]]
+    _settling: bool
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        parse_cache: Optional[ParseCache] = None,
+        external_cache: Optional[ExternalCache] = None,
+        workers: Optional[WorkerPool] = None,
+        references: Optional[References] = None,
+        files: Optional[FileTransport] = None,
+        executor: Optional[Executor] = None,
+        inprocess_externals: bool = False,
+    ) -> None:
+        self.parse_cache = parse_cache
+        self.external_cache = external_cache
+        self.workers = workers
+        self.references = references
+        self.files = files
+        self.executor = executor
+        self.inprocess_externals = inprocess_externals
+        self.pending = []
+        self.batches = {}
+        self._settling = False
+
+    def defer(self, name: str, future: Future, finish: Callable[[Any], None]) -> None:
+        """Register a define of `name` that waits for `future`. Once the
+        future is done `finish` is called with its result and does the actual
+        define.
+
+        Deferred defines are finished in the order they were deferred, before
+        any variable that overlaps with them is looked up or defined (see
+        `settle`). This keeps the result the same as if they were defined
+        right away."""
+        log.debug("deferring define of %r", name)
+        self.pending.append((name, future, finish))
+
+    def settle(self, name: Optional[str] = None) -> None:
+        """Finish the deferred defines that `name` depends on, or all of them
+        without a `name`."""
+        if self._settling or not self.pending:
+            return
+
+        last = -1
+        for i, (pending_name, _, _) in enumerate(self.pending):
+            if name is None or _overlaps(pending_name, name):
+                last = i
+        if last < 0:
+            return
+
+        done = self.pending[:last + 1]
+        del self.pending[:last + 1]
+        # Whatever `finish` looks up or defines must not trigger (later)
+        # deferred defines, they would not have been defined yet either.
+        self._settling = True
+        try:
+            for pending_name, future, finish in done:
+                log.debug("waiting for deferred define of %r", pending_name)
+                finish(future.result())
+        finally:
+            self._settling = False
+
+    def close(self) -> None:
+        """Stop what is still running in the background."""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.workers is not None:
+            self.workers.close()
+        if self.references is not None:
+            self.references.close()
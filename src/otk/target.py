@@ -1,15 +1,24 @@
 import json
 import logging
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, TextIO
 
 from .context import CommonContext, OSBuildContext
 from .constant import PREFIX_TARGET
 from .error import ParseError
+from .tree import iter_json
 
 log = logging.getLogger(__name__)
 
 
+def _json_format(pretty: bool) -> dict[str, Any]:
+    """Arguments for `json.dump` and `json.dumps` for pretty (indented) or
+    compact output."""
+    if pretty:
+        return {"indent": 2}
+    return {"separators": (",", ":")}
+
+
 class Target(ABC):
     @abstractmethod
     def ensure_valid(self, tree: Any) -> None: ...
@@ -17,6 +26,11 @@ class Target(ABC):
     @abstractmethod
     def as_string(self, context: Any, tree: Any, pretty: bool = True) -> str: ...
 
+    @abstractmethod
+    def write(self, fp: TextIO, context: Any, tree: Any, pretty: bool = True) -> None:
+        """Write the same output as `as_string` to `fp`, incrementally instead
+        of building the whole string first and for trees of any depth."""
+
 
 # NOTE this common target is a bit weird, we probably shouldn't always assume JSON but
 # NOTE it makes development a tad easier until we figure out all our targets
@@ -25,7 +39,10 @@ class CommonTarget(Target):
         pass
 
     def as_string(self, context: CommonContext, tree: Any, pretty: bool = True) -> str:
-        return json.dumps(tree, indent=2 if pretty else None)
+        return json.dumps(tree, **_json_format(pretty))
+
+    def write(self, fp: TextIO, context: CommonContext, tree: Any, pretty: bool = True) -> None:
+        fp.writelines(iter_json(tree, **_json_format(pretty)))
 
 
 class OSBuildTarget(Target):
@@ -36,7 +53,13 @@ class OSBuildTarget(Target):
                 "The key 'version' is added by otk internally.")
 
     def as_string(self, context: OSBuildContext, tree: Any, pretty: bool = True) -> str:
-        osbuild_tree = tree[PREFIX_TARGET + context.target_requested]
-        osbuild_tree["version"] = "2"
+        return json.dumps(self._osbuild_tree(context, tree), **_json_format(pretty))
 
-        return json.dumps(osbuild_tree, indent=2 if pretty else None)
+    def write(self, fp: TextIO, context: OSBuildContext, tree: Any, pretty: bool = True) -> None:
+        fp.writelines(iter_json(self._osbuild_tree(context, tree), **_json_format(pretty)))
+
+    def _osbuild_tree(self, context: OSBuildContext, tree: Any) -> dict[str, Any]:
+        # the resolved tree is shared, don't modify it
+        osbuild_tree = dict(tree[PREFIX_TARGET + context.target_requested])
+        osbuild_tree["version"] = "2"
+        return osbuild_tree
@@ -11,32 +11,45 @@ keys in the dictionaries."""
 # Enables postponed annotations on older snakes (PEP-563)
 from __future__ import annotations
 
+import functools
+import hashlib
+import io
 import itertools
 import logging
+import marshal
 import os.path
 import pathlib
 import re
-from typing import Any
+import sys
+from concurrent.futures import Future
+from typing import Any, BinaryIO, Callable, Generator, NamedTuple, Optional, Union
 
 import yaml
 
-from . import tree
-from .constant import NAME_VERSION, PREFIX, PREFIX_DEFINE, PREFIX_INCLUDE, PREFIX_OP, PREFIX_TARGET
+from . import __version__, tree
+from .cache import DiskCache
+from .constant import (NAME_VERSION, PREFIX, PREFIX_DEFINE, PREFIX_EXTERNAL, PREFIX_INCLUDE, PREFIX_OP,
+                       PREFIX_TARGET)
 from .context import Context, validate_var_name
 from .error import (
     IncludeNotFoundError, OTKError,
     ParseError, ParseTypeError, ParseValueError, ParseDuplicatedYamlKeyError,
     TransformDirectiveTypeError, TransformDirectiveUnknownError,
 )
-from .external import call
+from .external import BATCHED, call
+from .runtime import Runtime
 from .traversal import State
+from .tree import copy_tree
 
 log = logging.getLogger(__name__)
 
 
 # from https://gist.github.com/pypt/94d747fe5180851196eb?permalink_comment_id=4653474#gistcomment-4653474
-# pylint: disable=too-many-ancestors
-class SafeUniqueKeyLoader(yaml.SafeLoader):
+# pylint: disable=too-few-public-methods
+class UniqueKeyConstructorMixin:
+    """Reject mappings with duplicated keys. Shared between the loader
+    backends so they behave the same."""
+
     def construct_mapping(self, node, deep=False):
         mapping = set()
         for key_node, _ in node.value:
@@ -53,6 +66,95 @@ class SafeUniqueKeyLoader(yaml.SafeLoader):
         return super().construct_mapping(node, deep)
 
 
+# pylint: disable=too-many-ancestors
+class SafeUniqueKeyLoader(UniqueKeyConstructorMixin, yaml.SafeLoader):
+    pass
+
+
+# Loader backends by name, the libyaml based one is only available when
+# PyYAML was built against it.
+YAML_LOADERS: dict[str, type] = {
+    "python": SafeUniqueKeyLoader,
+}
+
+if yaml.__with_libyaml__:
+    class CSafeUniqueKeyLoader(UniqueKeyConstructorMixin, yaml.CSafeLoader):
+        pass
+
+    YAML_LOADERS["libyaml"] = CSafeUniqueKeyLoader
+
+# Prefer the much faster libyaml parser, fall back to the pure Python one.
+yaml_loader: type = YAML_LOADERS.get("libyaml", SafeUniqueKeyLoader)
+
+# Stored parses are only valid for the `otk` and marshal format that wrote them.
+PARSE_CACHE_SALT = (
+    f"otk {__version__} marshal {marshal.version} "
+    f"python {sys.version_info.major}.{sys.version_info.minor}\0"
+).encode()
+
+
+def load_yaml(path: pathlib.Path) -> Any:
+    """Parse the YAML file at `path`."""
+    with path.open(encoding="utf8") as fp:
+        return yaml.load(fp, Loader=yaml_loader)
+
+
+class ParseCache:
+    """Parsed YAML files for the duration of a single compile. Entries are
+    keyed by path and stat identity so a file changing during the run is
+    parsed again. Defined variables can end up being modified in place so
+    every load hands out a private copy of the cached tree.
+
+    When a `DiskCache` is passed parsed files are also kept across
+    invocations, keyed by the SHA-256 of their contents and the version of
+    `otk`."""
+
+    _entries: dict[tuple[str, int, int, int, int], Any]
+    _store: Optional[DiskCache]
+
+    def __init__(self, store: Optional[DiskCache] = None) -> None:
+        self._entries = {}
+        self._store = store
+
+    def load(self, path: pathlib.Path) -> Any:
+        with path.open("rb") as fp:
+            st = os.fstat(fp.fileno())
+            key = (os.fspath(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            if key not in self._entries:
+                self._entries[key] = self._parse(path, fp)
+            else:
+                log.debug("using cached parse of %s", path)
+        return copy_tree(self._entries[key])
+
+    def _parse(self, path: pathlib.Path, fp: BinaryIO) -> Any:
+        if self._store is None:
+            return yaml.load(io.TextIOWrapper(fp, encoding="utf8"), Loader=yaml_loader)
+
+        contents = fp.read()
+        digest = hashlib.sha256(PARSE_CACHE_SALT + contents).hexdigest()
+
+        cached = self._store.get(digest)
+        if cached is not None:
+            try:
+                data = marshal.loads(cached)
+                log.debug("using stored parse of %s", path)
+                return data
+            except (EOFError, ValueError, TypeError):
+                log.debug("ignoring broken stored parse of %s", path)
+                self._store.remove(digest)
+
+        # parse from a named stream so errors still point to the file
+        buf = io.BytesIO(contents)
+        buf.name = os.fspath(path)
+        data = yaml.load(io.TextIOWrapper(buf, encoding="utf8"), Loader=yaml_loader)
+        try:
+            self._store.put(digest, marshal.dumps(data))
+        except ValueError:
+            # e.g. timestamps can't be marshalled, those files are not stored
+            log.debug("cannot store parse of %s", path)
+        return data
+
+
 def resolve(ctx: Context, state: State, data: Any) -> Any:
     """Resolves a value of any supported type into a new value. Each type has
     its own specific handler to replace the data value."""
@@ -80,17 +182,24 @@ def resolve_dict(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
     - otk.define.* updates the defines dictionary with all the defined key-value
       pairs.
     - Values under any other key are processed based on their type (see resolve()).
+
+    The passed in `tree` is never modified. A dictionary without any changes
+    is returned as-is, otherwise a (shallow) copy is made on the first change.
     """
 
-    for key, val in tree.copy().items():
+    out = tree
+    for key, orig in tree.items():
         # Replace any variables in a value immediately before doing anything
         # else, so that variables defined in strings are considered in the
         # processing of all directives.
+        val = orig
         if isinstance(val, str):
             val = substitute_vars(ctx, state, val)
         if is_directive(key):
             if key.startswith(PREFIX_DEFINE):
-                del tree[key]  # remove otk.define from the output tree
+                if out is tree:
+                    out = dict(tree)
+                del out[key]  # remove otk.define from the output tree
                 process_defines(ctx, state, val)
                 continue
 
@@ -98,9 +207,6 @@ def resolve_dict(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
                 continue
 
             if key.startswith(PREFIX_TARGET):
-                # no target, "dry" run
-                if not ctx.target_requested:
-                    continue
                 # wrong target
                 if not key.startswith(PREFIX_TARGET + ctx.target_requested):
                     continue
@@ -109,25 +215,30 @@ def resolve_dict(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
                     raise ParseError(
                         f"First level below a 'target' should be a dictionary (not a {type(target).__name__})", state)
 
-                tree.update(target)
+                if target is not orig or out is not tree:
+                    if out is tree:
+                        out = dict(tree)
+                    out[key] = target
                 continue
 
             if key.startswith(PREFIX_INCLUDE):
-                del tree[key]  # replace "otk.include" with resolved included data
+                if out is tree:
+                    out = dict(tree)
+                del out[key]  # replace "otk.include" with resolved included data
 
                 included = process_include(ctx, state, pathlib.Path(val))
                 if not isinstance(included, dict):
-                    if len(tree) > 0:
+                    if len(out) > 0:
                         raise ParseValueError(
-                            f"otk.include '{val}' overrides non-empty dict {tree} with '{included}'", state)
+                            f"otk.include '{val}' overrides non-empty dict {out} with '{included}'", state)
                     return included
 
-                tree.update(included)
+                out.update(included)
                 continue
 
             # Other directives do *not* allow siblings
-            if len(tree) > 1:
-                keys = list(tree.keys())
+            if len(out) > 1:
+                keys = list(out.keys())
                 raise ParseError(f"directive {key} should not have siblings: {keys!r}", state)
 
             if key.startswith(PREFIX_OP):
@@ -135,23 +246,32 @@ def resolve_dict(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
                 return resolve(ctx, state, op(ctx, state, resolve(ctx, state, val), key))
 
             if key.startswith("otk.external."):
-                # no target, "dry" run
-                if not ctx.target_requested:
-                    continue
                 # return is fine, no siblings allowed
-                return resolve(ctx, state, call(state, key, resolve(ctx, state, val)))
+                return resolve(ctx, state, call_external(ctx.runtime, state, key, resolve(ctx, state, val)))
 
-        tree[key] = resolve(ctx, state, val)
-    return tree
+        new = resolve(ctx, state, val)
+        if new is not orig or out is not tree:
+            if out is tree:
+                out = dict(tree)
+            out[key] = new
+    return out
 
 
 def resolve_list(ctx: Context, state: State, tree: list[Any]) -> list[Any]:
     """Resolving a list means applying the resolve function to each element in
-    the list."""
+    the list. A list without any changes is returned as-is."""
 
     log.debug("resolving list %r", tree)
 
-    return [resolve(ctx, state, val) for val in tree]
+    out = None
+    for i, val in enumerate(tree):
+        new = resolve(ctx, state, val)
+        if out is None:
+            if new is val:
+                continue
+            out = tree[:i]
+        out.append(new)
+    return tree if out is None else out
 
 
 def resolve_str(ctx: Context, state: State, tree: str) -> Any:
@@ -182,8 +302,7 @@ def process_defines(ctx: Context, state: State, tree: Any) -> None:
         ctx.define(state.define_subkey(), {})
         return
 
-    # Iterate over a copy of the tree so that we can modify it in-place.
-    for key, value in tree.copy().items():
+    for key, value in tree.items():
         if key.startswith("otk.define"):
             # nested otk.define: process the nested values directly
             process_defines(ctx, state, value)
@@ -193,13 +312,15 @@ def process_defines(ctx: Context, state: State, tree: Any) -> None:
             raise ParseError(f"otk.include not allowed in an otk.define in {state.path}", state)
 
         if key.startswith("otk.op"):
-            del tree[key]
             value = op(ctx, state, value, key)
             ctx.define(state.define_subkey(), value)
             continue
 
         if key.startswith("otk.external."):
-            new_vars = resolve(ctx, state, call(state, key, resolve(ctx, state, value)))
+            value = resolve(ctx, state, value)
+            if defer_external(ctx, state, key, value, resolve):
+                continue
+            new_vars = resolve(ctx, state, call_external(ctx.runtime, state, key, value))
             ctx.merge_defines(state.define_subkey(), new_vars)
             continue
 
@@ -215,27 +336,213 @@ def process_defines(ctx: Context, state: State, tree: Any) -> None:
             ctx.define(state.define_subkey(key), value)
 
 
-def process_include(ctx: Context, state: State, path: pathlib.Path) -> dict:
+def load_include(ctx: Context, state: State, path: pathlib.Path) -> tuple[pathlib.Path, Any]:
     """
-    Load a yaml file and send it to resolve() for processing.
+    Load the yaml file an otk.include refers to. Returns the absolute path of
+    the file and its (unresolved) data.
     """
+    path = _include_path(state, path)
+    log.info("resolving %s", path)
+    return _load_include(ctx, state, path)
+
+
+def _include_path(state: State, path: pathlib.Path) -> pathlib.Path:
     # resolve 'path' relative to 'state.path'
     if not path.is_absolute():
         cur_path = state.path.parent
         path = (cur_path / pathlib.Path(path)).resolve()
-    log.info("resolving %s", path)
+    return path
+
+
+def _load_include(ctx: Context, state: State, path: pathlib.Path) -> tuple[pathlib.Path, Any]:
     try:
-        with path.open(encoding="utf8") as fp:
-            data = yaml.load(fp, Loader=SafeUniqueKeyLoader)
+        parse_cache = ctx.runtime.parse_cache
+        if parse_cache is not None:
+            data = parse_cache.load(path)
+        else:
+            data = load_yaml(path)
     except FileNotFoundError as fnfe:
         cleaned_path = os.fspath(path).removeprefix(
             os.path.commonprefix([path, state.path]))
         raise IncludeNotFoundError(f"file {cleaned_path} was not found", state) from fnfe
     except ParseDuplicatedYamlKeyError as err:
         raise ParseDuplicatedYamlKeyError(f"{err}", state.copy(path=path)) from err
+    return path, data
+
 
+def find_targets(ctx: Context, state: State, path: pathlib.Path,
+                 _including: tuple[pathlib.Path, ...] = ()) -> list[str]:
+    """Return the names of the targets in the omnifest at `path` without
+    resolving it. Top-level includes are followed unless their path uses
+    variables, targets in those are only found by resolving."""
+    path = _include_path(state, path)
+    if path in _including:
+        return []
+    try:
+        path, data = _load_include(ctx, state, path)
+    except OTKError:
+        # reported when resolving
+        return []
+    if not isinstance(data, dict):
+        return []
+
+    names = []
+    for key, val in data.items():
+        if key.startswith(PREFIX_TARGET):
+            names.append(key.removeprefix(PREFIX_TARGET))
+        elif key.startswith(PREFIX_INCLUDE) and isinstance(val, str) and "${" not in val:
+            names.extend(find_targets(ctx, state.copy(path=path), pathlib.Path(val), _including + (path,)))
+    return list(dict.fromkeys(names))
+
+
+def call_external(runtime: Runtime, state: State, directive: str, tree: Any) -> Any:
+    """Call the external for `directive` with the external cache, workers,
+    references and file transport of the runtime."""
+    return call(state, directive, tree, runtime.external_cache, runtime.workers,
+                inprocess=runtime.inprocess_externals, references=runtime.references,
+                files=runtime.files)
+
+
+def defer_external(ctx: Context, state: State, directive: str, tree: Any,
+                   resolver: Callable[[Context, State, Any], Any]) -> bool:
+    """
+    Call the external for an `otk.external` in an otk.define on the executor
+    of the runtime. The define is deferred, the result is resolved with
+    `resolver` and merged into the defines once a variable that depends on it
+    is used. Returns `False` when there is no executor, the external then
+    needs to be called right away.
+
+    Lookups of externals that can do several at once (see `BATCHED`) are
+    always deferred. They are grouped with the other lookups in requests that
+    are otherwise the same and sent once the first of them is needed.
+    """
+    runtime = ctx.runtime
+    executor = runtime.executor
+    batched = _batched(directive, tree)
+    if executor is None and not batched:
+        return False
+    name = state.define_subkey()
+
+    def finish(result: Any) -> None:
+        ctx.merge_defines(name, resolver(ctx, state, result))
+
+    # Defines that follow can change values in place that are part of
+    # `tree`, the external gets them as they are now, like without executor.
+    tree = copy_tree(tree)
+    if name:
+        # keep the place the define has without executor
+        ctx.reserve(name)
+    if batched:
+        future = _Batch.add(runtime, state, directive, tree)
+    else:
+        assert executor is not None
+        future = executor.submit(call_external, runtime, state, directive, tree)
+    runtime.defer(name, future, finish)
+    return True
+
+
+def _batched(directive: str, tree: Any) -> bool:
+    """Can the lookup in `tree` be sent with others? See `BATCHED`."""
+    keys = BATCHED.get(directive[len(PREFIX_EXTERNAL):])
+    if keys is None or not isinstance(tree, dict):
+        return False
+    single, batch = keys
+    if single in tree:
+        return batch not in tree
+    return isinstance(tree.get(batch), (list, dict))
+
+
+class _Lookup(Future):
+    """A lookup in a `_Batch`, the batch is sent when its result is needed."""
+
+    def __init__(self, batch: _Batch) -> None:
+        super().__init__()
+        self._batch = batch
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        self._batch.send()
+        return super().result(timeout)
+
+
+class _Batch:
+    """Lookups of an external that are sent in one request, see
+    `defer_external`."""
+
+    def __init__(self, runtime: Runtime, state: State, directive: str, request: dict) -> None:
+        self.runtime = runtime
+        self.state = state
+        self.directive = directive
+        # the request without what is looked up
+        self.request = request
+        self.lookups: list[tuple[_Lookup, str, Any]] = []
+        self.sent = False
+
+    @classmethod
+    def add(cls, runtime: Runtime, state: State, directive: str, tree: dict) -> Future:
+        """Add the lookup in `tree` to a batch of `runtime`, returns the
+        future of its result."""
+        single, batch = BATCHED[directive[len(PREFIX_EXTERNAL):]]
+        key = single if single in tree else batch
+        request = {k: v for k, v in tree.items() if k != key}
+
+        batches = runtime.batches.setdefault(directive, [])
+        for this in batches:
+            if this.request == request:
+                break
+        else:
+            this = cls(runtime, state, directive, request)
+            batches.append(this)
+        lookup = _Lookup(this)
+        this.lookups.append((lookup, key, tree[key]))
+        return lookup
+
+    def send(self) -> None:
+        """Send the lookups once and set the results of their futures."""
+        if self.sent:
+            return
+        self.sent = True
+        self.runtime.batches[self.directive].remove(self)
+
+        single, batch = BATCHED[self.directive[len(PREFIX_EXTERNAL):]]
+        try:
+            if len(self.lookups) == 1:
+                # alone a lookup is sent as it is
+                _, key, value = self.lookups[0]
+                results = [call_external(self.runtime, self.state, self.directive, dict(self.request, **{key: value}))]
+            else:
+                names = {}
+                for i, (_, key, value) in enumerate(self.lookups):
+                    if key == single:
+                        names[str(i)] = value
+                    else:
+                        names.update((f"{i}.{k}", v) for k, v in _lookup_names(value).items())
+                result = call_external(self.runtime, self.state, self.directive, dict(self.request, **{batch: names}))
+                results = [
+                    result[str(i)] if key == single else {k: result[f"{i}.{k}"] for k in _lookup_names(value)}
+                    for i, (_, key, value) in enumerate(self.lookups)
+                ]
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            for lookup, _, _ in self.lookups:
+                lookup.set_exception(exc)
+            return
+        for (lookup, _, _), res in zip(self.lookups, results):
+            lookup.set_result(res)
+
+
+def _lookup_names(value: Any) -> dict:
+    """The values to look up by the key of their result, see `BATCHED`."""
+    return value if isinstance(value, dict) else {name: name for name in value}
+
+
+def process_include(ctx: Context, state: State, path: pathlib.Path,
+                    resolver: Callable[[Context, State, Any], Any] = resolve) -> dict:
+    """
+    Load a yaml file and send it to resolve() (or the given `resolver`) for
+    processing.
+    """
+    path, data = load_include(ctx, state, path)
     if data is not None:
-        return resolve(ctx, state.copy(path=path), data)
+        return resolver(ctx, state.copy(path=path), data)
     return {}
 
 
@@ -257,9 +564,7 @@ def op_join(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
         raise TransformDirectiveTypeError(
             f"seq join received values of the wrong type, was expecting a list of lists but got {values!r}", state)
 
-    for i, val in enumerate(values):
-        if isinstance(val, str):
-            values[i] = substitute_vars(ctx, state, val)
+    values = [substitute_vars(ctx, state, val) if isinstance(val, str) else val for val in values]
 
     if all(isinstance(sl, list) for sl in values):
         return list(itertools.chain.from_iterable(values))
@@ -273,6 +578,267 @@ def op_join(ctx: Context, state: State, tree: dict[str, Any]) -> Any:
     raise TransformDirectiveTypeError(f"cannot join {values}", state)
 
 
+# The iterative resolver below implements the same rules as `resolve` and
+# friends above. Instead of recursing, every dictionary, list and define block
+# becomes a generator of "steps". A step that needs a value resolved yields a
+# new generator for that value and receives the resolved value back. The
+# generators are kept on an explicit stack so the depth of a tree is not
+# limited by the Python recursion limit.
+#
+# Both implementations need to be kept in sync until the iterative one has
+# replaced the recursive one.
+Steps = Generator[Any, Any, Any]
+
+
+def resolve_iterative(ctx: Context, state: State, data: Any) -> Any:
+    """Resolves a value of any supported type into a new value, without
+    recursion. See `resolve`."""
+
+    stack = [_resolve_steps(ctx, state, data)]
+    value = None
+    while stack:
+        try:
+            step = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            value = stop.value
+            continue
+        stack.append(step)
+        value = None
+    return value
+
+
+def _resolve_steps(ctx: Context, state: State, data: Any) -> Steps:
+    if isinstance(data, dict):
+        return _resolve_dict_steps(ctx, state, data)
+    if isinstance(data, list):
+        return _resolve_list_steps(ctx, state, data)
+    return _resolve_value_steps(ctx, state, data)
+
+
+def _resolve_value_steps(ctx: Context, state: State, data: Any) -> Steps:
+    return resolve(ctx, state, data)
+    yield  # pylint: disable=unreachable
+
+
+# pylint: disable=too-many-branches,too-many-statements
+def _resolve_dict_steps(ctx: Context, state: State, tree: dict[str, Any]) -> Steps:
+    """See `resolve_dict`."""
+
+    out = tree
+    for key, orig in tree.items():
+        val = orig
+        if isinstance(val, str):
+            val = substitute_vars(ctx, state, val)
+        if isinstance(key, str) and key.startswith(PREFIX):
+            if key.startswith(PREFIX_DEFINE):
+                if out is tree:
+                    out = dict(tree)
+                del out[key]
+                yield _define_steps(ctx, state, val)
+                continue
+
+            if key == NAME_VERSION:
+                continue
+
+            if key.startswith(PREFIX_TARGET):
+                if not key.startswith(PREFIX_TARGET + ctx.target_requested):
+                    continue
+                target = yield _resolve_steps(ctx, state, val)
+                if not isinstance(target, dict):
+                    raise ParseError(
+                        f"First level below a 'target' should be a dictionary (not a {type(target).__name__})", state)
+
+                if target is not orig or out is not tree:
+                    if out is tree:
+                        out = dict(tree)
+                    out[key] = target
+                continue
+
+            if key.startswith(PREFIX_INCLUDE):
+                if out is tree:
+                    out = dict(tree)
+                del out[key]
+
+                path, data = load_include(ctx, state, pathlib.Path(val))
+                included = {}
+                if data is not None:
+                    included = yield _resolve_steps(ctx, state.copy(path=path), data)
+                if not isinstance(included, dict):
+                    if len(out) > 0:
+                        raise ParseValueError(
+                            f"otk.include '{val}' overrides non-empty dict {out} with '{included}'", state)
+                    return included
+
+                out.update(included)
+                continue
+
+            if len(out) > 1:
+                keys = list(out.keys())
+                raise ParseError(f"directive {key} should not have siblings: {keys!r}", state)
+
+            if key.startswith(PREFIX_OP):
+                val = yield _resolve_steps(ctx, state, val)
+                return (yield _resolve_steps(ctx, state, op(ctx, state, val, key)))
+
+            if key.startswith("otk.external."):
+                val = yield _resolve_steps(ctx, state, val)
+                return (yield _resolve_steps(ctx, state, call_external(ctx.runtime, state, key, val)))
+
+        # plain values are resolved in place, only containers need a step
+        if isinstance(val, str):
+            new = substitute_vars(ctx, state, val)
+        elif isinstance(val, dict):
+            new = yield _resolve_dict_steps(ctx, state, val)
+        elif isinstance(val, list):
+            new = yield _resolve_list_steps(ctx, state, val)
+        else:
+            new = resolve(ctx, state, val)
+        if new is not orig or out is not tree:
+            if out is tree:
+                out = dict(tree)
+            out[key] = new
+    return out
+
+
+def _resolve_list_steps(ctx: Context, state: State, tree: list[Any]) -> Steps:
+    """See `resolve_list`."""
+
+    log.debug("resolving list %r", tree)
+
+    out = None
+    for i, val in enumerate(tree):
+        if isinstance(val, str):
+            new = substitute_vars(ctx, state, val)
+        elif isinstance(val, dict):
+            new = yield _resolve_dict_steps(ctx, state, val)
+        elif isinstance(val, list):
+            new = yield _resolve_list_steps(ctx, state, val)
+        else:
+            new = resolve(ctx, state, val)
+        if out is None:
+            if new is val:
+                continue
+            out = tree[:i]
+        out.append(new)
+    return tree if out is None else out
+
+
+def _define_steps(ctx: Context, state: State, tree: Any) -> Steps:
+    """See `process_defines`. Nested define blocks are kept on a stack of
+    their own."""
+
+    stack: list[tuple[State, Any]] = []
+    block: Optional[tuple[State, Any]] = (state, tree)
+    while True:
+        if block is not None:
+            state, tree = block
+            block = None
+            if tree is None:
+                log.warning("empty otk.define in %s", state.path)
+            elif tree == {}:
+                ctx.define(state.define_subkey(), {})
+            else:
+                stack.append((state, iter(tree.items())))
+        if not stack:
+            return None
+
+        state, items = stack[-1]
+        for key, value in items:
+            if key.startswith("otk.define"):
+                block = (state, value)
+                break
+
+            if key.startswith("otk.include"):
+                raise ParseError(f"otk.include not allowed in an otk.define in {state.path}", state)
+
+            if key.startswith("otk.op"):
+                value = op(ctx, state, value, key)
+                ctx.define(state.define_subkey(), value)
+                continue
+
+            if key.startswith("otk.external."):
+                value = yield _resolve_steps(ctx, state, value)
+                if defer_external(ctx, state, key, value, resolve_iterative):
+                    continue
+                new_vars = yield _resolve_steps(ctx, state, call_external(ctx.runtime, state, key, value))
+                ctx.merge_defines(state.define_subkey(), new_vars)
+                continue
+
+            if isinstance(value, dict):
+                block = (state.copy(subkey_add=key), value)
+                break
+
+            if isinstance(value, str):
+                ctx.define(state.define_subkey(key), substitute_vars(ctx, state, value))
+            else:
+                ctx.define(state.define_subkey(key), value)
+        else:
+            stack.pop()
+
+
+# Resolver implementations by name.
+RESOLVERS: dict[str, Callable[[Context, State, Any], Any]] = {
+    "recursive": resolve,
+    "iterative": resolve_iterative,
+}
+
+
+# A variable reference in a string, e.g. `${name}`.
+VAR_RE = re.compile(r"\$\{(?P<name>[^}]+)\}")
+
+
+class VarRef(NamedTuple):
+    """A variable reference in a string template. Names are validated when
+    the template is built, `invalid` holds the error for an invalid name."""
+    name: str
+    invalid: Optional[str]
+
+
+def var_ref(name: str) -> VarRef:
+    try:
+        validate_var_name(name)
+    except ParseError as exc:
+        return VarRef(name, str(exc))
+    return VarRef(name, None)
+
+
+class Template(NamedTuple):
+    """A string split into its literal text and variable references. When
+    the whole string is a single reference it is kept in `single`."""
+    single: Optional[VarRef]
+    parts: tuple[Union[str, VarRef], ...]
+
+
+@functools.lru_cache(maxsize=65536)
+def compile_template(data: str) -> Template:
+    """Tokenize `data` into a `Template`. Templates are cached by string
+    value as the same strings tend to occur over and over again in
+    omnifests."""
+    if m := VAR_RE.fullmatch(data):
+        return Template(var_ref(m.group("name")), ())
+
+    parts: list[Union[str, VarRef]] = []
+    pos = 0
+    for m in VAR_RE.finditer(data):
+        if m.start() > pos:
+            parts.append(data[pos:m.start()])
+        parts.append(var_ref(m.group("name")))
+        pos = m.end()
+    if pos < len(data):
+        parts.append(data[pos:])
+    return Template(None, tuple(parts))
+
+
+def _partially_substituted(parts: tuple[Union[str, VarRef], ...], values: dict[str, str]) -> str:
+    """Render `parts` with only the variables in `values` substituted, this
+    is what the string looks like at the moment substitution fails."""
+    return "".join(
+        part if isinstance(part, str) else values.get(part.name, f"${{{part.name}}}")
+        for part in parts
+    )
+
+
 @tree.must_be(str)
 def substitute_vars(ctx: Context, state: State, data: str) -> Any:
     """Substitute variables in the `data` string.
@@ -287,36 +853,44 @@ def substitute_vars(ctx: Context, state: State, data: str) -> Any:
     value in the names variables must be primitive types, either str, int, or
     float."""
 
-    bracket = r"\$\{%s\}"
-    pattern = bracket % r"(?P<name>[^}]+)"
+    if "${" not in data:
+        return data
+
+    tmpl = compile_template(data)
+
     # If there is a single match and its span is the entire haystack then we
     # return its value directly.
-    if m := re.fullmatch(pattern, data):
-        validate_var_name(m.group("name"))
+    if tmpl.single is not None:
+        if tmpl.single.invalid is not None:
+            raise ParseError(tmpl.single.invalid)
         try:
-            var = ctx.variable(m.group("name"))
+            var = ctx.variable(tmpl.single.name)
         except OTKError as exc:
             raise exc.__class__(str(exc), state)
         return var
 
-    if matches := re.finditer(pattern, data):
-        for m in matches:
-            name = m.group("name")
-            validate_var_name(m.group("name"))
-
-            value = ctx.variable(name)
-            # We know how to turn ints and floats into str's
-            if isinstance(value, (int, float)):
-                value = str(value)
-
-            # Any other type we do not
-            if not isinstance(value, str):
-                raise TransformDirectiveTypeError(
-                    f"string {data!r} resolves to an incorrect type, "
-                    f"expected int, float, or str but got {type(value).__name__}", state)
-
-            # Replace all occurences of this name in the str
-            data = re.sub(bracket % re.escape(name), value, data)
-            log.debug("substituting %r as substring to %r", name, data)
+    if len(tmpl.parts) == 1 and isinstance(tmpl.parts[0], str):
+        return data
 
+    values: dict[str, str] = {}
+    for part in tmpl.parts:
+        if isinstance(part, str) or part.name in values:
+            continue
+        if part.invalid is not None:
+            raise ParseError(part.invalid)
+
+        value = ctx.variable(part.name)
+        # We know how to turn ints and floats into str's
+        if isinstance(value, (int, float)):
+            value = str(value)
+
+        # Any other type we do not
+        if not isinstance(value, str):
+            raise TransformDirectiveTypeError(
+                f"string {_partially_substituted(tmpl.parts, values)!r} resolves to an incorrect type, "
+                f"expected int, float, or str but got {type(value).__name__}", state)
+        values[part.name] = value
+
+    data = "".join(part if isinstance(part, str) else values[part.name] for part in tmpl.parts)
+    log.debug("substituted variables to %r", data)
     return data
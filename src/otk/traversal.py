@@ -1,5 +1,3 @@
-import copy
-import inspect
 import os
 import pathlib
 from typing import Any, Optional
@@ -8,32 +6,53 @@ from .error import CircularIncludeError
 
 
 class State:
+    """The traversal state, which file is being resolved, through which
+    chain of includes it was reached and in which (nested) define block.
+
+    A `State` is immutable, use `State.copy()` to derive a new one. As
+    nothing is ever modified the new state shares everything it does not
+    change with the state it was derived from."""
+
+    __slots__ = ("path", "_define_subkeys", "_includes")
+
+    path: pathlib.Path
+    _define_subkeys: tuple[str, ...]
+    _includes: tuple[pathlib.Path, ...]
 
     def __init__(self, path: Optional[pathlib.Path] = None) -> None:
         if path is None:
             path = pathlib.Path()
-        self.path = path
-        self._define_subkeys: list[str] = []
-        self._includes = []
+        includes: tuple[pathlib.Path, ...] = ()
         if path != pathlib.Path():
-            self._includes.append(path)
+            includes = (path,)
+        self._init(path, (), includes)
+
+    def _init(self, path: pathlib.Path, define_subkeys: tuple[str, ...], includes: tuple[pathlib.Path, ...]) -> None:
+        object.__setattr__(self, "path", path)
+        object.__setattr__(self, "_define_subkeys", define_subkeys)
+        object.__setattr__(self, "_includes", includes)
 
     def copy(self, *, path: Optional[pathlib.Path] = None, subkey_add: Optional[str] = None) -> "State":
         """
         Return a new State, optionally redefining the path and add a define
-        subkey. Properties not defined in the args are (shallow) copied
-        from the existing instance.
+        subkey. Properties not defined in the args are shared with the
+        existing instance.
         """
-        new_state = copy.deepcopy(self)
+        new_path = self.path
+        define_subkeys = self._define_subkeys
+        includes = self._includes
         if subkey_add:
-            new_state._define_subkeys.append(subkey_add)
+            define_subkeys = define_subkeys + (subkey_add,)
         if path:
-            if path in self._includes:
-                circle = [os.fspath(p) for p in new_state._includes]
+            if path in includes:
+                circle = [os.fspath(p) for p in includes]
                 circle.append(os.fspath(path))
                 raise CircularIncludeError(f"circular include from {'->'.join(circle)}")
-            new_state.path = path
-            new_state._includes.append(path)
+            new_path = path
+            includes = includes + (path,)
+
+        new_state = State.__new__(State)
+        new_state._init(new_path, define_subkeys, includes)
         return new_state
 
     def define_subkey(self, key: Optional[str] = None) -> str:
@@ -42,13 +61,9 @@ class State:
         """
         if key is None:
             return ".".join(self._define_subkeys)
-        return ".".join(self._define_subkeys + [key])
+        return ".".join(self._define_subkeys + (key,))
 
     def __setattr__(self, name: str, val: Any) -> None:
-        caller = inspect.stack()[1][3]
-        # ideally we would check that the caller is State.copy() here
-        if hasattr(self, name) and caller != "copy":
-            class_name = self.__class__.__name__
-            raise ValueError(
-                f"cannot set '{name}': {class_name} cannot be changed after creation, use {class_name}.copy() instead")
-        super().__setattr__(name, val)
+        class_name = self.__class__.__name__
+        raise ValueError(
+            f"cannot set '{name}': {class_name} cannot be changed after creation, use {class_name}.copy() instead")
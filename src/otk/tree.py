@@ -1,12 +1,14 @@
 """`otk` is primarily a tree transformation tool. This module contains the
-objects used validate tree arguments for functions that deal with trees."""
+objects used validate tree arguments for functions that deal with trees and
+helpers to work with trees."""
 
 # Enables postponed annotations on older snakes (PEP-563)
 from __future__ import annotations
 
 
 import functools
-from typing import Callable, Type
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Iterator, Optional, Type, Union
 
 from .error import TransformDirectiveArgumentError, TransformDirectiveTypeError
 
@@ -51,3 +53,142 @@ def has_keys(keys):
                 raise TransformDirectiveArgumentError(f"Expected key {key!r}")
 
     return inner
+
+
+def copy_tree(data: Any, memo: Optional[dict[int, Any]] = None) -> Any:
+    """Copy the containers of a tree. Scalars are immutable and shared,
+    aliased containers stay aliased in the copy. This is a lot cheaper than
+    `copy.deepcopy` for the kind of trees YAML and JSON produce.
+
+    Containers are copied from a stack instead of recursively, trees can be
+    nested deeper than the recursion limit."""
+    if not isinstance(data, (dict, list)):
+        return data
+    if memo is None:
+        memo = {}
+
+    stack: list[tuple[Any, Any]] = []
+
+    def copy(val: Any) -> Any:
+        if not isinstance(val, (dict, list)):
+            return val
+        if id(val) in memo:
+            return memo[id(val)]
+        new: Any = {} if isinstance(val, dict) else []
+        memo[id(val)] = new
+        stack.append((val, new))
+        return new
+
+    new_data = copy(data)
+    while stack:
+        old, new = stack.pop()
+        if isinstance(old, dict):
+            for key, val in old.items():
+                new[key] = copy(val)
+        else:
+            new.extend(copy(val) for val in old)
+    return new_data
+
+
+def json_scalar(val: Any) -> str:  # pylint: disable=too-many-return-statements
+    """Serialize a value that is not a container to JSON."""
+    if isinstance(val, str):
+        return encode_basestring_ascii(val)
+    if val is None:
+        return "null"
+    if val is True:
+        return "true"
+    if val is False:
+        return "false"
+    if isinstance(val, int):
+        return int.__repr__(val)
+    if isinstance(val, float):
+        if val != val:  # pylint: disable=comparison-with-itself
+            return "NaN"
+        if val in (float("inf"), float("-inf")):
+            return "Infinity" if val > 0 else "-Infinity"
+        return float.__repr__(val)
+    raise TypeError(f"Object of type {val.__class__.__name__} is not JSON serializable")
+
+
+def json_key(key: Any) -> str:
+    """Serialize the key of an object to JSON."""
+    if isinstance(key, str):
+        return encode_basestring_ascii(key)
+    if key is None or isinstance(key, (bool, int, float)):
+        return '"' + json_scalar(key) + '"'
+    raise TypeError(f"keys must be str, int, float, bool or None, not {key.__class__.__name__}")
+
+
+_END = object()
+
+
+def iter_json(  # pylint: disable=too-many-branches,too-many-statements
+        data: Any,
+        indent: Union[int, str, None] = None,
+        separators: Optional[tuple[str, str]] = None,
+) -> Iterator[str]:
+    """Serialize `data` to JSON in chunks, the same as `json.dump` with the
+    same arguments does. Containers are kept on a stack instead of being
+    serialized recursively, trees can be nested deeper than the recursion
+    limit."""
+    if separators is not None:
+        item_sep, key_sep = separators
+    elif indent is not None:
+        item_sep, key_sep = ",", ": "
+    else:
+        item_sep, key_sep = ", ", ": "
+    if indent is not None and not isinstance(indent, str):
+        indent = " " * indent
+
+    # containers that are being serialized, by their id
+    markers: dict[int, Any] = {}
+    stack: list[tuple[Any, Iterator[Any], bool]] = []
+    value = data
+    while True:
+        if isinstance(value, (dict, list)) and value:
+            if id(value) in markers:
+                raise ValueError("Circular reference detected")
+            markers[id(value)] = value
+            if isinstance(value, dict):
+                yield "{"
+                stack.append((value, iter(value.items()), True))
+            else:
+                yield "["
+                stack.append((value, iter(value), False))
+            first = True
+        else:
+            if isinstance(value, dict):
+                yield "{}"
+            elif isinstance(value, list):
+                yield "[]"
+            else:
+                yield json_scalar(value)
+            first = False
+
+        # the next value, closing the containers that are done
+        while stack:
+            container, items, is_dict = stack[-1]
+            item: Any = next(items, _END)
+            if item is _END:
+                stack.pop()
+                del markers[id(container)]
+                if indent is not None:
+                    yield "\n" + indent * len(stack)
+                yield "}" if is_dict else "]"
+                first = False
+                continue
+
+            sep = "" if first else item_sep
+            if indent is not None:
+                sep += "\n" + indent * len(stack)
+            if is_dict:
+                key, value = item
+                yield sep + json_key(key) + key_sep
+            else:
+                value = item
+                if sep:
+                    yield sep
+            break
+        else:
+            return
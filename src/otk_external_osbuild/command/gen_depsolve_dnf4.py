@@ -1,11 +1,35 @@
+import contextlib
+import fcntl
+import functools
 import hashlib
 import json
 import os
+import pathlib
+import re
+import shutil
+import ssl
 import subprocess
 import sys
-from typing import TextIO
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, Optional, TextIO
 from urllib.parse import urlsplit, urlunsplit
 
+from otk.cache import cache_home
+from otk_external_osbuild.protocol import no_cache, respond
+
+# Directory to keep the repository metadata in, defaults to a directory in
+# the otk cache.
+ENV_CACHE_DIR = "OTK_DEPSOLVE_CACHE_DIR"
+# Directory to keep the results of depsolves in, defaults to a directory in
+# the otk cache. It can be seeded with results from elsewhere.
+ENV_RESULT_DIR = "OTK_DEPSOLVE_RESULT_DIR"
+# Metadata of repositories and results that were not used for this long are
+# removed.
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
 
 def transform(packages):
     """Transform the output of `osbuild-depsolve-dnf4` to the output format
@@ -59,33 +83,319 @@ def mockdata(packages, repos, architecture):
     ]
 
 
-def root(input_stream: TextIO) -> None:
-    data = json.loads(input_stream.read())
-    tree = data["tree"]
+def cache_dir() -> pathlib.Path:
+    base = os.getenv(ENV_CACHE_DIR)
+    if base:
+        return pathlib.Path(base)
+    return cache_home() / "depsolve"
+
+
+def _lock(entry: pathlib.Path, operation: int, create: bool = True) -> int:
+    """Lock the cache `entry`, returns the locked file descriptor or -1 when
+    the entry was removed while waiting for the lock."""
+    lock = entry / ".lock"
+    flags = os.O_RDWR | os.O_CLOEXEC
+    if create:
+        flags |= os.O_CREAT
+    fd = os.open(lock, flags, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        if os.stat(lock).st_ino == os.fstat(fd).st_ino:
+            return fd
+    except FileNotFoundError:
+        pass
+    except BaseException:
+        os.close(fd)
+        raise
+    os.close(fd)
+    return -1
+
+
+def evict(base: pathlib.Path) -> None:
+    """Remove the cache entries in `base` that were not used for longer than
+    `CACHE_MAX_AGE`. Entries that are in use are skipped."""
+    deadline = time.time() - CACHE_MAX_AGE
+    try:
+        entries = [pathlib.Path(dent.path) for dent in os.scandir(base) if dent.is_dir(follow_symlinks=False)]
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime >= deadline:
+                continue
+            # using an entry updates its modification time, creating the
+            # lock here would too
+            fd = _lock(entry, fcntl.LOCK_EX | fcntl.LOCK_NB, create=False)
+        except FileNotFoundError:
+            # never locked, not in use
+            shutil.rmtree(entry, ignore_errors=True)
+            continue
+        except OSError:
+            # in use
+            continue
+        if fd < 0:
+            continue
+        try:
+            if entry.stat().st_mtime < deadline:
+                shutil.rmtree(entry, ignore_errors=True)
+        finally:
+            os.close(fd)
+
+
+@contextlib.contextmanager
+def cache_entry(tree: dict, exclusive: bool = True) -> Iterator[pathlib.Path]:
+    """Lock and return the cache directory for the repositories in `tree`.
+    Depsolves that might update the metadata need an `exclusive` lock, the
+    lock is shared otherwise. Without caches (see `no_cache`) every depsolve
+    gets a temporary directory instead."""
+    if no_cache():
+        with tempfile.TemporaryDirectory(prefix="otk-depsolve-") as tmp:
+            yield pathlib.Path(tmp)
+        return
+
+    repos = {k: tree[k] for k in ("architecture", "module_platform_id", "releasever", "repositories")}
+    key = hashlib.sha256(json.dumps(repos, sort_keys=True).encode()).hexdigest()
+    base = cache_dir()
+    evict(base)
+
+    entry = base / key
+    fd = -1
+    while fd < 0:
+        entry.mkdir(parents=True, exist_ok=True)
+        fd = _lock(entry, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        # mark as recently used
+        os.utime(entry)
+        yield entry
+    finally:
+        os.close(fd)
+
+
+def mock_metadata(entry: pathlib.Path, tree: dict) -> list:
+    """Stand-in for the repository metadata in a cache `entry`, as used by
+    tests. The repositories are stored on the first use and read back on
+    later uses."""
+    metadata = entry / "mock-metadata.json"
+    try:
+        return json.loads(metadata.read_text(encoding="utf8"))
+    except FileNotFoundError:
+        pass
+    metadata.write_text(json.dumps(tree["repositories"]), encoding="utf8")
+    return tree["repositories"]
+
+
+def result_dir() -> pathlib.Path:
+    base = os.getenv(ENV_RESULT_DIR)
+    if base:
+        return pathlib.Path(base)
+    return cache_home() / "depsolve-results"
+
+
+@functools.lru_cache(maxsize=None)
+def _fetch_revision(baseurl: str, sslverify: bool, sslcacert: Optional[str], sslclientcert: Optional[str],
+                    sslclientkey: Optional[str]) -> Optional[str]:
+    try:
+        context = ssl.create_default_context(cafile=sslcacert)
+        if not sslverify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if sslclientcert:
+            context.load_cert_chain(sslclientcert, sslclientkey)
+        # proxies are taken from the environment, like the depsolver does
+        with urllib.request.urlopen(baseurl.rstrip("/") + "/repodata/repomd.xml", timeout=30,
+                                    context=context) as fp:
+            return hashlib.sha256(fp.read()).hexdigest()
+    except (OSError, ValueError):
+        return None
+
+
+def repo_revision(repo: dict) -> Optional[str]:
+    """Return the revision of the metadata of `repo`, the checksum of its
+    `repomd.xml`. Returns `None` when it can't be determined. Revisions are
+    only fetched once, with the TLS options of the repository."""
+    baseurl = repo.get("baseurl")
+    if isinstance(baseurl, list):
+        baseurl = baseurl[0] if len(baseurl) == 1 else None
+    if not baseurl:
+        # a mirrorlist or metalink can point to different revisions
+        return None
     if "OTK_UNDER_TEST" in os.environ:
-        packages = mockdata(tree["packages"], tree["repositories"], tree["architecture"])
-        sys.stdout.write(json.dumps(transform(packages)))
+        return hashlib.sha256(baseurl.encode()).hexdigest()
+    return _fetch_revision(baseurl, bool(repo.get("sslverify", True)), repo.get("sslcacert"),
+                           repo.get("sslclientcert"), repo.get("sslclientkey"))
+
+
+def loaded_revisions(entry: pathlib.Path, repos: list) -> Optional[list]:
+    """Return the revisions of the metadata of `repos` the depsolver loaded
+    into the cache `entry`, see `repo_revision`. The metadata of a
+    repository is kept in a directory named by its id and a checksum of its
+    configuration. Returns `None` when any of them can't be determined."""
+    if "OTK_UNDER_TEST" in os.environ:
+        revisions = [repo_revision(repo) for repo in repos]
+        return None if None in revisions else revisions
+    try:
+        names = os.listdir(entry)
+    except OSError:
+        return None
+    revisions = []
+    for repo in repos:
+        pattern = re.compile(re.escape(str(repo.get("id"))) + r"-[0-9a-f]{16}")
+        found = [name for name in names if pattern.fullmatch(name)]
+        if len(found) != 1:
+            return None
+        try:
+            data = (entry / found[0] / "repodata" / "repomd.xml").read_bytes()
+        except OSError:
+            return None
+        revisions.append(hashlib.sha256(data).hexdigest())
+    return revisions
+
+
+def result_request(tree: dict, packages: dict) -> Optional[dict]:
+    """Return everything the result of depsolving `packages` depends on,
+    or `None` when the result can't be cached."""
+    revisions = []
+    for repo in tree["repositories"]:
+        revision = repo_revision(repo)
+        if revision is None:
+            return None
+        revisions.append(revision)
+    return {
+        "architecture": tree["architecture"],
+        "module_platform_id": tree["module_platform_id"],
+        "releasever": tree["releasever"],
+        "repositories": tree["repositories"],
+        "revisions": revisions,
+        "include": packages["include"],
+        "exclude": packages.get("exclude", []),
+    }
+
+
+def _checksum(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def load_result(request: dict) -> Optional[list]:
+    """Return the cached result for `request`. Results are only used when
+    they are for the same request and match their checksum."""
+    path = result_dir() / f"{_checksum(request)}.json"
+    try:
+        result = json.loads(path.read_text(encoding="utf8"))
+        if result["request"] != request or result["sha256"] != _checksum(result["packages"]):
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    try:
+        # mark as recently used
+        os.utime(path)
+    except OSError:
+        pass
+    return result["packages"]
+
+
+def store_result(request: dict, packages: list) -> None:
+    base = result_dir()
+    result = {
+        "request": request,
+        "packages": packages,
+        "sha256": _checksum(packages),
+    }
+    try:
+        base.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=base, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as fp:
+                json.dump(result, fp)
+            os.replace(tmp, base / f"{_checksum(request)}.json")
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        # a read-only result directory is fine
         return
+    evict_results(base)
+
+
+def evict_results(base: pathlib.Path) -> None:
+    deadline = time.time() - CACHE_MAX_AGE
+    try:
+        with os.scandir(base) as it:
+            entries = [dent.path for dent in it if dent.name.endswith(".json")]
+    except OSError:
+        return
+    for path in entries:
+        try:
+            if os.stat(path).st_mtime < deadline:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def cached_result(tree: dict, packages: dict) -> tuple[Optional[dict], Optional[list]]:
+    """Return the request to store the result of depsolving `packages` for
+    and the result that is stored for it, if any. The request is `None` when
+    the result can't be cached or `otk` was asked not to use any cache."""
+    request = None if no_cache() else result_request(tree, packages)
+    if request is None:
+        return None, None
+    return request, load_result(request)
+
+
+def depsolve(tree: dict, packages: dict) -> list:
+    """Depsolve a single package set against the repositories in `tree`.
+    Results are reused as long as the metadata of the repositories does not
+    change, unless `otk` was asked not to use any cache."""
+    request, result = cached_result(tree, packages)
+    if result is not None:
+        return result
+    return solve(tree, packages, request)
+
+
+def solve(tree: dict, packages: dict, request: Optional[dict], exclusive: bool = True) -> list:
+    """Depsolve `packages` and store the result for `request` (see
+    `cached_result`). With `exclusive` the metadata cache is locked
+    exclusively, otherwise it must already be filled and is shared."""
+    revisions = None
+    with cache_entry(tree, exclusive) as entry:
+        if "OTK_UNDER_TEST" in os.environ:
+            result = mockdata(packages, mock_metadata(entry, tree), tree["architecture"])
+        else:
+            result = _depsolve(tree, packages, entry)
+        if request is not None:
+            # the metadata can change between looking up its revision and
+            # the depsolver loading it, or the depsolver uses metadata from
+            # the cache, the result is stored for what it was solved with
+            revisions = loaded_revisions(entry, tree["repositories"])
 
+    if request is not None and revisions is not None:
+        store_result(dict(request, revisions=revisions), result)
+    return result
+
+
+def _depsolve(tree: dict, packages: dict, entry: pathlib.Path) -> list:
+    root_dir = entry / "root"
+    root_dir.mkdir(exist_ok=True)
     request = {
         "command": "depsolve",
         "arch": tree["architecture"],
         "module_platform_id": "platform:" + tree["module_platform_id"],
         "releasever": tree["releasever"],
-        "cachedir": "/tmp",
+        "cachedir": os.fspath(entry),
         "arguments": {
-            "root_dir": "/tmp",
+            # keeps the depsolver from picking up any repositories or
+            # variables from the host
+            "root_dir": os.fspath(root_dir),
             "repos": tree["repositories"],
             "transactions": [
                 {
-                    "package-specs": tree["packages"]["include"],
-                    "exclude-specs": tree["packages"].get("exclude", []),
+                    "package-specs": packages["include"],
+                    "exclude-specs": packages.get("exclude", []),
                 },
             ],
         },
     }
 
-    process = subprocess.run(
+    proc = subprocess.run(
         ["/usr/libexec/osbuild-depsolve-dnf"],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -94,13 +404,64 @@ def root(input_stream: TextIO) -> None:
         check=False,
     )
 
-    if process.returncode != 0:
-        raise RuntimeError(f"{process.stdout=}{process.stderr=}")
+    if proc.returncode != 0:
+        raise RuntimeError(f"{proc.stdout=}{proc.stderr=}")
+
+    results = json.loads(proc.stdout)
+    return results.get("packages", [])
+
+
+def depsolve_batch(tree, packagesets):
+    """Depsolve several package sets against the same repositories in
+    `tree`, returns the packages by the name of the package set.
+
+    The transactions of a single depsolver request build on top of each
+    other, so every package set needs its own request. Identical package sets
+    are only solved once, results that are cached are not solved at all. The
+    first request fills the metadata cache of the repositories, the others
+    only read it and run in parallel, sharing the lock on the cache."""
+    def key(packages):
+        return json.dumps(packages, sort_keys=True)
+
+    unique = {}
+    for packages in packagesets.values():
+        unique.setdefault(key(packages), packages)
+
+    solved = {}
+    requests = {}
+    for k, packages in unique.items():
+        requests[k], result = cached_result(tree, packages)
+        if result is not None:
+            solved[k] = result
+    keys = [k for k in unique if k not in solved]
 
-    results = json.loads(process.stdout)
-    packages = results.get("packages", [])
+    if keys:
+        solved[keys[0]] = solve(tree, unique[keys[0]], requests[keys[0]])
+    if len(keys) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(keys) - 1, os.cpu_count() or 1)) as executor:
+            futures = {k: executor.submit(solve, tree, unique[k], requests[k], False) for k in keys[1:]}
+        for k, future in futures.items():
+            solved[k] = future.result()
 
-    sys.stdout.write(json.dumps(transform(packages)))
+    return {name: solved[key(packages)] for name, packages in packagesets.items()}
+
+
+def process(tree: dict) -> dict:
+    if "packagesets" in tree:
+        if "packages" in tree:
+            raise ValueError("only one of 'packages' and 'packagesets' can be given")
+        return {
+            "tree": {
+                name: transform(packages)["tree"]
+                for name, packages in depsolve_batch(tree, tree["packagesets"]).items()
+            },
+        }
+
+    return transform(depsolve(tree, tree["packages"]))
+
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream)
 
 
 def main():
@@ -1,25 +1,205 @@
 import base64
 import hashlib
+import io
 import json
+import logging
+import os
 import pathlib
-import sys
-from typing import TextIO
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterable, Optional, TextIO
 
+from otk.cache import DiskCache, cache_home
+from otk_external_osbuild.protocol import no_cache, respond, run
 
-def process_contents(contents):
-    digest = hashlib.sha256(contents).hexdigest()
-    source_id = f"sha256:{digest}"
-    b64contents = base64.b64encode(contents).decode("utf8")
+log = logging.getLogger(__name__)
+
+# Files are read, hashed and encoded in chunks of this size. It is a multiple of
+# 3 so the base64 of full chunks can be concatenated as is.
+CHUNK_SIZE = 3 * 256 * 1024
+
+# Directory to keep the digests and encoded contents of files in, defaults to a
+# directory in the otk cache.
+ENV_CACHE_DIR = "OTK_INLINE_FILES_CACHE_DIR"
+# Fraction (0 to 1) of the files found in the cache that are read again to
+# verify their cache entry.
+ENV_VERIFY = "OTK_INLINE_FILES_VERIFY"
+CACHE_MAX_SIZE = 256 * 1024 * 1024
+# The cache is searched for entries of files that vanished at most this
+# often, see `evict_vanished`.
+EVICT_VANISHED_INTERVAL = 60 * 60
+# Directory to keep the encoded contents of files in when they are passed on
+# by reference, defaults to a directory in the otk cache.
+ENV_STORE_DIR = "OTK_INLINE_FILES_STORE_DIR"
+STORE_MAX_SIZE = 1024 * 1024 * 1024
+
+
+def process_chunks(chunks: Iterable[bytes]) -> dict:
+    digest = hashlib.sha256()
+    b64chunks = []
+    rest = b""
+    for chunk in chunks:
+        digest.update(chunk)
+        if rest:
+            chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        b64chunks.append(base64.b64encode(chunk[:cut]).decode("ascii"))
+        rest = chunk[cut:]
+    b64chunks.append(base64.b64encode(rest).decode("ascii"))
     return {
-        "id": source_id,
-        "data": b64contents,
+        "id": f"sha256:{digest.hexdigest()}",
+        "data": "".join(b64chunks),
     }
 
 
-def root(input_stream: TextIO) -> None:
-    data = json.loads(input_stream.read())
-    tree = data["tree"]
+def process_contents(contents: bytes) -> dict:
+    return process_chunks([contents])
+
+
+def read_chunks(fp: IO) -> Iterable[bytes]:
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+def process_path(path: str, read_type: str) -> dict:
+    """Hash and encode the file at `path` without holding more than a chunk of
+    its (raw) contents in memory."""
+    fp: IO
+    if read_type == "text":
+        fp = open(path, encoding="utf-8")  # pylint: disable=consider-using-with
+    else:
+        fp = io.FileIO(path)
+    with fp:
+        return process_chunks(read_chunks(fp))
+
 
+def cache_dir() -> pathlib.Path:
+    base = os.getenv(ENV_CACHE_DIR)
+    if base:
+        return pathlib.Path(base)
+    return cache_home() / "inline-files"
+
+
+def store_dir() -> pathlib.Path:
+    base = os.getenv(ENV_STORE_DIR)
+    if base:
+        return pathlib.Path(base)
+    return cache_home() / "inline-store"
+
+
+def store_file(store: DiskCache, file: dict, item: dict) -> dict:
+    """Put the encoded contents of `file` into `store`, returns the file with
+    the path of its contents in the store instead of its contents. The store
+    is size capped, the file also refers to the path `item` it was read from
+    in case its contents were evicted by the time they are read."""
+    key = file["id"].removeprefix("sha256:")
+    if not store.touch(key):
+        store.put(key, file["data"].encode("ascii"))
+    return {
+        "id": file["id"],
+        "path": os.fspath(store.path / key),
+        "source": {
+            "path": os.path.abspath(item["path"]),
+            "type": item["type"],
+        },
+    }
+
+
+def _stat_header(path: str, read_type: str) -> Optional[dict]:
+    """Return what identifies the current contents of the file at `path`, or
+    `None` when it cannot be stat'ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return {
+        "path": os.path.realpath(path),
+        "ino": st.st_ino,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "type": read_type,
+    }
+
+
+def _load_entry(cache: DiskCache, key: str, header: dict) -> Optional[dict]:
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        head, body = data.split(b"\n", 1)
+        if json.loads(head) != header:
+            return None
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+def cached_process_path(cache: DiskCache, path: str, read_type: str) -> dict:
+    """Like `process_path` but files that did not change since they were last
+    processed (same path, inode, size and modification time) are taken from
+    `cache`. A sample of the files taken from the cache is verified."""
+    header = _stat_header(path, read_type)
+    if header is None:
+        return process_path(path, read_type)
+    key = hashlib.sha256(json.dumps(header, sort_keys=True).encode("utf8")).hexdigest()
+
+    cached = _load_entry(cache, key, header)
+    if cached is not None:
+        if random.random() >= float(os.getenv(ENV_VERIFY) or 0):
+            return cached
+        res = process_path(path, read_type)
+        if res == cached:
+            return res
+        log.warning("cache entry for %s did not match its contents, replacing it", path)
+    else:
+        res = process_path(path, read_type)
+
+    # a file that changed while it was read is not cached
+    if _stat_header(path, read_type) == header:
+        cache.put(key, json.dumps(header).encode("utf8") + b"\n" + json.dumps(res).encode("utf8"))
+    return res
+
+
+def evict_vanished(cache: DiskCache) -> int:
+    """Remove the entries of files that no longer exist or changed since they
+    were cached, returns the number of removed entries. Every entry is read
+    for this, so it is done at most once every `EVICT_VANISHED_INTERVAL`.
+    The last time is kept as the modification time of a file in the
+    cache."""
+    stamp = cache.path / ".evict-vanished"
+    try:
+        if time.time() - stamp.stat().st_mtime < EVICT_VANISHED_INTERVAL:
+            return 0
+    except OSError:
+        pass
+    try:
+        stamp.touch()
+        entries = list(os.scandir(cache.path))
+    except OSError:
+        return 0
+    evicted = 0
+    for dent in entries:
+        if dent.name.startswith("."):
+            # the stamp and entries being written
+            continue
+        try:
+            with open(dent.path, "rb") as fp:
+                header = json.loads(fp.readline())
+            current = _stat_header(header["path"], header["type"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # not ours
+            continue
+        if current != header:
+            cache.remove(dent.name)
+            evicted += 1
+    return evicted
+
+
+def process(tree: dict) -> dict:
     inline_files = tree.get("inline", {})
     inlines: dict = {}
     for name, item in inline_files.items():
@@ -33,16 +213,34 @@ def root(input_stream: TextIO) -> None:
 
         path = item["path"]
         read_type = item["type"]
-        if read_type == "text":
-            contents = pathlib.Path(path).read_text(encoding="utf-8").encode("utf-8")
-        elif read_type == "binary":
-            contents = pathlib.Path(path).read_bytes()
-        else:
+        if read_type not in ("text", "binary"):
             raise ValueError(f"invalid type for inline path {path}: {read_type}")
 
-        inlines[name] = process_contents(contents)
+    cache = None if no_cache() else DiskCache(cache_dir(), CACHE_MAX_SIZE)
+
+    def process_item(item: dict) -> dict:
+        if cache is None:
+            return process_path(item["path"], item["type"])
+        return cached_process_path(cache, item["path"], item["type"])
+
+    # hashlib releases the GIL, files are processed in parallel
+    if len(inline_paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(inline_paths), os.cpu_count() or 1)) as executor:
+            inlines.update(zip(inline_paths, executor.map(process_item, inline_paths.values())))
+    else:
+        for name, item in inline_paths.items():
+            inlines[name] = process_item(item)
+    if inline_paths and cache is not None:
+        evict_vanished(cache)
 
-    output = {
+    # only the contents of files on disk are stored, those of inline files
+    # are already part of the tree
+    if tree.get("store", False) and inline_paths and not no_cache():
+        store = DiskCache(store_dir(), STORE_MAX_SIZE)
+        for name, item in inline_paths.items():
+            inlines[name] = store_file(store, inlines[name], item)
+
+    return {
         "tree": {
             "const": {
                 "files": inlines,
@@ -50,11 +248,13 @@ def root(input_stream: TextIO) -> None:
         }
     }
 
-    sys.stdout.write(json.dumps(output))
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream)
 
 
 def main():
-    root(sys.stdin)
+    run(root)
 
 
 if __name__ == "__main__":
@@ -1,39 +1,97 @@
-import json
-import sys
-from typing import List, Optional, TextIO
+import threading
+from typing import Dict, List, Optional, TextIO
 
+from otk_external_osbuild.protocol import reference_digest, respond, run
 
-def find_pkg_by_name(packages: List[dict], pkg_name: str) -> Optional[dict]:
+# the externals share the same entrypoint boilerplate
+# pylint: disable=duplicate-code
+
+# Indexes of package sets that were passed by reference, by their checksum.
+# A worker is sent the same package sets over and over. In-process calls come
+# from several threads.
+_indexes: Dict[str, Dict[str, List[dict]]] = {}
+_indexes_lock = threading.Lock()
+INDEXES_MAX = 8
+
+
+def _index(packages: List[dict]) -> Dict[str, List[dict]]:
+    index: Dict[str, List[dict]] = {}
     for pkg in packages:
-        if pkg["name"] == pkg_name:
-            return pkg
-    return None
+        index.setdefault(pkg["name"], []).append(pkg)
+    return index
 
 
-def root(input_stream: TextIO) -> None:
-    data = json.load(input_stream)
-    pkg_name = data["tree"]["packagename"]
-    packages = data["tree"]["packageset"]["const"]["internal"]["packages"]
+def index_packages(packages: List[dict]) -> Dict[str, List[dict]]:
+    """Return the packages by their name, a name can be in a package set more
+    than once, e.g. for different architectures."""
+    digest = reference_digest(packages)
+    if digest is None:
+        return _index(packages)
+
+    with _indexes_lock:
+        index = _indexes.get(digest)
+    if index is None:
+        index = _index(packages)
+        with _indexes_lock:
+            if len(_indexes) >= INDEXES_MAX:
+                del _indexes[next(iter(_indexes))]
+            _indexes[digest] = index
+    return index
+
+
+def find_pkg_by_name(packages: List[dict], pkg_name: str, arch: Optional[str] = None) -> Optional[dict]:
+    """Return the package named `pkg_name`. When there is more than one the
+    one for `arch`, or else a noarch one, is preferred over the first."""
+    candidates = index_packages(packages).get(pkg_name)
+    if not candidates:
+        return None
+    if arch is not None and len(candidates) > 1:
+        for preferred in (arch, "noarch"):
+            for pkg in candidates:
+                if pkg["arch"] == preferred:
+                    return pkg
+    return candidates[0]
 
-    pkg = find_pkg_by_name(packages, pkg_name)
+
+def package_info(packages: List[dict], pkg_name: str, arch: Optional[str] = None) -> dict:
+    pkg = find_pkg_by_name(packages, pkg_name, arch)
     if not pkg:
         raise KeyError(f"cannot find package {pkg_name}")
-    sys.stdout.write(
-        json.dumps(
-            {
-                "tree": {
-                    "name": pkg["name"],
-                    "version": pkg["version"],
-                    "release": pkg["release"],
-                    "arch": pkg["arch"],
-                }
-            }
-        )
-    )
+    return {
+        "name": pkg["name"],
+        "version": pkg["version"],
+        "release": pkg["release"],
+        "arch": pkg["arch"],
+    }
+
+
+def process(tree: dict) -> dict:
+    packages = tree["packageset"]["const"]["internal"]["packages"]
+    arch = tree.get("architecture")
+
+    if "packagenames" in tree:
+        if "packagename" in tree:
+            raise ValueError("only one of 'packagename' and 'packagenames' can be given")
+        names = tree["packagenames"]
+        # a mapping names the results, e.g. for package names that are not
+        # valid variable names
+        if not isinstance(names, dict):
+            names = {name: name for name in names}
+        result = {key: package_info(packages, name, arch) for key, name in names.items()}
+    else:
+        result = package_info(packages, tree["packagename"], arch)
+    return {
+        "tree": result,
+        "cacheable": True,
+    }
+
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream)
 
 
 def main():
-    root(sys.stdin)
+    run(root)
 
 
 if __name__ == "__main__":
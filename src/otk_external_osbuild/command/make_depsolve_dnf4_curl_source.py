@@ -1,33 +1,52 @@
-import itertools
-import json
-import sys
-from typing import TextIO
+import logging
+from typing import Any, TextIO
 
+from otk_external_osbuild.protocol import respond, run
 
-def root(input_stream: TextIO) -> None:
-    data = json.load(input_stream)
-    tree = data["tree"]
+# the externals share the same entrypoint boilerplate
+# pylint: disable=duplicate-code
+
+log = logging.getLogger(__name__)
+
+
+def slim_package(obj: dict) -> Any:
+    """Only keep what is needed of the packages while the request is parsed,
+    the package sets are never held in memory as a whole."""
+    if "checksum" in obj and "remote_location" in obj:
+        return {"checksum": obj["checksum"], "remote_location": obj["remote_location"]}
+    return obj
 
-    sources: dict = {"org.osbuild.curl": {"items": {}}}
 
-    for package in itertools.chain.from_iterable(
-        s["const"]["internal"]["packages"] for s in tree["packagesets"]
-    ):
-        sources["org.osbuild.curl"]["items"][package["checksum"]] = {
-            "url": package["remote_location"],
-        }
+def process(tree: dict) -> dict:
+    items: dict = {}
 
-    sys.stdout.write(
-        json.dumps(
-            {
-                "tree": sources,
-            }
-        )
-    )
+    total = 0
+    for packageset in tree["packagesets"]:
+        for package in packageset["const"]["internal"]["packages"]:
+            total += 1
+            # package sets overlap, a package is added once
+            checksum = package["checksum"]
+            if checksum not in items:
+                items[checksum] = {
+                    "url": package["remote_location"],
+                }
+
+    log.info("%d packages in %d package sets, %d unique, %d duplicates",
+             total, len(tree["packagesets"]), len(items), total - len(items))
+    return {
+        "tree": {"org.osbuild.curl": {"items": items}},
+        "cacheable": True,
+    }
+
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream, slim_package)
 
 
 def main():
-    root(sys.stdin)
+    # the statistics are reported on stderr
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    run(root)
 
 
 if __name__ == "__main__":
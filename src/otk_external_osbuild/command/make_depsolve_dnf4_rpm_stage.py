@@ -1,11 +1,12 @@
-import json
-import sys
 from typing import TextIO
 
+from otk_external_osbuild.protocol import respond, run
 
-def root(input_stream: TextIO) -> None:
-    data = json.load(input_stream)
-    tree = data["tree"]
+# the externals share the same entrypoint boilerplate
+# pylint: disable=duplicate-code
+
+
+def process(tree: dict) -> dict:
     pkgs = tree["packageset"]["const"]["internal"]
 
     # allow passing on rpm stage options
@@ -15,32 +16,33 @@ def root(input_stream: TextIO) -> None:
     # it should: https://github.com/osbuild/otk/issues/218
     opts["gpgkeys"] = tree["gpgkeys"]
 
-    sys.stdout.write(
-        json.dumps(
-            {
-                "tree": {
-                    "type": "org.osbuild.rpm",
-                    "inputs": {
-                        "packages": {
-                            "type": "org.osbuild.files",
-                            "origin": "org.osbuild.source",
-                            "references": [
-                                {
-                                    "id": package["checksum"],
-                                }
-                                for package in pkgs["packages"]
-                            ],
-                        },
-                    },
-                    "options": opts,
-                }
-            }
-        )
-    )
+    return {
+        "tree": {
+            "type": "org.osbuild.rpm",
+            "inputs": {
+                "packages": {
+                    "type": "org.osbuild.files",
+                    "origin": "org.osbuild.source",
+                    "references": [
+                        {
+                            "id": package["checksum"],
+                        }
+                        for package in pkgs["packages"]
+                    ],
+                },
+            },
+            "options": opts,
+        },
+        "cacheable": True,
+    }
+
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream)
 
 
 def main():
-    root(sys.stdin)
+    run(root)
 
 
 if __name__ == "__main__":
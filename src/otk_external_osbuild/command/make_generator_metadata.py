@@ -1,21 +1,19 @@
-import json
-import sys
-
 import otk
+from otk_external_osbuild.protocol import run, write_response
+
+
+def process(_tree: dict) -> dict:
+    return {
+        "tree": f"otk {otk.__version__}",
+    }
 
 
 def root() -> None:
-    sys.stdout.write(
-        json.dumps(
-            {
-                "tree": f"otk {otk.__version__}",
-            }
-        )
-    )
+    write_response(process({}))
 
 
 def main():
-    root()
+    run(lambda _: root())
 
 
 if __name__ == "__main__":
@@ -1,32 +1,75 @@
-import json
-import sys
+import base64
+import hashlib
 from typing import TextIO
 
+from otk_external_osbuild.command.gen_inline_files import process_path
+from otk_external_osbuild.protocol import respond, run
 
-def root(input_stream: TextIO) -> None:
-    data = json.load(input_stream)
-    tree = data["tree"]
+# the externals share the same entrypoint boilerplate
+# pylint: disable=duplicate-code
+
+
+def _matches(file: dict, data: str) -> bool:
+    return file["id"] == f"sha256:{hashlib.sha256(base64.b64decode(data)).hexdigest()}"
+
+
+def file_data(file: dict) -> str:
+    """Return the encoded contents of `file`, either passed along or, for
+    files put into the store by `osbuild-gen-inline-files`, read from it.
+    Contents that are no longer in the store, or no longer match their
+    checksum, are read from their source again."""
+    data = file.get("data")
+    if data is not None:
+        return data
+    try:
+        with open(file["path"], encoding="ascii") as fp:
+            data = fp.read()
+        if _matches(file, data):
+            return data
+    except (OSError, ValueError):
+        pass
+    source = file.get("source")
+    if source is None:
+        raise ValueError(f"contents of {file['id']} are no longer in the store at {file['path']}")
+    data = process_path(source["path"], source["type"])["data"]
+    if not _matches(file, data):
+        raise ValueError(f"contents of {source['path']} changed, they no longer match {file['id']}")
+    return data
+
+
+def process(tree: dict) -> dict:
     files = tree["const"]["files"]
+    # the files of several calls to osbuild-gen-inline-files can be combined
+    filesets = files if isinstance(files, list) else [files]
 
     items = {}
+    stored = False
 
-    for file in files.values():
-        items[file["id"]] = {
-            "encoding": "base64",
-            "data": file["data"],
-        }
-
-    sys.stdout.write(
-        json.dumps(
-            {
-                "tree": {"org.osbuild.inline": {"items": items}}
+    # files are identified by their contents, identical contents are added
+    # (and read) only once no matter under how many names they were inlined
+    for fileset in filesets:
+        for file in fileset.values():
+            stored = stored or "data" not in file
+            if file["id"] in items:
+                continue
+            items[file["id"]] = {
+                "encoding": "base64",
+                "data": file_data(file),
             }
-        )
-    )
+
+    res: dict = {"tree": {"org.osbuild.inline": {"items": items}}}
+    # the contents of stored files are not part of the tree
+    if not stored:
+        res["cacheable"] = True
+    return res
+
+
+def root(input_stream: TextIO) -> None:
+    respond(process, input_stream)
 
 
 def main():
-    root(sys.stdin)
+    run(root)
 
 
 if __name__ == "__main__":
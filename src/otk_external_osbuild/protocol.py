@@ -0,0 +1,108 @@
+"""Support for the optional parts of the `otk` external protocol that are
+shared between the externals."""
+
+import contextlib
+import io
+import json
+import os
+import sys
+from typing import Any, Callable, Optional, TextIO
+
+from otk.constant import ENV_EXTERNAL_INPUT, ENV_EXTERNAL_OUTPUT, ENV_EXTERNAL_WORKER, ENV_NO_CACHE, NAME_REFERENCE
+
+# referenced values by their checksum, a worker reads each one only once
+_references: dict[str, Any] = {}
+# and the checksums by the id of the values, these are kept in `_references`
+# so their ids stay unique
+_digests: dict[int, str] = {}
+
+
+def dereference(tree: Any, object_hook: Optional[Callable[[dict], Any]] = None) -> Any:
+    """Return `tree` with the values `otk` passed by reference read in, see
+    `respond` for `object_hook`."""
+    if isinstance(tree, dict):
+        ref = tree.get(NAME_REFERENCE)
+        if ref is not None and len(tree) == 1:
+            value = _references.get(ref["sha256"])
+            if value is None:
+                with open(ref["path"], encoding="utf8") as fp:
+                    value = json.load(fp, object_hook=object_hook)
+                value = _references[ref["sha256"]] = dereference(value, object_hook)
+                _digests[id(value)] = ref["sha256"]
+            return value
+        return {key: dereference(value, object_hook) for key, value in tree.items()}
+    if isinstance(tree, list):
+        return [dereference(value, object_hook) for value in tree]
+    return tree
+
+
+def reference_digest(value: Any) -> Optional[str]:
+    """Return the checksum of `value` when it was passed by reference (see
+    `dereference`), `None` otherwise. Externals can use it to remember what
+    they derive from large values across requests."""
+    digest = _digests.get(id(value))
+    if digest is None or _references.get(digest) is not value:
+        return None
+    return digest
+
+
+def no_cache() -> bool:
+    """Was `otk` asked not to use or update any cache? Externals must not use
+    caches of their own then either."""
+    return bool(os.environ.get(ENV_NO_CACHE))
+
+
+# flags added to the response, see `run`
+_flags: dict[str, Any] = {}
+
+
+def write_response(response: dict) -> None:
+    """Write `response` to stdout. The JSON is written as it is encoded, large
+    responses are never held in memory as a whole."""
+    json.dump({**response, **_flags}, sys.stdout)
+
+
+def respond(process: Callable[[Any], dict], input_stream: TextIO,
+            object_hook: Optional[Callable[[dict], Any]] = None) -> None:
+    """Answer the request read from `input_stream` with the response
+    `process` returns for its tree. Every object in the request is passed
+    through `object_hook` as it is parsed (see `json.loads`), e.g. to only
+    keep the parts of large values that are needed."""
+    request = input_stream.read()
+    tree = json.loads(request, object_hook=object_hook)["tree"]
+    if NAME_REFERENCE in request:
+        tree = dereference(tree, object_hook)
+    write_response(process(tree))
+
+
+def run(root: Callable[[TextIO], None]) -> None:
+    """Run the external implemented by `root`, which reads a request from the
+    stream it is passed and writes its response with `write_response`.
+
+    Started as a worker by `otk` every line on stdin is a request that is
+    answered by a single line on stdout, until stdin is closed. Otherwise
+    `root` is called once and the response advertises that the external can
+    run as a worker, takes values by reference (see `dereference`) and can
+    exchange its request and response through files. In the latter case the
+    request is read from the file `otk` names in the environment and the
+    response is written to the file named next to it."""
+    if os.environ.get(ENV_EXTERNAL_WORKER):
+        for line in sys.stdin:
+            root(io.StringIO(line))
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        return
+
+    _flags.update(worker=True, references=True, files=True)
+    try:
+        input_path = os.environ.get(ENV_EXTERNAL_INPUT)
+        output_path = os.environ.get(ENV_EXTERNAL_OUTPUT)
+        if input_path and output_path:
+            with open(input_path, encoding="utf8") as input_stream, \
+                    open(output_path, "w", encoding="utf8") as output_stream, \
+                    contextlib.redirect_stdout(output_stream):
+                root(input_stream)
+        else:
+            root(sys.stdin)
+    finally:
+        _flags.clear()
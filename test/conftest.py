@@ -1,3 +1,5 @@
+import pytest
+
 from .test_against_images_refs import _TestCase
 
 
@@ -7,3 +9,9 @@ def pytest_make_parametrize_id(config, val):  # pylint: disable=W0613
     if isinstance(val, _TestCase):
         return f"{val}"
     return None
+
+
+@pytest.fixture(autouse=True)
+def _isolated_cache_home(tmp_path_factory, monkeypatch):
+    # never let the tests read or write the users real cache
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path_factory.mktemp("cache")))
@@ -99,8 +99,9 @@ def test_normalize_rpm_refs():
         {"id": "sha256:111"}, {"id": "sha256:222"}]
 
 
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
 @pytest.mark.parametrize("tc", reference_manifests("empty"))
-def test_images_ref_no_customizations(tmp_path, monkeypatch, tc):
+def test_images_ref_no_customizations(tmp_path, monkeypatch, tc, resolver):
     monkeypatch.setenv("OSBUILD_TESTING_RNG_SEED", "0")
     monkeypatch.setenv("OTK_EXTERNAL_PATH", "./external")
     monkeypatch.setenv("OTK_UNDER_TEST", "1")
@@ -112,6 +113,7 @@ def test_images_ref_no_customizations(tmp_path, monkeypatch, tc):
 
     otk_json = tmp_path / "manifest-otk.json"
     run(["compile",
+         "--resolver", resolver,
          "-o", os.fspath(otk_json),
          os.fspath(tc.as_example_yaml()),
          ])
@@ -123,8 +125,9 @@ def test_images_ref_no_customizations(tmp_path, monkeypatch, tc):
     assert manifest == ref_manifest
 
 
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
 @pytest.mark.parametrize("tc", reference_manifests("full"))
-def test_images_ref_full_customizations(tmp_path, monkeypatch, tc):
+def test_images_ref_full_customizations(tmp_path, monkeypatch, tc, resolver):
     monkeypatch.setenv("OSBUILD_TESTING_RNG_SEED", "0")
     monkeypatch.setenv("OTK_EXTERNAL_PATH", "./external")
     monkeypatch.setenv("OTK_UNDER_TEST", "1")
@@ -147,6 +150,7 @@ def test_images_ref_full_customizations(tmp_path, monkeypatch, tc):
 
     otk_json = tmp_path / "manifest-otk.json"
     run(["compile",
+         "--resolver", resolver,
          "-o", os.fspath(otk_json),
          os.fspath(input_otk_path),
          ])
@@ -0,0 +1,68 @@
+import os
+
+from otk.cache import DiskCache, cache_home
+
+
+def test_cache_home(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", os.fspath(tmp_path))
+    assert cache_home() == tmp_path / "otk"
+
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.setenv("HOME", os.fspath(tmp_path))
+    assert cache_home() == tmp_path / ".cache" / "otk"
+
+
+def test_disk_cache_get_put(tmp_path):
+    cache = DiskCache(tmp_path / "sub", 1024)
+    assert cache.get("key") is None
+
+    cache.put("key", b"value")
+    assert cache.get("key") == b"value"
+    assert [p.name for p in (tmp_path / "sub").iterdir()] == ["key"]
+
+    assert cache.touch("key")
+    cache.remove("key")
+    assert cache.get("key") is None
+    assert not cache.touch("key")
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path, 35)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put(key, b"x" * 10)
+        os.utime(tmp_path / key, ns=(i * 10**9, i * 10**9))
+
+    # reading "a" marks it as used so "b" is the oldest entry now
+    assert cache.get("a") is not None
+    assert cache.put("d", b"x" * 10) == 1
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c", "d"]
+
+
+def test_disk_cache_unwritable_is_ignored(tmp_path):
+    (tmp_path / "file").write_text("not a directory")
+    cache = DiskCache(tmp_path / "file" / "cache", 1024)
+    cache.put("key", b"value")
+    assert cache.get("key") is None
+
+
+def test_disk_cache_scans_once(tmp_path, monkeypatch):
+    scans = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scans.append(path)
+        return scandir(path)
+    monkeypatch.setattr(os, "scandir", counting_scandir)
+
+    cache = DiskCache(tmp_path, 35)
+    for i, key in enumerate(["a", "b", "c"]):
+        assert cache.put(key, b"x" * 10) == 0
+        os.utime(tmp_path / key, ns=(i * 10**9, i * 10**9))
+    assert len(scans) == 1
+
+    # entries of other processes are found once the cache might be full
+    (tmp_path / "other").write_bytes(b"x" * 10)
+    assert cache.put("d", b"x" * 10) == 2
+    assert len(scans) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["c", "d", "other"]
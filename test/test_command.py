@@ -1,6 +1,9 @@
+import os
+
 import pytest
 
 from otk.command import parser_create, run
+from otk.constant import EXTERNAL_INDEX_FILE
 
 
 @pytest.mark.parametrize(
@@ -21,6 +24,9 @@ from otk.command import parser_create, run
             },
         ),
         (["validate", "foo.yaml"], {"command": "validate", "input": "foo.yaml"}),
+        (["compile", "foo.yaml"], {"command": "compile", "no_cache": False}),
+        (["compile", "--no-cache", "foo.yaml"], {"command": "compile", "no_cache": True}),
+        (["validate", "--no-cache", "foo.yaml"], {"command": "validate", "no_cache": True}),
     ],
 )
 def test_parse_commands_success(command, results):
@@ -141,3 +147,25 @@ def test_argument_t(tmp_path, caplog, data):
     assert output_file.read_text() == data["output_data"]
     assert ret == data["ret_expected"]
     assert data["log_expected"] in caplog.text
+
+
+def test_externals_command(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    for name in ["test", "osbuild-make-inline-source"]:
+        (tmp_path / name).write_text("#!/bin/sh\n")
+        (tmp_path / name).chmod(0o755)
+
+    assert run(["externals", "--no-inprocess-externals"]) == 0
+    assert capsys.readouterr().out == (
+        f"osbuild-make-inline-source\t{tmp_path}/osbuild-make-inline-source\n"
+        f"test\t{tmp_path}/test\n"
+    )
+
+    (tmp_path / "osbuild-make-inline-source").unlink()
+    assert run(["externals"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert "osbuild-make-inline-source\tin-process (otk_external_osbuild.command.make_inline_source)" in lines
+    assert f"test\t{tmp_path}/test" in lines
+
+    assert run(["externals", "--write-index", os.fspath(tmp_path)]) == 0
+    assert (tmp_path / EXTERNAL_INDEX_FILE).exists()
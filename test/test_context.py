@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import Future
 
 import pytest
 
@@ -159,3 +160,125 @@ def test_context_define_validates_err_msg():
 def test_context_define_validates_good(var_name):
     ctx = CommonContext()
     ctx.define(var_name, "val")
+
+
+def test_context_index_follows_defines():
+    ctx = CommonContext()
+    ctx.define("a", {"b": {"c": 1}, "l": [10, 20]})
+    assert ctx.variable("a.b.c") == 1
+    assert ctx.variable("a.l.1") == 20
+
+    ctx.define("a.b.c", 2)
+    assert ctx.variable("a.b.c") == 2
+    ctx.define("a.b", {"c": 3})
+    assert ctx.variable("a.b.c") == 3
+    ctx.define("a.l", [30])
+    assert ctx.variable("a.l.0") == 30
+    with pytest.raises(TransformVariableIndexRangeError):
+        ctx.variable("a.l.1")
+
+    # a value is replaced by a dict through a define of a subkey
+    ctx.define("x", "str")
+    assert ctx.variable("x") == "str"
+    ctx.define("x.y", "val")
+    assert ctx.variable("x") == {"y": "val"}
+
+    ctx.define("a", "str")
+    with pytest.raises(TransformVariableTypeError):
+        ctx.variable("a.b.c")
+
+
+def test_context_index_follows_aliased_defines():
+    ctx = CommonContext()
+    ctx.define("y", {"k": "old"})
+    assert ctx.variable("y.k") == "old"
+    # "x" and "y" are the same mapping
+    ctx.define("x", ctx.variable("y"))
+    ctx.define("x.k", "new")
+    assert ctx.variable("y.k") == "new"
+
+
+def test_context_index_follows_merge_defines():
+    ctx = CommonContext()
+    ctx.define("a", {"b": 1})
+    ctx.define("c", 1)
+    assert ctx.variable("a.b") == 1
+    assert ctx.variable("c") == 1
+
+    ctx.merge_defines("", {"a": {"b": 2}})
+    assert ctx.variable("a.b") == 2
+    assert ctx.variable("c") == 1
+
+    ctx.merge_defines("c", {"d": 3})
+    assert ctx.variable("c.d") == 3
+
+
+def _done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def test_context_defer_define_settles_overlapping():
+    ctx = CommonContext()
+    finished = []
+
+    def finish(name):
+        def _finish(result):
+            finished.append(name)
+            ctx.merge_defines(name, result)
+        return _finish
+
+    ctx.runtime.defer("a.b", _done({"v": 1}), finish("a.b"))
+    ctx.runtime.defer("c", _done({"v": 2}), finish("c"))
+    ctx.runtime.defer("a.d", _done({"v": 3}), finish("a.d"))
+    ctx.define("x", 1)
+    assert ctx.variable("x") == 1
+    assert not finished
+
+    # settles everything up to the last overlapping define, in order
+    assert ctx.variable("a.d.v") == 3
+    assert finished == ["a.b", "c", "a.d"]
+    assert ctx.variable("a") == {"b": {"v": 1}, "d": {"v": 3}}
+
+
+def test_context_defer_define_before_define():
+    ctx = CommonContext()
+    ctx.runtime.defer("a", _done({"b": 1, "c": 1}), lambda result: ctx.merge_defines("a", result))
+
+    # the deferred define happened first, the later define wins
+    ctx.define("a.b", 2)
+    assert ctx.variable("a") == {"b": 2, "c": 1}
+
+
+def test_context_defer_define_root():
+    ctx = CommonContext()
+    ctx.runtime.defer("", _done({"a": 1}), lambda result: ctx.merge_defines("", result))
+    assert ctx.variable("a") == 1
+
+
+def test_context_reserve_keeps_place():
+    ctx = CommonContext(warn_duplicated_defs=True)
+    ctx.define("a.x", 0)
+    ctx.reserve("a.b.c")
+    ctx.reserve("a.x")
+    ctx.define("a.d", 1)
+    # reserved names are not defined yet
+    with pytest.raises(TransformVariableLookupError):
+        ctx.variable("a.b.c")
+    ctx.define("a.b.c", 2)
+    assert list(ctx.variable("a")) == ["x", "b", "d"]
+    assert ctx.variable("a.b.c") == 2
+    assert ctx.variable("a.x") == 0
+
+
+def test_context_settle_all_raises():
+    ctx = CommonContext()
+    future = Future()
+    future.set_exception(ValueError("failed"))
+    ctx.runtime.defer("a", future, lambda result: None)
+    # unrelated variables don't wait for the external
+    ctx.define("b.c", 1)
+    assert ctx.variable("b.c") == 1
+    with pytest.raises(ValueError, match="failed"):
+        ctx.runtime.settle()
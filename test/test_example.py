@@ -9,11 +9,12 @@ from .fake_externals import mirror as _mirror
 
 @pytest.mark.parametrize("src_yaml",
                          [str(path) for path in (pathlib.Path(__file__).parent / "data/base").glob("*.yaml")])
-def test_command_compile_on_base_examples(tmp_path, src_yaml, _mirror):
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
+def test_command_compile_on_base_examples(tmp_path, src_yaml, resolver, _mirror):
     src_yaml = pathlib.Path(src_yaml)
     dst = tmp_path / "out.json"
 
-    ns = argparse.Namespace(input=src_yaml, output=dst, target="osbuild", extra=None)
+    ns = argparse.Namespace(input=src_yaml, output=dst, target="osbuild", extra=None, resolver=resolver)
 
     command.compile(ns)
 
@@ -25,10 +26,11 @@ def test_command_compile_on_base_examples(tmp_path, src_yaml, _mirror):
 
 @pytest.mark.parametrize("src_yaml",
                          [str(path) for path in (pathlib.Path(__file__).parent / "data/error").glob("*.yaml")])
-def test_errors(src_yaml, _mirror):
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
+def test_errors(src_yaml, resolver, _mirror):
     src_yaml = pathlib.Path(src_yaml)
     expected = src_yaml.with_suffix(".err").read_text(encoding="utf8").strip()
-    ns = argparse.Namespace(input=src_yaml, output="/dev/null", target="osbuild", extra=None)
+    ns = argparse.Namespace(input=src_yaml, output="/dev/null", target="osbuild", extra=None, resolver=resolver)
     with pytest.raises(Exception) as exception:
         command.compile(ns)
     assert expected in str(exception.value)
@@ -1,14 +1,20 @@
+import errno
 import json
 import os
 import re
+import sys
 import textwrap
 
 import pytest
 
 import otk.external
+from otk.cache import DiskCache
+from otk.constant import EXTERNAL_INDEX_FILE
 from otk.error import ExternalFailedError
-from otk.external import exe_from_directive
+from otk.external import (ExternalCache, FileTransport, References, WorkerPool, exe_from_directive, external_index,
+                          path_for, write_index)
 from otk.traversal import State
+from otk_external_osbuild.command import make_generator_metadata
 
 
 @pytest.mark.parametrize(
@@ -96,3 +102,453 @@ def test_integration_error(tmp_path):
     assert re.match(
         r"foo.yaml: call /.*/test 'otk.external.test' failed: "
         r"stdout='some output\\n', stderr='stderr output\\n'", str(exc.value))
+
+
+def make_counting_external(path, name, cacheable):
+    return make_fake_external(path, name, textwrap.dedent(f"""\
+    #!/bin/sh
+    echo called >> "$0".calls
+    echo '{{"tree": {{"some": "result"}}, "cacheable": {"true" if cacheable else "false"}}}'
+    """))
+
+
+def test_external_cache_reuses_cacheable(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_counting_external(tmp_path, "test", cacheable=True)
+    cache = ExternalCache(DiskCache(tmp_path / "cache", 1024 * 1024))
+
+    for _ in range(2):
+        res = otk.external.call(State(""), "otk.external.test", {"b": 1, "a": 2}, cache)
+        assert res == {"some": "result"}
+    # the same tree, only the order of the keys differs
+    res = otk.external.call(State(""), "otk.external.test", {"a": 2, "b": 1}, cache)
+    assert res == {"some": "result"}
+    assert fake_external_path.with_suffix(".calls").read_text() == "called\n"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # a different tree or a changed external is a different entry
+    otk.external.call(State(""), "otk.external.test", {"a": 3}, cache)
+    fake_external_path.write_text(fake_external_path.read_text() + "\n")
+    otk.external.call(State(""), "otk.external.test", {"a": 3}, cache)
+    assert fake_external_path.with_suffix(".calls").read_text() == "called\n" * 3
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_external_cache_skips_not_cacheable(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_counting_external(tmp_path, "test", cacheable=False)
+    cache = ExternalCache(DiskCache(tmp_path / "cache", 1024 * 1024))
+
+    for _ in range(2):
+        otk.external.call(State(""), "otk.external.test", {}, cache)
+    assert fake_external_path.with_suffix(".calls").read_text() == "called\n" * 2
+    assert not (tmp_path / "cache").exists()
+
+
+def test_external_cache_broken_entry(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_counting_external(tmp_path, "test", cacheable=True)
+    cache = ExternalCache(DiskCache(tmp_path / "cache", 1024 * 1024))
+
+    key = cache.key(fake_external_path, {})
+    cache.store.put(key, b"{broken")
+    assert otk.external.call(State(""), "otk.external.test", {}, cache) == {"some": "result"}
+    assert cache.get(key) == {"tree": {"some": "result"}}
+
+
+def test_external_cache_counts_evictions(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_counting_external(tmp_path, "test", cacheable=True)
+    # room for a single entry
+    cache = ExternalCache(DiskCache(tmp_path / "cache", 40))
+
+    for i in range(3):
+        otk.external.call(State(""), "otk.external.test", {"i": i}, cache)
+    assert cache.evictions == 2
+
+
+def make_worker_external(path, name):
+    return make_fake_external(path, name, textwrap.dedent("""\
+    #!/bin/sh
+    echo started >> "$0".starts
+    if [ -n "$OTK_EXTERNAL_WORKER" ]; then
+        while read -r line; do
+            [ "$line" = '{"tree": "exit"}' ] && exit 1
+            echo '{"tree": "worker"}'
+        done
+        exit 0
+    fi
+    cat > /dev/null
+    echo '{"tree": "oneshot", "worker": true}'
+    """))
+
+
+def test_external_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_worker_external(tmp_path, "test")
+    workers = WorkerPool()
+    try:
+        results = [otk.external.call(State(""), "otk.external.test", {}, workers=workers) for _ in range(3)]
+    finally:
+        workers.close()
+    assert results == ["oneshot", "worker", "worker"]
+    assert fake_external_path.with_suffix(".starts").read_text() == "started\n" * 2
+
+
+def test_external_worker_not_advertised(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_fake_external(tmp_path, "test", textwrap.dedent("""\
+    #!/bin/sh
+    echo started >> "$0".starts
+    echo '{"tree": "oneshot"}'
+    """))
+    workers = WorkerPool()
+    try:
+        results = [otk.external.call(State(""), "otk.external.test", {}, workers=workers) for _ in range(2)]
+    finally:
+        workers.close()
+    assert results == ["oneshot", "oneshot"]
+    assert (tmp_path / "test.starts").read_text() == "started\n" * 2
+
+
+def test_external_worker_exits(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_worker_external(tmp_path, "test")
+    workers = WorkerPool()
+    try:
+        otk.external.call(State(""), "otk.external.test", {}, workers=workers)
+        with pytest.raises(ExternalFailedError) as exc:
+            otk.external.call(State("foo.yaml"), "otk.external.test", "exit", workers=workers)
+        assert re.match(r"foo.yaml: call /.*/test 'otk.external.test' failed: worker exited", str(exc.value))
+        # a new worker is started for the next call
+        assert otk.external.call(State(""), "otk.external.test", {}, workers=workers) == "worker"
+    finally:
+        workers.close()
+
+
+def test_external_inprocess(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {}, inprocess=True)
+    assert res == f"otk {otk.__version__}"
+
+    # disabled the external has to be found in the search paths
+    with pytest.raises(RuntimeError) as exc:
+        otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {})
+    assert "could not find 'osbuild-make-generator-metadata' in any search path" in str(exc.value)
+
+
+def test_external_inprocess_keeps_input(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    tree = {
+        "packageset": {"const": {"internal": {"packages": [{"checksum": "sha256:1234"}]}}},
+        "gpgkeys": ["key"],
+        "options": {"rpm_stage": {}},
+    }
+    # the external adds to the options it is passed, in-process it gets a copy
+    res = otk.external.call(State(""), "otk.external.osbuild-make-depsolve-dnf4-rpm-stage", tree, inprocess=True)
+    assert res["options"] == {"gpgkeys": ["key"]}
+    assert tree["options"] == {"rpm_stage": {}}
+
+
+def test_external_inprocess_override(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_fake_external(tmp_path, "osbuild-make-generator-metadata", textwrap.dedent("""\
+    #!/bin/sh
+    echo '{"tree": "override"}'
+    """))
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {}, inprocess=True)
+    assert res == "override"
+
+
+def test_external_inprocess_bundled_program(tmp_path, monkeypatch):
+    # the search paths usually link to the program installed with otk
+    scripts = tmp_path / "bin"
+    scripts.mkdir()
+    program = make_fake_external(scripts, "osbuild-make-generator-metadata", textwrap.dedent("""\
+    #!/bin/sh
+    echo '{"tree": "program"}'
+    """))
+    (tmp_path / "osbuild-make-generator-metadata").symlink_to(program)
+    monkeypatch.setattr(otk.external.sysconfig, "get_path", lambda name: os.fspath(scripts))
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    monkeypatch.setattr(make_generator_metadata, "process", lambda tree: {"tree": "in-process"})
+
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {}, inprocess=True)
+    assert res == "in-process"
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {})
+    assert res == "program"
+
+
+def test_external_inprocess_bundled_entry_point(tmp_path, monkeypatch):
+    # installations copy the installed entry points, e.g. to
+    # /usr/libexec/otk/external, and drop the ones in the scripts directory
+    libexec = tmp_path / "libexec"
+    libexec.mkdir()
+    make_fake_external(libexec, "osbuild-make-generator-metadata", textwrap.dedent("""\
+    #!/usr/bin/python3
+    # -*- coding: utf-8 -*-
+    import re
+    import sys
+    from otk_external_osbuild.command.make_generator_metadata import main
+    if __name__ == '__main__':
+        sys.argv[0] = re.sub(r'(-script\\.pyw|\\.exe)?$', '', sys.argv[0])
+        sys.exit(main())
+    """))
+    # an entry point of another bundled external is not the same program
+    make_fake_external(libexec, "osbuild-make-inline-source", textwrap.dedent("""\
+    #!/bin/sh
+    # from otk_external_osbuild.command.make_generator_metadata import main
+    echo '{"tree": "program"}'
+    """))
+    monkeypatch.setattr(otk.external.sysconfig, "get_path", lambda name: os.fspath(tmp_path / "bin"))
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(libexec))
+    monkeypatch.setattr(make_generator_metadata, "process", lambda tree: {"tree": "in-process"})
+
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", {}, inprocess=True)
+    assert res == "in-process"
+    res = otk.external.call(State(""), "otk.external.osbuild-make-inline-source", {}, inprocess=True)
+    assert res == "program"
+
+
+def test_external_inprocess_gets_copy(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+
+    def process(tree):
+        tree["const"]["changed"] = True
+        tree["list"].append(2)
+        return {"tree": tree}
+    monkeypatch.setattr(make_generator_metadata, "process", process)
+
+    tree = {"const": {}, "list": [1]}
+    res = otk.external.call(State(""), "otk.external.osbuild-make-generator-metadata", tree, inprocess=True)
+    assert res == {"const": {"changed": True}, "list": [1, 2]}
+    assert tree == {"const": {}, "list": [1]}
+
+
+def test_external_inprocess_error(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    tree = {"packagename": "missing", "packageset": {"const": {"internal": {"packages": []}}}}
+    with pytest.raises(ExternalFailedError) as exc:
+        otk.external.call(State("foo.yaml"), "otk.external.osbuild-get-dnf4-package-info", tree, inprocess=True)
+    assert str(exc.value) == (
+        "foo.yaml: call osbuild-get-dnf4-package-info 'otk.external.osbuild-get-dnf4-package-info' failed: "
+        "KeyError('cannot find package missing')")
+
+
+def test_external_inprocess_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    cache = ExternalCache(DiskCache(tmp_path / "cache", 1024 * 1024))
+    tree = {"const": {"files": {"a": {"id": "sha256:1234", "data": "YQ=="}}}}
+
+    for _ in range(2):
+        res = otk.external.call(State(""), "otk.external.osbuild-make-inline-source", tree, cache, inprocess=True)
+        assert res == {"org.osbuild.inline": {"items": {"sha256:1234": {"encoding": "base64", "data": "YQ=="}}}}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_external_index_memoized(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    exe = make_fake_external(tmp_path, "test", "#!/bin/sh\n")
+    assert path_for("test") == exe
+
+    # found externals are not checked again
+    def no_access(*args):
+        raise AssertionError("unexpected access()")
+    monkeypatch.setattr(otk.external.os, "access", no_access)
+    assert path_for("test") == exe
+    assert external_index() is external_index()
+
+
+def test_external_index_refreshed(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", f"{tmp_path}/dir1:{tmp_path}/dir2")
+    (tmp_path / "dir1").mkdir()
+    (tmp_path / "dir2").mkdir()
+    index = external_index()
+    with pytest.raises(RuntimeError):
+        path_for("test")
+    # a changed directory is read again, the first match wins
+    make_fake_external(tmp_path / "dir2", "test", "#!/bin/sh\n")
+    exe = make_fake_external(tmp_path / "dir1", "test", "#!/bin/sh\n")
+    assert path_for("test") == exe
+    assert external_index() is index
+
+    # a changed search path is a new index
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", f"{tmp_path}/dir2")
+    assert external_index() is not index
+    assert path_for("test") == tmp_path / "dir2/test"
+
+
+def test_external_index_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    exe = make_fake_external(tmp_path, "test", "#!/bin/sh\n")
+    (tmp_path / "not-executable").write_text("")
+    assert write_index(tmp_path) == ["test"]
+    assert json.loads((tmp_path / EXTERNAL_INDEX_FILE).read_text()) == {"externals": ["test"]}
+
+    # only what is in the index is found
+    make_fake_external(tmp_path, "other", "#!/bin/sh\n")
+    assert path_for("test") == exe
+    with pytest.raises(RuntimeError):
+        path_for("other")
+
+    # a broken index falls back to listing the directory
+    (tmp_path / EXTERNAL_INDEX_FILE).unlink()
+    (tmp_path / EXTERNAL_INDEX_FILE).write_text("{broken")
+    assert path_for("other") == tmp_path / "other"
+
+
+def test_references_replace():
+    # larger than a reference
+    references = References(min_size=300)
+    try:
+        shared = [{"name": f"package-{i}"} for i in range(20)]
+        tree = {"small": [1], "a": {"packages": shared}, "b": [shared, "x" * 50]}
+        replaced = references.replace(tree)
+        ref = replaced["a"]["packages"]
+        assert set(ref) == {"otk.ref"}
+        with open(ref["otk.ref"]["path"], encoding="utf8") as fp:
+            assert json.load(fp) == shared
+        # the same value is the same reference, the rest is inline
+        assert replaced["small"] == [1]
+        assert replaced["b"][0] is ref
+        assert replaced["b"][1] == "x" * 50
+        # the original tree is left alone
+        assert tree["a"]["packages"] is shared
+        path = ref["otk.ref"]["path"]
+    finally:
+        references.close()
+    assert not os.path.exists(path)
+
+
+def test_references_replace_changed_in_place():
+    references = References(min_size=300)
+    try:
+        shared = {f"package-{i}": i for i in range(40)}
+        first = references.replace({"a": shared})["a"]
+        # e.g. a later otk.define adds to a defined value
+        shared["zzz"] = 1
+        second = references.replace({"a": shared})["a"]
+        assert first != second
+        with open(second["otk.ref"]["path"], encoding="utf8") as fp:
+            assert json.load(fp) == shared
+        # equal content is the same reference
+        assert references.replace({"b": dict(shared)})["b"] is second
+    finally:
+        references.close()
+
+
+def test_references_replace_deep_tree():
+    references = References(min_size=300)
+    try:
+        depth = sys.getrecursionlimit() * 5
+        tree: list = ["x" * 400]
+        for _ in range(depth):
+            tree = [{"a": tree}]
+        replaced = references.replace({"deep": tree})["deep"]
+        # values that contain references become large again every few levels
+        refs = 0
+
+        def deref(value):
+            nonlocal refs
+            if isinstance(value, dict) and "otk.ref" in value:
+                refs += 1
+                with open(value["otk.ref"]["path"], encoding="utf8") as fp:
+                    return json.load(fp)
+            return value
+
+        for _ in range(depth):
+            replaced = deref(deref(deref(replaced)[0])["a"])
+        assert replaced == ["x" * 400]
+        assert refs > depth / 20
+    finally:
+        references.close()
+
+
+def test_references_replace_write_error(monkeypatch):
+    references = References(min_size=300)
+    try:
+        def no_space(*args, **kwargs):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        monkeypatch.setattr(otk.external.tempfile, "mkstemp", no_space)
+        # values that can't be written are passed inline
+        tree = {"a": [{"name": f"package-{i}"} for i in range(20)]}
+        assert references.replace(tree) == tree
+    finally:
+        references.close()
+
+
+def test_external_references(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_fake_external(tmp_path, "test", textwrap.dedent("""\
+    #!/bin/sh
+    cat >> "$0".stdin
+    echo >> "$0".stdin
+    echo '{"tree": "result", "references": true}'
+    """))
+    references = References(min_size=20)
+    tree = {"packages": ["pkg1", "pkg2", "pkg3", "pkg4"]}
+    try:
+        for _ in range(2):
+            otk.external.call(State(""), "otk.external.test", tree, references=references)
+        first, second = [json.loads(line) for line in fake_external_path.with_suffix(".stdin").read_text().splitlines()]
+        assert first == {"tree": tree}
+        path = second["tree"]["packages"]["otk.ref"]["path"]
+        with open(path, encoding="utf8") as fp:
+            assert json.load(fp) == tree["packages"]
+    finally:
+        references.close()
+
+
+def test_external_files(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external_path = make_fake_external(tmp_path, "test", textwrap.dedent("""\
+    #!/bin/sh
+    if [ -n "$OTK_EXTERNAL_INPUT" ]; then
+        cat "$OTK_EXTERNAL_INPUT" > "$0".input
+        echo '{"tree": "files"}' > "$OTK_EXTERNAL_OUTPUT"
+    else
+        echo '{"tree": "stdin", "files": true}'
+    fi
+    """))
+    files = FileTransport()
+    tree = {"packages": ["pkg1", "pkg2"]}
+    results = [otk.external.call(State(""), "otk.external.test", tree, files=files) for _ in range(2)]
+    assert results == ["stdin", "files"]
+    assert json.loads(fake_external_path.with_suffix(".input").read_text()) == {"tree": tree}
+
+
+@pytest.mark.parametrize("fail", ["TemporaryDirectory", "open"])
+def test_external_files_write_error(tmp_path, monkeypatch, fail):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_fake_external(tmp_path, "test", textwrap.dedent("""\
+    #!/bin/sh
+    if [ -n "$OTK_EXTERNAL_INPUT" ]; then
+        echo '{"tree": "files"}' > "$OTK_EXTERNAL_OUTPUT"
+    else
+        echo '{"tree": "stdin", "files": true}'
+    fi
+    """))
+    files = FileTransport()
+    otk.external.call(State(""), "otk.external.test", {}, files=files)
+
+    def no_space(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    if fail == "open":
+        monkeypatch.setattr(otk.external, "open", no_space, raising=False)
+    else:
+        monkeypatch.setattr(otk.external.tempfile, fail, no_space)
+    # requests that can't be written are passed on stdin
+    assert otk.external.call(State(""), "otk.external.test", {}, files=files) == "stdin"
+
+
+def test_external_files_no_output(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    make_fake_external(tmp_path, "test", textwrap.dedent("""\
+    #!/bin/sh
+    echo '{"tree": "stdin", "files": true}'
+    """))
+    files = FileTransport()
+    otk.external.call(State(""), "otk.external.test", {}, files=files)
+    with pytest.raises(ExternalFailedError) as exc:
+        otk.external.call(State("foo.yaml"), "otk.external.test", {}, files=files)
+    assert re.match(r"foo.yaml: call /.*/test 'otk.external.test' failed: no output written", str(exc.value))
@@ -0,0 +1,86 @@
+import io
+import json
+import sys
+
+from otk.external import References
+
+from otk_external_osbuild.command.get_dnf4_package_info import root
+from otk_external_osbuild.protocol import dereference, run
+
+fake_input = {
+    "tree": {
+        "packagename": "pkg1",
+        "packageset": {
+            "const": {
+                "internal": {
+                    "packages": [
+                        {"name": "pkg1", "version": "1", "release": "fc30", "arch": "c64"},
+                    ]
+                }
+            }
+        }
+    }
+}
+
+expected_tree = {"name": "pkg1", "version": "1", "release": "fc30", "arch": "c64"}
+
+
+def test_run_oneshot_advertises_worker(monkeypatch, capsys):
+    monkeypatch.delenv("OTK_EXTERNAL_WORKER", raising=False)
+    monkeypatch.setattr(sys, "stdin", io.StringIO(json.dumps(fake_input)))
+    run(root)
+    output = json.loads(capsys.readouterr().out)
+    assert output == {"tree": expected_tree, "cacheable": True, "worker": True, "references": True, "files": True}
+
+
+def test_run_files(monkeypatch, capsys, tmp_path):
+    monkeypatch.delenv("OTK_EXTERNAL_WORKER", raising=False)
+    input_path = tmp_path / "input.json"
+    input_path.write_text(json.dumps(fake_input))
+    output_path = tmp_path / "output.json"
+    monkeypatch.setenv("OTK_EXTERNAL_INPUT", str(input_path))
+    monkeypatch.setenv("OTK_EXTERNAL_OUTPUT", str(output_path))
+    monkeypatch.setattr(sys, "stdin", io.StringIO(""))
+    run(root)
+    assert capsys.readouterr().out == ""
+    assert json.loads(output_path.read_text())["tree"] == expected_tree
+
+
+def test_run_worker(monkeypatch, capsys):
+    monkeypatch.setenv("OTK_EXTERNAL_WORKER", "1")
+    monkeypatch.setattr(sys, "stdin", io.StringIO((json.dumps(fake_input) + "\n") * 2))
+    run(root)
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == [{"tree": expected_tree, "cacheable": True}] * 2
+
+
+def test_run_references(monkeypatch, capsys):
+    monkeypatch.setenv("OTK_EXTERNAL_WORKER", "1")
+    references = References(min_size=1)
+    try:
+        request = {"tree": references.replace(fake_input["tree"])}
+        assert "otk.ref" in request["tree"]["packageset"]
+        monkeypatch.setattr(sys, "stdin", io.StringIO((json.dumps(request) + "\n") * 2))
+        run(root)
+    finally:
+        references.close()
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == [{"tree": expected_tree, "cacheable": True}] * 2
+
+
+def test_dereference(tmp_path):
+    path = tmp_path / "ref.json"
+    path.write_text(json.dumps([1, 2]))
+    ref = {"otk.ref": {"path": str(path), "sha256": "test_dereference"}}
+    assert dereference({"a": ref, "b": [ref, {"otk.ref": "not-a-ref", "c": 1}]}) == {
+        "a": [1, 2], "b": [[1, 2], {"otk.ref": "not-a-ref", "c": 1}]}
+    # read only once
+    path.unlink()
+    assert dereference([ref]) == [[1, 2]]
+
+
+def test_dereference_object_hook(tmp_path):
+    path = tmp_path / "ref.json"
+    path.write_text(json.dumps([{"a": 1, "b": 2}]))
+    ref = {"otk.ref": {"path": str(path), "sha256": "test_dereference_object_hook"}}
+    assert dereference({"x": ref}, lambda obj: {"a": obj["a"]} if "a" in obj else obj) == {"x": [{"a": 1}]}
@@ -1,8 +1,16 @@
+import fcntl
+import hashlib
 import json
+import os
+import pathlib
 import subprocess
+import time
 from io import StringIO
 from unittest.mock import call, Mock, patch
 
+import pytest
+
+from otk_external_osbuild.command import gen_depsolve_dnf4
 from otk_external_osbuild.command.gen_depsolve_dnf4 import root
 
 # pylint: disable=line-too-long
@@ -75,17 +83,22 @@ def make_dnfjson_mock_run_result():
 
 
 @patch("subprocess.run")
-def test_gen_depsolve_dnf4_call_out(mocked_run):
+def test_gen_depsolve_dnf4_call_out(mocked_run, tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path))
+    monkeypatch.setattr(gen_depsolve_dnf4, "repo_revision", lambda repo: None)
     mocked_run.return_value = make_dnfjson_mock_run_result()
 
+    root(StringIO(json.dumps(fake_input)))
+    # a cache directory for the repositories
+    [entry] = tmp_path.iterdir()
     expected_dnfjson_input = json.dumps({
         "command": "depsolve",
         "arch": "x86_64",
         "module_platform_id": "platform:f40",
         "releasever": "40",
-        "cachedir": "/tmp",
+        "cachedir": os.fspath(entry),
         "arguments": {
-            "root_dir": "/tmp",
+            "root_dir": os.fspath(entry / "root"),
             "repos": fake_input["tree"]["repositories"],
             "transactions": [
                 {
@@ -95,7 +108,6 @@ def test_gen_depsolve_dnf4_call_out(mocked_run):
             ],
         },
     })
-    root(StringIO(json.dumps(fake_input)))
     assert len(mocked_run.call_args_list) == 1
     assert mocked_run.call_args_list[0] == call(
         ["/usr/libexec/osbuild-depsolve-dnf"],
@@ -105,3 +117,242 @@ def test_gen_depsolve_dnf4_call_out(mocked_run):
         encoding="utf8",
         check=False,
     )
+
+
+def test_gen_depsolve_dnf4_batch_under_test_mock_data(monkeypatch, capsys):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    root(StringIO(json.dumps(fake_input)))
+    single = json.loads(capsys.readouterr().out)["tree"]
+
+    tree = dict(fake_input["tree"])
+    packages = tree.pop("packages")
+    tree["packagesets"] = {
+        "os": packages,
+        "build": {"include": ["pkg3"], "exclude": []},
+        "other": packages,
+    }
+    root(StringIO(json.dumps({"tree": tree})))
+    output = json.loads(capsys.readouterr().out)["tree"]
+    assert list(output) == ["os", "build", "other"]
+    assert output["os"] == single
+    assert output["other"] == single
+    assert [p["name"] for p in output["build"]["const"]["internal"]["packages"]][1:] == ["pkg3"]
+
+
+@patch("subprocess.run")
+def test_gen_depsolve_dnf4_batch_call_out(mocked_run, monkeypatch):
+    monkeypatch.setattr(gen_depsolve_dnf4, "repo_revision", lambda repo: None)
+    mocked_run.return_value = make_dnfjson_mock_run_result()
+
+    tree = dict(fake_input["tree"])
+    packages = tree.pop("packages")
+    tree["packagesets"] = {
+        "build": {"include": ["pkg3"]},
+        "os": packages,
+        "other": packages,
+    }
+    root(StringIO(json.dumps({"tree": tree})))
+    # identical package sets are only solved once, each one on its own
+    requests = [json.loads(c.kwargs["input"]) for c in mocked_run.call_args_list]
+    assert sorted(r["arguments"]["transactions"][0]["package-specs"] for r in requests) == [["pkg1"], ["pkg3"]]
+    assert all(len(r["arguments"]["transactions"]) == 1 for r in requests)
+
+
+def test_gen_depsolve_dnf4_batch_and_single(monkeypatch):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    tree = dict(fake_input["tree"])
+    tree["packagesets"] = {"os": tree["packages"]}
+    with pytest.raises(ValueError) as exc:
+        root(StringIO(json.dumps({"tree": tree})))
+    assert str(exc.value) == "only one of 'packages' and 'packagesets' can be given"
+
+
+def test_gen_depsolve_dnf4_cache_hit_and_miss(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path))
+
+    root(StringIO(json.dumps(fake_input)))
+    miss = capsys.readouterr().out
+    [entry] = tmp_path.iterdir()
+    metadata = entry / "mock-metadata.json"
+    assert json.loads(metadata.read_text()) == fake_input["tree"]["repositories"]
+
+    # the next depsolve uses the cached metadata
+    mtime = metadata.stat().st_mtime_ns
+    tree = dict(fake_input["tree"], packages={"include": ["pkg3"], "exclude": []})
+    root(StringIO(json.dumps({"tree": tree})))
+    assert capsys.readouterr().out != miss
+    assert metadata.stat().st_mtime_ns == mtime
+    assert list(tmp_path.iterdir()) == [entry]
+
+    # different repositories get their own entry
+    tree = dict(fake_input["tree"], releasever="41")
+    root(StringIO(json.dumps({"tree": tree})))
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_gen_depsolve_dnf4_cache_no_cache(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path / "metadata"))
+    monkeypatch.setenv("OTK_NO_CACHE", "1")
+
+    root(StringIO(json.dumps(fake_input)))
+    assert json.loads(capsys.readouterr().out)["tree"]["const"]["internal"]["packages"]
+    assert not (tmp_path / "metadata").exists()
+
+
+def test_gen_depsolve_dnf4_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path))
+    old = tmp_path / "old"
+    (old / "root").mkdir(parents=True)
+    recent = tmp_path / "recent"
+    recent.mkdir()
+    long_ago = time.time() - gen_depsolve_dnf4.CACHE_MAX_AGE - 60
+    os.utime(old, (long_ago, long_ago))
+
+    root(StringIO(json.dumps(fake_input)))
+    assert not old.exists()
+    assert recent.exists()
+
+
+def test_gen_depsolve_dnf4_cache_entry_locked(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path))
+    tree = fake_input["tree"]
+    with gen_depsolve_dnf4.cache_entry(tree) as entry:
+        with pytest.raises(BlockingIOError):
+            fcntl.flock(os.open(entry / ".lock", os.O_RDONLY), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        # entries in use are never evicted
+        os.utime(entry, (0, 0))
+        gen_depsolve_dnf4.evict(tmp_path)
+        assert entry.exists()
+    with gen_depsolve_dnf4.cache_entry(tree, exclusive=False) as entry:
+        with gen_depsolve_dnf4.cache_entry(tree, exclusive=False) as other:
+            assert other == entry
+
+
+def sha256(data):
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+@patch("subprocess.run")
+def test_gen_depsolve_dnf4_result_cache(mocked_run, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path / "metadata"))
+    monkeypatch.setenv("OTK_DEPSOLVE_RESULT_DIR", os.fspath(tmp_path / "results"))
+    # the repomd.xml that is looked up and the one the depsolver loads
+    repomd = {"lookup": "rev1", "loaded": "rev1"}
+    monkeypatch.setattr(gen_depsolve_dnf4, "repo_revision", lambda repo: sha256(repomd["lookup"]))
+
+    def run(_args, **kwargs):
+        request = json.loads(kwargs["input"])
+        repodata = pathlib.Path(request["cachedir"]) / "BaseOS-0123456789abcdef" / "repodata"
+        repodata.mkdir(parents=True, exist_ok=True)
+        (repodata / "repomd.xml").write_text(repomd["loaded"])
+        return make_dnfjson_mock_run_result()
+    mocked_run.side_effect = run
+
+    for _ in range(2):
+        root(StringIO(json.dumps(fake_input)))
+        assert json.loads(capsys.readouterr().out)["tree"]["const"]["internal"]["packages"] == ["pkg1", "dep-pkg1"]
+    assert len(mocked_run.call_args_list) == 1
+    [path] = (tmp_path / "results").iterdir()
+    result = json.loads(path.read_text())
+    assert result["request"]["revisions"] == [sha256("rev1")]
+    assert result["packages"] == ["pkg1", "dep-pkg1"]
+
+    # a new revision of the repositories is solved again
+    repomd.update(lookup="rev2", loaded="rev2")
+    root(StringIO(json.dumps(fake_input)))
+    assert len(mocked_run.call_args_list) == 2
+
+    # results are stored for the metadata the depsolver loaded
+    repomd.update(lookup="rev3")
+    root(StringIO(json.dumps(fake_input)))
+    assert len(mocked_run.call_args_list) == 3
+    root(StringIO(json.dumps(fake_input)))
+    assert len(mocked_run.call_args_list) == 4
+    repomd.update(lookup="rev2")
+    root(StringIO(json.dumps(fake_input)))
+    assert len(mocked_run.call_args_list) == 4
+
+    # results that don't match their checksum are not used
+    result["packages"] = ["pkg1"]
+    path.write_text(json.dumps(result))
+    repomd.update(lookup="rev1", loaded="rev1")
+    root(StringIO(json.dumps(fake_input)))
+    assert len(mocked_run.call_args_list) == 5
+
+
+@patch("subprocess.run")
+def test_gen_depsolve_dnf4_result_cache_no_cache(mocked_run, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path / "metadata"))
+    monkeypatch.setenv("OTK_DEPSOLVE_RESULT_DIR", os.fspath(tmp_path / "results"))
+    monkeypatch.setenv("OTK_NO_CACHE", "1")
+    monkeypatch.setattr(gen_depsolve_dnf4, "repo_revision", lambda repo: "rev1")
+    mocked_run.return_value = make_dnfjson_mock_run_result()
+
+    for _ in range(2):
+        root(StringIO(json.dumps(fake_input)))
+        assert json.loads(capsys.readouterr().out)["tree"]["const"]["internal"]["packages"] == ["pkg1", "dep-pkg1"]
+    assert len(mocked_run.call_args_list) == 2
+    assert not (tmp_path / "results").exists()
+
+
+def test_gen_depsolve_dnf4_result_cache_seeded(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    monkeypatch.setenv("OTK_DEPSOLVE_RESULT_DIR", os.fspath(tmp_path))
+    request = gen_depsolve_dnf4.result_request(fake_input["tree"], fake_input["tree"]["packages"])
+    gen_depsolve_dnf4.store_result(request, [{"name": "seeded"}])
+
+    root(StringIO(json.dumps(fake_input)))
+    output = json.loads(capsys.readouterr().out)
+    assert output["tree"]["const"]["internal"]["packages"] == [{"name": "seeded"}]
+
+
+def test_gen_depsolve_dnf4_batch_result_cache_seeded(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("OTK_UNDER_TEST", "1")
+    monkeypatch.setenv("OTK_DEPSOLVE_CACHE_DIR", os.fspath(tmp_path / "metadata"))
+    monkeypatch.setenv("OTK_DEPSOLVE_RESULT_DIR", os.fspath(tmp_path / "results"))
+    tree = dict(fake_input["tree"])
+    packages = tree.pop("packages")
+    request = gen_depsolve_dnf4.result_request(tree, packages)
+    gen_depsolve_dnf4.store_result(request, [{"name": "seeded"}])
+
+    locks = []
+    cache_entry = gen_depsolve_dnf4.cache_entry
+
+    def locked_cache_entry(tree, exclusive=True):
+        locks.append(exclusive)
+        return cache_entry(tree, exclusive)
+    monkeypatch.setattr(gen_depsolve_dnf4, "cache_entry", locked_cache_entry)
+
+    tree["packagesets"] = {
+        "os": packages,
+        "build": {"include": ["pkg3"], "exclude": []},
+        "other": {"include": ["pkg4"], "exclude": []},
+    }
+    root(StringIO(json.dumps({"tree": tree})))
+    output = json.loads(capsys.readouterr().out)["tree"]
+    assert output["os"]["const"]["internal"]["packages"] == [{"name": "seeded"}]
+    # the first package set that is not cached fills the metadata cache
+    assert locks == [True, False]
+
+
+def test_gen_depsolve_dnf4_repo_revision(tmp_path):
+    (tmp_path / "repodata").mkdir()
+    (tmp_path / "repodata/repomd.xml").write_text("<repomd/>")
+    rev = gen_depsolve_dnf4.repo_revision({"id": "a", "baseurl": tmp_path.as_uri()})
+    assert rev == "50095c0dd3ea786b68ccdfc6eaf4a30f893ab83aa88d29bdd787e957b888cb48"
+    assert gen_depsolve_dnf4.repo_revision({"id": "a", "baseurl": [tmp_path.as_uri()]}) == rev
+    assert gen_depsolve_dnf4.repo_revision({"id": "a", "metalink": "https://example.com"}) is None
+    assert gen_depsolve_dnf4.repo_revision({"id": "a", "baseurl": (tmp_path / "missing").as_uri()}) is None
+
+
+def test_gen_depsolve_dnf4_loaded_revisions(tmp_path):
+    for name, data in [("BaseOS-0123456789abcdef", "base"), ("BaseOS-extra-0123456789abcdef", "extra")]:
+        (tmp_path / name / "repodata").mkdir(parents=True)
+        (tmp_path / name / "repodata/repomd.xml").write_text(data)
+    repos = [{"id": "BaseOS"}, {"id": "BaseOS-extra"}]
+    assert gen_depsolve_dnf4.loaded_revisions(tmp_path, repos) == [sha256("base"), sha256("extra")]
+    # repositories without metadata in the cache
+    assert gen_depsolve_dnf4.loaded_revisions(tmp_path, repos + [{"id": "AppStream"}]) is None
@@ -1,8 +1,11 @@
+import base64
+import hashlib
 import json
 import os
 from io import StringIO
 
 import pytest
+from otk_external_osbuild.command import gen_inline_files
 from otk_external_osbuild.command.gen_inline_files import root
 
 test_input = {
@@ -90,3 +93,112 @@ def test_gen_inline_files_name_collision():
     with pytest.raises(KeyError) as exc:
         root(StringIO(json.dumps(input_with_collisions)))
     assert exc.value.args[0] == "duplicate name found for inline files: dupe"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 7, 3 * 256 * 1024])
+def test_gen_inline_files_chunks(tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(gen_inline_files, "CHUNK_SIZE", chunk_size)
+    contents = {
+        "empty": b"",
+        "short": b"ab",
+        "binary": bytes(range(256)) * 5 + b"\r\n",
+        "text": "line\r\nother line \N{SNOWMAN}\r\n".encode("utf-8") * 7,
+    }
+    paths = {}
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+        paths[name] = {"path": os.fspath(tmp_path / name), "type": "text" if name == "text" else "binary"}
+
+    files = gen_inline_files.process({"paths": paths})["tree"]["const"]["files"]
+    assert list(files) == list(contents)
+    for name, data in contents.items():
+        if name == "text":
+            # text is read with universal newlines
+            data = data.replace(b"\r\n", b"\n")
+        assert files[name] == {
+            "id": f"sha256:{hashlib.sha256(data).hexdigest()}",
+            "data": base64.b64encode(data).decode("ascii"),
+        }
+
+
+def test_gen_inline_files_invalid_type():
+    with pytest.raises(ValueError) as exc:
+        gen_inline_files.process({"paths": {"foo": {"path": "/does/not/matter", "type": "other"}}})
+    assert str(exc.value) == "invalid type for inline path /does/not/matter: other"
+
+
+def inline_path(path):
+    return {"paths": {"file": {"path": os.fspath(path), "type": "binary"}}}
+
+
+def cache_entries():
+    return [entry for entry in gen_inline_files.cache_dir().iterdir() if not entry.name.startswith(".")]
+
+
+def test_gen_inline_files_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(gen_inline_files, "EVICT_VANISHED_INTERVAL", 0)
+    path = tmp_path / "file"
+    path.write_bytes(b"contents")
+    expected = gen_inline_files.process(inline_path(path))
+    assert len(cache_entries()) == 1
+
+    # unchanged files are not read again
+    def fail(*args):
+        raise AssertionError(f"unexpected read {args}")
+    with monkeypatch.context() as mp:
+        mp.setattr(gen_inline_files, "process_path", fail)
+        assert gen_inline_files.process(inline_path(path)) == expected
+
+    # changed files are, their old entry is evicted
+    path.write_bytes(b"other contents")
+    os.utime(path, ns=(0, 0))
+    res = gen_inline_files.process(inline_path(path))
+    assert res["tree"]["const"]["files"]["file"]["data"] == base64.b64encode(b"other contents").decode()
+    assert len(cache_entries()) == 1
+
+
+def test_gen_inline_files_cache_no_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_NO_CACHE", "1")
+    path = tmp_path / "file"
+    path.write_bytes(b"contents")
+    res = gen_inline_files.process(inline_path(path))
+    assert res["tree"]["const"]["files"]["file"]["data"] == base64.b64encode(b"contents").decode()
+    assert not gen_inline_files.cache_dir().exists()
+
+
+def test_gen_inline_files_cache_vanished(tmp_path, monkeypatch):
+    path = tmp_path / "file"
+    path.write_bytes(b"contents")
+    gen_inline_files.process(inline_path(path))
+    path.unlink()
+    other = tmp_path / "other"
+    other.write_bytes(b"other")
+
+    # the cache is only searched for vanished files once in a while
+    gen_inline_files.process(inline_path(other))
+    assert len(cache_entries()) == 2
+
+    monkeypatch.setattr(gen_inline_files, "EVICT_VANISHED_INTERVAL", 0)
+    gen_inline_files.process(inline_path(other))
+    entries = cache_entries()
+    assert len(entries) == 1
+    assert entries[0].read_bytes().startswith(json.dumps({"path": os.path.realpath(other)}).encode()[:-1])
+
+
+def test_gen_inline_files_cache_verify(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv("OTK_INLINE_FILES_CACHE_DIR", os.fspath(tmp_path / "cache"))
+    path = tmp_path / "file"
+    path.write_bytes(b"contents")
+    expected = gen_inline_files.process(inline_path(path))
+    entry, = cache_entries()
+    head, body = entry.read_bytes().split(b"\n", 1)
+    entry.write_bytes(head + b"\n" + body.replace(b"sha256:", b"sha256:corrupt"))
+
+    # without verification the entry is trusted
+    assert gen_inline_files.process(inline_path(path)) != expected
+    monkeypatch.setenv("OTK_INLINE_FILES_VERIFY", "1")
+    assert gen_inline_files.process(inline_path(path)) == expected
+    assert "did not match its contents" in caplog.text
+    # and replaced
+    monkeypatch.delenv("OTK_INLINE_FILES_VERIFY")
+    assert gen_inline_files.process(inline_path(path)) == expected
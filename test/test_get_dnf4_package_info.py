@@ -1,7 +1,11 @@
 import json
+import os
 from io import StringIO
 
-from otk_external_osbuild.command.get_dnf4_package_info import root
+import pytest
+
+from otk_external_osbuild.command.get_dnf4_package_info import index_packages, process, root
+from otk_external_osbuild.protocol import dereference
 
 
 fake_input = {
@@ -40,5 +44,68 @@ def test_make_depsolve_dnf4_curl_source(capsys):
             "version": "1",
             "release": "fc30",
             "arch": "c64",
-        }
+        },
+        "cacheable": True,
+    }
+
+
+def make_packageset(packages):
+    return {"const": {"internal": {"packages": packages}}}
+
+
+def test_get_dnf4_package_info_batch():
+    packages = fake_input["tree"]["packageset"]["const"]["internal"]["packages"]
+    output = process({"packagenames": ["bar", "foo"], "packageset": make_packageset(packages)})
+    assert output == {
+        "tree": {
+            "bar": {"name": "bar", "version": "2", "release": "fc40", "arch": "c128"},
+            "foo": {"name": "foo", "version": "1", "release": "fc30", "arch": "c64"},
+        },
+        "cacheable": True,
     }
+
+
+def test_get_dnf4_package_info_batch_mapping():
+    packages = fake_input["tree"]["packageset"]["const"]["internal"]["packages"]
+    output = process({"packagenames": {"a": "foo", "b": "foo"}, "packageset": make_packageset(packages)})
+    info = {"name": "foo", "version": "1", "release": "fc30", "arch": "c64"}
+    assert output["tree"] == {"a": info, "b": info}
+
+
+def test_get_dnf4_package_info_batch_missing():
+    packages = fake_input["tree"]["packageset"]["const"]["internal"]["packages"]
+    with pytest.raises(KeyError) as exc:
+        process({"packagenames": ["foo", "baz"], "packageset": make_packageset(packages)})
+    assert "cannot find package baz" in str(exc.value)
+
+
+def test_get_dnf4_package_info_name_and_names():
+    with pytest.raises(ValueError):
+        process({"packagename": "foo", "packagenames": ["foo"], "packageset": make_packageset([])})
+
+
+def test_get_dnf4_package_info_multiple_arches():
+    packages = [
+        {"name": "glibc", "version": "2", "release": "1", "arch": "i686"},
+        {"name": "glibc", "version": "2", "release": "1", "arch": "x86_64"},
+        {"name": "tzdata", "version": "3", "release": "1", "arch": "noarch"},
+    ]
+    tree = {"packagename": "glibc", "packageset": make_packageset(packages)}
+    # without an architecture the first one wins, like before
+    assert process(tree)["tree"]["arch"] == "i686"
+    assert process({**tree, "architecture": "x86_64"})["tree"]["arch"] == "x86_64"
+    assert process({**tree, "packagename": "tzdata", "architecture": "x86_64"})["tree"]["arch"] == "noarch"
+
+
+def test_get_dnf4_package_info_index_reused(tmp_path):
+    packages = [{"name": "foo", "version": "1", "release": "1", "arch": "noarch"}]
+    # only package sets passed by reference are remembered
+    assert index_packages(packages) is not index_packages(packages)
+
+    path = tmp_path / "ref.json"
+    path.write_text(json.dumps(packages))
+    ref = {"otk.ref": {"path": os.fspath(path), "sha256": "test_get_dnf4_package_info_index_reused"}}
+    referenced = dereference(ref)
+    assert index_packages(referenced) is index_packages(dereference(ref))
+    # an equal list that was not passed by reference is indexed on its own
+    assert index_packages(referenced) is not index_packages(list(referenced))
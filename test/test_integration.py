@@ -1,10 +1,14 @@
+import json
 import logging
 import os
+import sys
 import textwrap
 
 import pytest
 
+from otk.cache import cache_home
 from otk.command import run
+from otk.error import ExternalFailedError
 
 
 TEST_OTK = """
@@ -53,8 +57,6 @@ def test_otk_define_empty(tmp_path, caplog):
       otk.define:
     """))
     run(["validate", os.fspath(test_otk)])
-    # note that this will appear twice because we resolve the otk file
-    # twice
     expected_msg = f"empty otk.define in {test_otk}"
     assert expected_msg in [rec.message for rec in caplog.records]
 
@@ -66,6 +68,427 @@ def test_verbose_logs_processed_files(tmp_path, caplog):
     test_otk.write_text(TEST_OTK)
     run(["validate", os.fspath(test_otk)])
 
-    # note that this will appear twice as we resolve the otk file twice
     expected_msg = f"resolving {test_otk}"
-    assert expected_msg in [rec.message for rec in caplog.records]
+    assert [expected_msg] == [rec.message for rec in caplog.records if rec.message.startswith("resolving")]
+
+
+@pytest.mark.parametrize("cache_arg,expect_cached", [
+    ([], True),
+    (["--no-cache"], False),
+])
+def test_parse_cache(tmp_path, cache_arg, expect_cached):
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(TEST_OTK)
+
+    run(["validate"] + cache_arg + [os.fspath(test_otk)])
+    parse_cache_dir = cache_home() / "parse"
+    assert parse_cache_dir.exists() == expect_cached
+
+
+@pytest.mark.parametrize("cache_arg,expected", [
+    ([], ""),
+    (["--no-cache"], "1"),
+])
+def test_compile_no_cache_externals(tmp_path, monkeypatch, cache_arg, expected):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    monkeypatch.delenv("OTK_NO_CACHE", raising=False)
+    fake_external = tmp_path / "env"
+    fake_external.write_text(textwrap.dedent("""\
+    #!/bin/sh
+    echo "{\\"tree\\": \\"$OTK_NO_CACHE\\"}"
+    """))
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.target.osbuild:
+      x:
+        otk.external.env: {}
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "--compact", "-o", os.fspath(output)] + cache_arg + [os.fspath(test_otk)]) == 0
+    assert json.loads(output.read_text())["x"] == expected
+    # externals are only told for the compile
+    assert "OTK_NO_CACHE" not in os.environ
+
+
+@pytest.mark.parametrize("target_arg", [[], ["-t", "osbuild"]])
+def test_compile_resolves_once(tmp_path, monkeypatch, target_arg):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "count"
+    fake_external.write_text(textwrap.dedent("""\
+    #!/bin/sh
+    echo called >> "$0".calls
+    echo '{"tree": {"value": "counted"}}'
+    """))
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      counted:
+        otk.external.count: {}
+    otk.target.osbuild:
+      x: ${counted.value}
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "-o", os.fspath(output)] + target_arg + [os.fspath(test_otk)]) == 0
+    assert output.read_text() == '{\n  "x": "counted",\n  "version": "2"\n}'
+    assert fake_external.with_suffix(".calls").read_text() == "called\n"
+
+
+def test_compile_multiple_targets_fails_before_resolving(tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "count"
+    fake_external.write_text(textwrap.dedent("""\
+    #!/bin/sh
+    echo called >> "$0".calls
+    echo '{"tree": {"value": "counted"}}'
+    """))
+    fake_external.chmod(0o755)
+
+    (tmp_path / "other.yaml").write_text(textwrap.dedent("""
+    otk.target.osbuild.other:
+      x: ${counted.value}
+    """))
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      counted:
+        otk.external.count: {}
+    otk.target.osbuild.one:
+      x: ${counted.value}
+    otk.include: other.yaml
+    """))
+    assert run(["compile", "-o", os.fspath(tmp_path / "out.json"), os.fspath(test_otk)]) == 1
+    assert "INPUT contains multiple targets, `-t` is required" in caplog.text
+    assert not fake_external.with_suffix(".calls").exists()
+
+
+@pytest.mark.parametrize("targets,ret", [
+    (["osbuild"], 0),
+    (["osbuild.one", "osbuild.two"], 1),
+])
+def test_compile_targets_found_when_resolving(tmp_path, caplog, targets, ret):
+    # targets in includes with variables in their path are only found by
+    # resolving
+    (tmp_path / "targets.yaml").write_text("\n".join(f"otk.target.{name}: {{x: y}}" for name in targets))
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      name: targets
+    otk.include: ${name}.yaml
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "--compact", "-o", os.fspath(output), os.fspath(test_otk)]) == ret
+    if ret == 0:
+        assert output.read_text() == '{"x":"y","version":"2"}'
+    else:
+        assert "INPUT contains multiple targets, `-t` is required" in caplog.text
+
+
+@pytest.mark.parametrize("compact_arg,expected", [
+    ([], '{\n  "x": "y",\n  "version": "2"\n}'),
+    (["--compact"], '{"x":"y","version":"2"}'),
+])
+def test_compile_compact(tmp_path, compact_arg, expected):
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.target.osbuild:
+      x: y
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "-o", os.fspath(output)] + compact_arg + [os.fspath(test_otk)]) == 0
+    assert output.read_text() == expected
+
+
+def test_compile_jobs_runs_externals_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    # each external waits (a while) for the other one to be started
+    for name, other in [("first", "second"), ("second", "first")]:
+        fake_external = tmp_path / name
+        fake_external.write_text(textwrap.dedent(f"""\
+        #!/bin/sh
+        touch "{tmp_path}/{name}.started"
+        for i in $(seq 100); do
+            [ -e "{tmp_path}/{other}.started" ] && break
+            sleep 0.1
+        done
+        [ -e "{tmp_path}/{other}.started" ] && echo '{{"tree": {{"saw": "{other}"}}}}' && exit 0
+        echo '{{"tree": {{"saw": "nothing"}}}}'
+        """))
+        fake_external.chmod(0o755)
+    # and one depends on the result of another
+    fake_external = tmp_path / "mirror"
+    fake_external.write_text("#!/bin/sh\ncat\n")
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      a:
+        otk.external.first: {}
+      b:
+        otk.external.second: {}
+      c:
+        otk.external.mirror:
+          saw: ${a.saw}
+    otk.target.osbuild:
+      a: ${a.saw}
+      b: ${b.saw}
+      c: ${c.saw}
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "-j", "2", "-o", os.fspath(output), os.fspath(test_otk)]) == 0
+    assert json.loads(output.read_text()) == {"a": "second", "b": "first", "c": "second", "version": "2"}
+
+
+@pytest.mark.parametrize("cache_arg", [[], ["--no-cache"]])
+def test_compile_iterative_deep_tree(tmp_path, cache_arg):
+    depth = 1500
+    deep = '"x"'
+    for _ in range(depth):
+        deep = '[{"a":' + deep + '}]'
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent(f"""
+    otk.version: 1
+    otk.define:
+      deep: {deep}
+    otk.target.osbuild:
+      deep: ${{deep}}
+      copy: {deep}
+    """))
+    output = tmp_path / "out.json"
+    for _ in range(2):
+        assert run(["compile", "--compact", "--resolver", "iterative"] + cache_arg +
+                   ["-o", os.fspath(output), os.fspath(test_otk)]) == 0
+        assert output.read_text() == '{"deep":' + deep + ',"copy":' + deep + ',"version":"2"}'
+
+
+@pytest.mark.parametrize("jobs", ["1", "4"])
+def test_compile_batched_lookups(tmp_path, monkeypatch, jobs):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "osbuild-get-dnf4-package-info"
+    fake_external.write_text(textwrap.dedent(f"""\
+    #!{sys.executable}
+    import json, sys
+    tree = json.load(sys.stdin)["tree"]
+    with open(sys.argv[0] + ".calls", "a") as fp:
+        print(json.dumps(tree, sort_keys=True), file=fp)
+    def info(name):
+        return {{"name": name, "set": tree["packageset"]}}
+    if "packagename" in tree:
+        print(json.dumps({{"tree": info(tree["packagename"])}}))
+    else:
+        names = tree["packagenames"]
+        names = names if isinstance(names, dict) else {{name: name for name in names}}
+        print(json.dumps({{"tree": {{key: info(name) for key, name in names.items()}}}}))
+    """))
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      kernel:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: os
+          packagename: kernel
+      other:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: other
+          packagename: kernel
+      more:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: os
+          packagenames:
+            - dracut
+            - grub2
+      named:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: os
+          packagenames:
+            boot: grub2
+    otk.target.osbuild:
+      kernel: ${kernel}
+      other: ${other}
+      more: ${more}
+      named: ${named}
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "--compact", "-j", jobs, "-o", os.fspath(output), os.fspath(test_otk)]) == 0
+    assert json.loads(output.read_text()) == {
+        "kernel": {"name": "kernel", "set": "os"},
+        "other": {"name": "kernel", "set": "other"},
+        "more": {"dracut": {"name": "dracut", "set": "os"}, "grub2": {"name": "grub2", "set": "os"}},
+        "named": {"boot": {"name": "grub2", "set": "os"}},
+        "version": "2",
+    }
+    # lookups in the same package set are done at once, one alone as it is
+    calls = [json.loads(line) for line in fake_external.with_suffix(".calls").read_text().splitlines()]
+    assert sorted(calls, key=lambda call: call["packageset"]) == [
+        {
+            "packageset": "os",
+            "packagenames": {"0": "kernel", "1.dracut": "dracut", "1.grub2": "grub2", "2.boot": "grub2"},
+        },
+        {"packageset": "other", "packagename": "kernel"},
+    ]
+
+
+def test_compile_batched_lookups_fail(tmp_path):
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      set:
+        const:
+          internal:
+            packages:
+              - {name: kernel, version: "1", release: "1", arch: x86_64}
+      kernel:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: ${set}
+          packagename: kernel
+      missing:
+        otk.external.osbuild-get-dnf4-package-info:
+          packageset: ${set}
+          packagename: missing
+    otk.target.osbuild:
+      kernel: ${kernel.version}
+    """))
+    # a lookup fails with the others it was done with
+    with pytest.raises(ExternalFailedError, match="cannot find package missing"):
+        run(["compile", "-o", os.fspath(tmp_path / "out.json"), os.fspath(test_otk)])
+
+
+def test_compile_jobs_same_output(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "echo-ext"
+    fake_external.write_text("#!/bin/sh\necho '{\"tree\": {\"v\": 1}}'\n")
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      packages:
+        os:
+          otk.external.echo-ext: {}
+        build: foo
+      other:
+        otk.external.echo-ext: {}
+      last: bar
+    otk.target.osbuild:
+      packages: ${packages}
+    """))
+    outputs = []
+    for jobs in ["1", "4"]:
+        output = tmp_path / f"out-{jobs}.json"
+        assert run(["compile", "--compact", "-j", jobs, "-o", os.fspath(output), os.fspath(test_otk)]) == 0
+        outputs.append(output.read_bytes())
+    assert outputs[0] == outputs[1]
+    assert json.loads(outputs[0])["packages"] == {"os": {"v": 1}, "build": "foo"}
+
+
+@pytest.mark.parametrize("jobs", ["1", "2", "4"])
+def test_compile_jobs_external_input_is_snapshot(tmp_path, monkeypatch, jobs):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "slow"
+    fake_external.write_text("#!/bin/sh\nsleep 0.5\necho '{\"tree\": {}}'\n")
+    fake_external.chmod(0o755)
+    fake_external = tmp_path / "count"
+    fake_external.write_text(textwrap.dedent(f"""\
+    #!{sys.executable}
+    import json, sys
+    print(json.dumps({{"tree": {{"n": len(json.load(sys.stdin)["tree"]["big"])}}}}))
+    """))
+    fake_external.chmod(0o755)
+
+    # the slow externals keep the executor busy while "big" changes, "count"
+    # still sees it as it was when it was passed
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      big:
+        a: 1
+        b: 2
+      s1:
+        otk.external.slow: {}
+      s2:
+        otk.external.slow: {}
+      s3:
+        otk.external.slow: {}
+      s4:
+        otk.external.slow: {}
+      count:
+        otk.external.count:
+          big: ${big}
+    otk.define.later:
+      big:
+        zzz: 3
+    otk.target.osbuild:
+      n: ${count.n}
+    """))
+    output = tmp_path / "out.json"
+    assert run(["compile", "-j", jobs, "-o", os.fspath(output), os.fspath(test_otk)]) == 0
+    assert json.loads(output.read_text()) == {"n": 2, "version": "2"}
+
+
+def test_compile_jobs_external_fails(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "fail"
+    fake_external.write_text("#!/bin/sh\nexit 1\n")
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.define:
+      unused:
+        otk.external.fail: {}
+    otk.target.osbuild:
+      x: y
+    """))
+    with pytest.raises(ExternalFailedError):
+        run(["compile", "-j", "2", "-o", os.fspath(tmp_path / "out.json"), os.fspath(test_otk)])
+
+
+@pytest.mark.parametrize("cache_args,expected_stats", [
+    (["--cache-externals"], ["external cache: 0 hits, 1 misses, 0 evictions",
+                             "external cache: 1 hits, 0 misses, 0 evictions"]),
+    (["--cache-externals", "--no-cache"], []),
+    ([], []),
+])
+def test_external_cache(tmp_path, monkeypatch, caplog, cache_args, expected_stats):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("OTK_EXTERNAL_PATH", os.fspath(tmp_path))
+    fake_external = tmp_path / "pure"
+    fake_external.write_text(textwrap.dedent("""\
+    #!/bin/sh
+    echo called >> "$0".calls
+    echo '{"tree": {"value": "result"}, "cacheable": true}'
+    """))
+    fake_external.chmod(0o755)
+
+    test_otk = tmp_path / "foo.yaml"
+    test_otk.write_text(textwrap.dedent("""
+    otk.version: 1
+    otk.target.osbuild:
+      x:
+        otk.external.pure: {}
+    """))
+    for _ in range(2):
+        assert run(["compile", "-o", os.fspath(tmp_path / "out.json")] + cache_args + [os.fspath(test_otk)]) == 0
+        assert json.loads((tmp_path / "out.json").read_text()) == {"x": {"value": "result"}, "version": "2"}
+
+    calls = 1 if expected_stats else 2
+    assert fake_external.with_suffix(".calls").read_text() == "called\n" * calls
+    assert expected_stats == [rec.message for rec in caplog.records if rec.message.startswith("external cache")]
@@ -1,7 +1,8 @@
 import json
+import logging
 from io import StringIO
 
-from otk_external_osbuild.command.make_depsolve_dnf4_curl_source import root
+from otk_external_osbuild.command.make_depsolve_dnf4_curl_source import process, root, slim_package
 
 
 fake_input = {
@@ -51,5 +52,28 @@ def test_make_depsolve_dnf4_curl_source(capsys):
                     }
                 }
             }
-        }
+        },
+        "cacheable": True,
     }
+
+
+def test_make_depsolve_dnf4_curl_source_dedup(caplog):
+    caplog.set_level(logging.INFO)
+    packagesets = fake_input["tree"]["packagesets"]
+    overlapping = {"const": {"internal": {"packages": [
+        {"remote_location": "http://example.com/other/pkg1", "checksum": "sha256:1234"},
+    ]}}}
+    output = process({"packagesets": packagesets + [overlapping]})
+    # the first location of a package is used
+    assert output["tree"]["org.osbuild.curl"]["items"] == {
+        "sha256:1234": {"url": "http://example.com/pkg1"},
+        "sha256:5678": {"url": "http://example.com/pkg2"},
+    }
+    assert "3 packages in 3 package sets, 2 unique, 1 duplicates" in caplog.text
+
+
+def test_make_depsolve_dnf4_curl_source_slim_package():
+    package = {"name": "pkg1", "remote_location": "http://example.com/pkg1", "checksum": "sha256:1234"}
+    assert slim_package(package) == {"remote_location": "http://example.com/pkg1", "checksum": "sha256:1234"}
+    other = {"name": "pkg1"}
+    assert slim_package(other) is other
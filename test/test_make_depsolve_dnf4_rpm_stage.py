@@ -56,7 +56,8 @@ def test_make_depsolve_dnf4_rpm_stage(capsys):
                     "gpg-key1",
                 ],
             }
-        }
+        },
+        "cacheable": True,
     }
 
 
@@ -118,5 +119,6 @@ def test_make_depsolve_dnf4_rpm_stage_with_options(capsys):
                 "disable_dracut": True,
                 "dbpath": "/usr/share/rpm",
             }
-        }
+        },
+        "cacheable": True,
     }
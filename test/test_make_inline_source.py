@@ -1,8 +1,13 @@
+import base64
 import json
+import os
 from io import StringIO
 from test.test_gen_inline_files import expected_output
 
-from otk_external_osbuild.command.make_inline_source import root
+import pytest
+
+from otk_external_osbuild.command import gen_inline_files
+from otk_external_osbuild.command.make_inline_source import process, root
 
 # use the output from test_gen_inline_files
 test_input = expected_output
@@ -33,5 +38,68 @@ def test_make_inline_source(capsys):
                     }
                 }
             }
-        }
+        },
+        "cacheable": True,
+    }
+
+
+def test_make_inline_source_dedup():
+    files = test_input["tree"]["const"]["files"]
+    other = {"copy-of-bob": files["bob"]}
+    output = process({"const": {"files": [files, other]}})
+    assert output == process({"const": {"files": files}})
+    assert len(output["tree"]["org.osbuild.inline"]["items"]) == len(files)
+
+
+def make_store_tree(tmp_path):
+    for name, contents in [("a", b"same contents"), ("b", b"same contents"), ("c", b"other contents")]:
+        (tmp_path / name).write_bytes(contents)
+    return {
+        "inline": {"d": {"contents": "inline contents"}},
+        "paths": {name: {"path": os.fspath(tmp_path / name), "type": "binary"} for name in "abc"},
     }
+
+
+def test_make_inline_source_store(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_INLINE_FILES_STORE_DIR", os.fspath(tmp_path / "store"))
+    tree = make_store_tree(tmp_path)
+    embedded = gen_inline_files.process(tree)["tree"]
+    stored = gen_inline_files.process({**tree, "store": True})["tree"]
+    for name, file in stored["const"]["files"].items():
+        assert file["id"] == embedded["const"]["files"][name]["id"]
+        # only files on disk are stored
+        assert ("data" in file) == (name == "d")
+    assert len(list((tmp_path / "store").iterdir())) == 2
+
+    res = process(stored)
+    assert res["tree"] == process(embedded)["tree"]
+    # the output depends on the contents of the store
+    assert "cacheable" not in res
+    assert process(embedded)["cacheable"] is True
+
+
+def test_make_inline_source_store_evicted(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_INLINE_FILES_STORE_DIR", os.fspath(tmp_path / "store"))
+    tree = make_store_tree(tmp_path)
+    expected = process(gen_inline_files.process(tree)["tree"])["tree"]
+    stored = gen_inline_files.process({**tree, "store": True})["tree"]
+
+    # evicted or corrupted contents are read from their source again
+    entries = sorted((tmp_path / "store").iterdir())
+    entries[0].unlink()
+    entries[1].write_text(base64.b64encode(b"corrupted").decode())
+    assert process(stored)["tree"] == expected
+
+    # unless that changed too
+    entries[1].unlink()
+    (tmp_path / "c").write_bytes(b"changed")
+    with pytest.raises(ValueError, match=r"contents of .*/c changed, they no longer match sha256:"):
+        process(stored)
+
+
+def test_make_inline_source_store_no_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OTK_INLINE_FILES_STORE_DIR", os.fspath(tmp_path / "store"))
+    monkeypatch.setenv("OTK_NO_CACHE", "1")
+    tree = make_store_tree(tmp_path)
+    assert gen_inline_files.process({**tree, "store": True}) == gen_inline_files.process(tree)
+    assert not (tmp_path / "store").exists()
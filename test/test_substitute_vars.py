@@ -2,7 +2,7 @@ import re
 
 import pytest
 from otk.context import CommonContext
-from otk.transform import substitute_vars
+from otk.transform import Template, VarRef, compile_template, substitute_vars
 from otk.traversal import State
 from otk.error import ParseError, TransformDirectiveTypeError, TransformVariableLookupError, TransformVariableTypeError
 
@@ -141,3 +141,31 @@ def test_substitute_vars_unhappy():
         substitute_vars(ctx, state, "a${dict}b")
     assert "foo.yaml: string 'a${dict}b' resolves to an incorrect type, " \
         "expected int, float, or str but got dict" in str(exc.value)
+
+
+def test_substitute_vars_repeated_and_literal():
+    state = State("")
+    ctx = CommonContext()
+    ctx.define("a", "foo")
+    ctx.define("path", r"C:\some\path")
+
+    assert substitute_vars(ctx, state, "${a}/${a}/${a}") == "foo/foo/foo"
+    assert substitute_vars(ctx, state, "no vars ${ here") == "no vars ${ here"
+    # values are inserted literally, no regex escape processing
+    assert substitute_vars(ctx, state, "p=${path}") == r"p=C:\some\path"
+
+
+def test_substitute_vars_template_cached():
+    compile_template.cache_clear()
+    state = State("")
+    ctx = CommonContext()
+    ctx.define("a", "foo")
+
+    for _ in range(3):
+        assert substitute_vars(ctx, state, "x-${a}-y") == "x-foo-y"
+    info = compile_template.cache_info()
+    assert info.misses == 1
+    assert info.hits == 2
+
+    assert compile_template("x-${a}-y") == Template(None, ("x-", VarRef("a", None), "-y"))
+    assert compile_template("${a}") == Template(VarRef("a", None), ())
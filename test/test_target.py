@@ -0,0 +1,81 @@
+import io
+import json
+import sys
+
+import pytest
+
+from otk.context import CommonContext, OSBuildContext
+from otk.target import CommonTarget, OSBuildTarget
+from otk.tree import iter_json
+
+TREE = {
+    "otk.target.osbuild": {
+        "pipelines": [{"name": "build", "stages": [{"type": "org.osbuild.rpm", "options": {}}]}],
+        "sources": {"org.osbuild.curl": {"items": {"sha256:1234": {"url": "https://example.com/ä"}}}},
+    },
+}
+
+
+@pytest.mark.parametrize("pretty", [True, False])
+def test_osbuild_target_write_same_as_string(pretty):
+    ctx = OSBuildContext(CommonContext(target_requested="osbuild"))
+    target = OSBuildTarget()
+
+    fp = io.StringIO()
+    target.write(fp, ctx, TREE, pretty)
+    assert fp.getvalue() == target.as_string(ctx, TREE, pretty)
+
+
+def test_osbuild_target_write_compact():
+    ctx = OSBuildContext(CommonContext(target_requested="osbuild"))
+
+    fp = io.StringIO()
+    OSBuildTarget().write(fp, ctx, {"otk.target.osbuild": {"a": [1, 2]}}, pretty=False)
+    assert fp.getvalue() == '{"a":[1,2],"version":"2"}'
+
+
+def test_osbuild_target_write_does_not_modify_tree():
+    ctx = OSBuildContext(CommonContext(target_requested="osbuild"))
+    tree = {"otk.target.osbuild": {"a": 1}}
+
+    OSBuildTarget().write(io.StringIO(), ctx, tree)
+    assert tree == {"otk.target.osbuild": {"a": 1}}
+
+
+@pytest.mark.parametrize("pretty", [True, False])
+def test_common_target_write_same_as_string(pretty):
+    ctx = CommonContext()
+    target = CommonTarget()
+
+    fp = io.StringIO()
+    target.write(fp, ctx, TREE, pretty)
+    assert fp.getvalue() == target.as_string(ctx, TREE, pretty)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"indent": 2}, {"indent": "\t"}, {"separators": (",", ":")}])
+def test_iter_json_same_as_json(kwargs):
+    tree = {
+        "a": [1, 2.5, -0.0, 1e100, float("inf"), float("nan"), {"b": None, "c": True}, [], {}],
+        2: False, None: "x", 2.5: [[[]]], True: {"ä": "ü\n"},
+    }
+    assert "".join(iter_json(tree, **kwargs)) == json.dumps(tree, **kwargs)
+    assert "".join(iter_json("str", **kwargs)) == json.dumps("str", **kwargs)
+
+
+def test_iter_json_errors():
+    tree: list = []
+    tree.append(tree)
+    with pytest.raises(ValueError, match="Circular reference detected"):
+        "".join(iter_json(tree))
+    with pytest.raises(TypeError, match="Object of type set is not JSON serializable"):
+        "".join(iter_json({"a": set()}))
+    with pytest.raises(TypeError, match="keys must be str, int, float, bool or None, not tuple"):
+        "".join(iter_json({(1,): 1}))
+
+
+def test_iter_json_deep_tree():
+    depth = sys.getrecursionlimit() * 5
+    tree: list = []
+    for _ in range(depth):
+        tree = [{"a": tree}]
+    assert "".join(iter_json(tree, separators=(",", ":"))) == '[{"a":' * depth + "[]" + "}]" * depth
@@ -1,5 +1,8 @@
+import sys
+
 import pytest
 from otk import transform
+from otk.cache import DiskCache
 from otk.error import ParseTypeError
 from otk.context import CommonContext
 from otk.traversal import State
@@ -40,18 +43,191 @@ from otk.traversal import State
         ),
     ]
 )
-def test_transform_process_defines(data, defines):
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
+def test_transform_process_defines(data, defines, resolver):
     ctx = CommonContext()
     state = State("")
 
-    transform.process_defines(ctx, state, data)
+    if resolver == "recursive":
+        transform.process_defines(ctx, state, data)
+    else:
+        transform.resolve_iterative(ctx, state, {"otk.define": data})
     assert ctx._variables == defines
 
 
-def test_transform_resolve_unknown_type():
+@pytest.mark.parametrize("resolver", ["recursive", "iterative"])
+def test_transform_resolve_unknown_type(resolver):
     ctx = CommonContext()
     state = State("foo.yaml")
 
     with pytest.raises(ParseTypeError) as exc:
-        transform.resolve(ctx, state, 1j)
+        transform.RESOLVERS[resolver](ctx, state, [1j])
     assert str(exc.value) == "foo.yaml: could not look up <class 'complex'> in resolvers"
+
+
+def test_transform_parse_cache_reuses_parse(tmp_path, monkeypatch):
+    path = tmp_path / "fragment.yaml"
+    path.write_text("a:\n  b: [1, 2]\n")
+
+    calls = []
+    real_load = transform.yaml.load
+
+    def counting_load(*args, **kwargs):
+        calls.append(args)
+        return real_load(*args, **kwargs)
+
+    monkeypatch.setattr(transform.yaml, "load", counting_load)
+
+    cache = transform.ParseCache()
+    first = cache.load(path)
+    second = cache.load(path)
+    assert first == second == {"a": {"b": [1, 2]}}
+    assert len(calls) == 1
+
+    # every load is a private copy that can be modified in place
+    first["a"]["b"].append(3)
+    assert cache.load(path) == {"a": {"b": [1, 2]}}
+
+
+def test_transform_parse_cache_reparses_changed_file(tmp_path):
+    path = tmp_path / "fragment.yaml"
+    path.write_text("a: 1\n")
+
+    cache = transform.ParseCache()
+    assert cache.load(path) == {"a": 1}
+
+    path.write_text("a: 22\n")
+    assert cache.load(path) == {"a": 22}
+
+
+def test_transform_copy_tree_keeps_aliases():
+    shared = {"x": [1]}
+    tree = {"a": shared, "b": shared, "c": "str"}
+
+    copied = transform.copy_tree(tree)
+    assert copied == tree
+    assert copied["a"] is not shared
+    assert copied["a"] is copied["b"]
+
+
+def test_transform_copy_tree_deep_tree():
+    depth = sys.getrecursionlimit() * 5
+    tree: dict = {"leaf": 1}
+    for _ in range(depth):
+        tree = {"a": [tree]}
+
+    copied = transform.copy_tree(tree)
+    for _ in range(depth):
+        assert copied is not tree
+        copied, tree = copied["a"][0], tree["a"][0]
+    assert copied == {"leaf": 1}
+
+
+def test_transform_parse_cache_store(tmp_path, monkeypatch):
+    path = tmp_path / "fragment.yaml"
+    path.write_text("a:\n  b: [1, 2]\n")
+    store = DiskCache(tmp_path / "cache", 1024 * 1024)
+
+    assert transform.ParseCache(store).load(path) == {"a": {"b": [1, 2]}}
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    # a new run does not parse the unchanged file again
+    def fail_load(*args, **kwargs):
+        raise AssertionError("unexpected parse")
+
+    with monkeypatch.context() as m:
+        m.setattr(transform.yaml, "load", fail_load)
+        assert transform.ParseCache(store).load(path) == {"a": {"b": [1, 2]}}
+
+    path.write_text("a: changed\n")
+    assert transform.ParseCache(store).load(path) == {"a": "changed"}
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_transform_parse_cache_store_broken_entry(tmp_path):
+    path = tmp_path / "fragment.yaml"
+    path.write_text("a: 1\n")
+    store = DiskCache(tmp_path / "cache", 1024 * 1024)
+    transform.ParseCache(store).load(path)
+
+    for entry in (tmp_path / "cache").iterdir():
+        entry.write_bytes(b"")
+    assert transform.ParseCache(store).load(path) == {"a": 1}
+
+
+def test_transform_resolve_copy_on_write():
+    ctx = CommonContext(target_requested="osbuild")
+    ctx.define("var", "value")
+    state = State("")
+
+    unchanged = {"a": [1, "two", {"three": 3.0}], "b": None}
+    changed = {"a": ["${var}"], "b": {"c": "d"}}
+    tree = {
+        "otk.version": 1,
+        "otk.define": {"x": 1},
+        "otk.target.osbuild": {"unchanged": unchanged, "changed": changed},
+    }
+    orig = {
+        "otk.version": 1,
+        "otk.define": {"x": 1},
+        "otk.target.osbuild": {"unchanged": unchanged, "changed": {"a": ["${var}"], "b": {"c": "d"}}},
+    }
+
+    res = transform.resolve(ctx, state, tree)
+    assert tree == orig
+    assert res == {
+        "otk.version": 1,
+        "otk.target.osbuild": {
+            "unchanged": unchanged,
+            "changed": {"a": ["value"], "b": {"c": "d"}},
+        },
+    }
+    # unchanged subtrees are shared, not copied
+    assert res["otk.target.osbuild"]["unchanged"] is unchanged
+    assert res["otk.target.osbuild"]["changed"]["b"] is changed["b"]
+    assert transform.resolve(ctx, state, unchanged) is unchanged
+
+
+def test_transform_op_join_does_not_modify_input():
+    ctx = CommonContext()
+    ctx.define("var", [2])
+    state = State("")
+
+    tree = {"otk.op.join": {"values": [[1], "${var}"]}}
+    assert transform.resolve(ctx, state, tree) == [1, 2]
+    assert tree == {"otk.op.join": {"values": [[1], "${var}"]}}
+
+
+def test_transform_resolve_iterative_deep_tree():
+    ctx = CommonContext()
+    ctx.define("var", "value")
+    state = State("")
+
+    depth = sys.getrecursionlimit() * 5
+    tree: dict = {"leaf": "${var}"}
+    for _ in range(depth):
+        tree = {"otk.define": {"x": 1}, "a": [tree]}
+
+    res = transform.resolve_iterative(ctx, state, tree)
+    for _ in range(depth):
+        assert list(res) == ["a"]
+        res = res["a"][0]
+    assert res == {"leaf": "value"}
+
+
+def test_transform_find_targets(tmp_path):
+    (tmp_path / "a.yaml").write_text("otk.target.osbuild.a: {}\notk.include: b.yaml\n")
+    (tmp_path / "b.yaml").write_text("otk.target.osbuild.b: {}\notk.include: a.yaml\n")
+    (tmp_path / "c.yaml").write_text("otk.target.osbuild.c: {}\n")
+    path = tmp_path / "foo.yaml"
+    path.write_text(
+        "otk.version: 1\n"
+        "otk.target.osbuild.foo: {}\n"
+        "otk.include: a.yaml\n"
+        "otk.include.more: c.yaml\n"
+        # only found by resolving
+        "otk.include.vars: ${name}.yaml\n"
+        "otk.include.missing: missing.yaml\n"
+    )
+    ctx = CommonContext()
+    assert transform.find_targets(ctx, State(), path) == ["osbuild.foo", "osbuild.a", "osbuild.b", "osbuild.c"]
@@ -16,12 +16,12 @@ def test_state_copy():
     state = State("some-path")
     assert state.path == "some-path"
     assert state.define_subkey() == ""
-    assert state._includes == ["some-path"]
+    assert state._includes == ("some-path",)
     new_state = state.copy(path="new-path")
     assert state.path == "some-path"
-    assert state._includes == ["some-path"]
+    assert state._includes == ("some-path",)
     assert new_state.path == "new-path"
-    assert new_state._includes == ["some-path", "new-path"]
+    assert new_state._includes == ("some-path", "new-path")
 
     ns2 = state.copy(subkey_add="key")
     assert state.define_subkey() == ""
@@ -45,7 +45,7 @@ def test_state_detect_circular_1():
     with pytest.raises(CircularIncludeError) as exc:
         ns2.copy(path="a.yaml")
     assert str(exc.value) == "circular include from a.yaml->b.yaml->c/c.yaml->a.yaml"
-    assert ns2._includes == ["a.yaml", "b.yaml", "c/c.yaml"]
+    assert ns2._includes == ("a.yaml", "b.yaml", "c/c.yaml")
 
 
 def test_state_detect_circular_2():
@@ -58,3 +58,18 @@ def test_state_detect_circular_2():
 def test_state_empty_includes():
     state = State()
     assert len(state._includes) == 0
+
+
+def test_state_copy_shares_unchanged():
+    state = State("a.yaml")
+    ns1 = state.copy(subkey_add="key")
+    assert ns1._includes is state._includes
+    ns2 = ns1.copy(path="b.yaml")
+    assert ns2._define_subkeys is ns1._define_subkeys
+    assert ns2.define_subkey("sub") == "key.sub"
+
+
+def test_state_error_on_new_attribute():
+    state = State("some-path")
+    with pytest.raises(ValueError):
+        state.other = "value"
@@ -0,0 +1,77 @@
+import pathlib
+import textwrap
+
+import pytest
+import yaml
+
+from otk import transform
+from otk.error import ParseDuplicatedYamlKeyError
+
+EXAMPLE_PATH = pathlib.Path(__file__).parent.parent / "example"
+
+LOADERS = [
+    pytest.param("python"),
+    pytest.param("libyaml", marks=pytest.mark.skipif(
+        "libyaml" not in transform.YAML_LOADERS, reason="PyYAML built without libyaml")),
+]
+
+
+@pytest.fixture(params=LOADERS)
+def loader(request, monkeypatch):
+    loader = transform.YAML_LOADERS[request.param]
+    monkeypatch.setattr(transform, "yaml_loader", loader)
+    return loader
+
+
+def test_yaml_loader_default_prefers_libyaml():
+    if yaml.__with_libyaml__:
+        assert transform.yaml_loader is transform.YAML_LOADERS["libyaml"]
+    else:
+        assert transform.yaml_loader is transform.SafeUniqueKeyLoader
+
+
+@pytest.mark.parametrize("src_yaml", sorted(EXAMPLE_PATH.glob("**/*.yaml")), ids=str)
+def test_yaml_loader_examples(loader, src_yaml):  # pylint: disable=unused-argument
+    with src_yaml.open(encoding="utf8") as fp:
+        expected = yaml.safe_load(fp)
+    assert transform.load_yaml(src_yaml) == expected
+
+
+def test_yaml_loader_duplicated_otk_key(loader, tmp_path):  # pylint: disable=unused-argument
+    path = tmp_path / "dup.yaml"
+    path.write_text(textwrap.dedent("""
+    otk.include: a.yaml
+    otk.include: b.yaml
+    """))
+    with pytest.raises(ParseDuplicatedYamlKeyError) as exc:
+        transform.load_yaml(path)
+    assert str(exc.value) == (
+        "duplicated 'otk.include' key found, try using otk.include.<uniq-tag>, e.g. otk.include.foo")
+
+
+def test_yaml_loader_duplicated_key(loader, tmp_path):  # pylint: disable=unused-argument
+    path = tmp_path / "dup.yaml"
+    path.write_text(textwrap.dedent("""
+    a:
+      foo: 1
+      foo: 2
+    """))
+    with pytest.raises(ParseDuplicatedYamlKeyError) as exc:
+        transform.load_yaml(path)
+    assert str(exc.value) == "duplicated 'foo' key found"
+
+
+def test_yaml_loader_merge_keys_are_not_duplicates(loader, tmp_path):  # pylint: disable=unused-argument
+    path = tmp_path / "merge.yaml"
+    path.write_text(textwrap.dedent("""
+    base: &base
+      a: 1
+      b: 2
+    other: &other
+      c: 3
+    merged:
+      <<: *base
+      <<: *other
+      b: 22
+    """))
+    assert transform.load_yaml(path)["merged"] == {"a": 1, "b": 22, "c": 3}